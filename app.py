@@ -1,51 +1,13 @@
-import gradio as gr
 import os
 import sys
 import base64
-from PIL import Image
-from io import BytesIO
-from datetime import datetime
-import tempfile
 import json
 import time
+import asyncio
 from pathlib import Path
 
-# Gradioバージョン確認
-try:
-    print(f"Gradio version: {gr.__version__}")
-    import gradio_client
-    print(f"Gradio Client version: {gradio_client.__version__}")
-except Exception as e:
-    print(f"バージョン確認エラー: {e}")
-
-# Gradioのバグ修正用猿パッチ（ChatGPT推奨）
-try:
-    import gradio_client.utils as _gcu
-    _orig = _gcu._json_schema_to_python_type  # keep ref
-
-    def _patched(schema, defs=None):
-        if isinstance(schema, bool):          # ← 追加
-            schema = {}                       # bool → 空dict に変換
-        return _orig(schema, defs or {})
-
-    _gcu._json_schema_to_python_type = _patched
-    print("Gradio猿パッチを適用しました")
-except Exception as e:
-    print(f"Gradio猿パッチの適用に失敗: {e}")
-
-# OpenAI proxies引数互換パッチ（古いSDK用）
-try:
-    import inspect
-    import functools
-    from openai import OpenAI
-    
-    if 'proxies' in inspect.signature(OpenAI.__init__).parameters:
-        OpenAI.__init__ = functools.partialmethod(OpenAI.__init__, proxies=None)
-        print("OpenAI proxies猿パッチを適用しました")
-    else:
-        print("OpenAI proxies引数は存在しません（新しいSDK）")
-except Exception as e:
-    print(f"OpenAI猿パッチの適用に失敗: {e}")
+# gradio・openaiは読み込みに数秒かかるため、初めて使う時点で読み込む
+# （gradioはcreate_optimized_app内、openaiはクライアント作成時。互換パッチもその時点で適用）
 
 # HuggingFace Spaces用パス設定
 BASE_DIR = Path(__file__).parent
@@ -56,68 +18,35 @@ for key in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
     os.environ.pop(key, None)
 
 try:
-    from src.services.image_generator import ImageGenerator
-    from src.services.responses_api import ResponsesAPI
+    from src.services.image_generator import AsyncImageGenerator
+    from src.services.responses_api import AsyncResponsesAPI
+    from src.services.rate_limit import api_key_id
+    from src.services.reference_cache import reference_key
+    from src.services.chat_api import create_chat_completion
+    from src.services.yaml_converter import convert_to_yaml_prompt
+    from src.services.prompt_templates import get_template_registry
+    from src.services.history_store import sweep_orphaned_files
+    from src.services.image_executor import get_image_executor
+    from src.services.session_store import SessionStore
+    from src.services.job_scheduler import PRIORITY_INTERACTIVE, PRIORITY_STANDARD, get_job_scheduler
+    from src.utils.metrics import TIME_TO_FIRST_PIXEL, get_latency_recorder
+    from src.utils.tracing import span, start_trace
+    from src.utils.image_utils import decode_to_rgba, image_from_rgba, prepare_reference_image
+    from src.utils.pricing import calculate_image_cost
+    from src.utils.config import API_SETTINGS
+    from src.utils.compat import ensure_gradio_schema_patch
 except ImportError as e:
     print(f"モジュールのインポートエラー: {e}")
 
 # 設定定数
 APP_CONFIG = {
     'title': 'AI画像生成',
-    'default_compression': 80
-}
-
-# GPT Image 1価格設定（2025年6月最新価格）
-GPT_IMAGE_PRICING = {
-    'low': {
-        '1024x1024': 0.011,
-        '1024x1536': 0.016,
-        '1536x1024': 0.016
-    },
-    'medium': {
-        '1024x1024': 0.042,
-        '1024x1536': 0.063,
-        '1536x1024': 0.063
-    },
-    'hd': {  # high
-        '1024x1024': 0.167,
-        '1024x1536': 0.25,
-        '1536x1024': 0.25
-    }
+    'default_compression': 80,
+    'default_partial_images': int(os.getenv("IMAGE_STREAM_PARTIAL_IMAGES", 2)),  # ストリーミング時の部分画像数（1〜3）
+    'concurrency_limit': int(os.getenv("APP_CONCURRENCY_LIMIT", 8)),  # イベントごとの同時実行数（セッション分離済み）
+    'fast_startup': os.getenv("FAST_STARTUP", "0") in ("1", "true", "True")  # APIを先に起動し、UIは裏で構築する
 }
 
-def calculate_image_cost(size, quality, image_count=1):
-    """サイズと品質に基づいて正確なコストを計算"""
-    try:
-        # 品質マッピング
-        quality_map = {
-            'auto': 'medium',  # デフォルトはmedium
-            'standard': 'medium',
-            'low': 'low',
-            'medium': 'medium', 
-            'high': 'hd',  # OpenAI docsではhigh = hd
-            'hd': 'hd'
-        }
-        
-        mapped_quality = quality_map.get(quality, 'medium')
-        cost_per_image = GPT_IMAGE_PRICING[mapped_quality][size]
-        total_cost_usd = cost_per_image * image_count
-        total_cost_jpy = total_cost_usd * 150  # 1USD = 150円で概算
-        
-        return {
-            'cost_usd': f"{total_cost_usd:.3f}",
-            'cost_jpy': f"{total_cost_jpy:.1f}",
-            'per_image_usd': f"{cost_per_image:.3f}"
-        }
-    except Exception as e:
-        # フォールバック価格
-        fallback_cost = 0.042 * image_count
-        return {
-            'cost_usd': f"{fallback_cost:.3f}",
-            'cost_jpy': f"{fallback_cost * 150:.1f}",
-            'per_image_usd': "0.042"
-        }
-
 SIZE_MAP = {
     "1024x1024 (正方形)": "1024x1024",
     "1024x1536 (縦長)": "1024x1536", 
@@ -238,28 +167,151 @@ def build_simple_prompt(purpose, message, style, colors, elements, additional):
     return ", ".join(parts)
 
 def create_optimized_app():
-    # アプリケーション状態の初期化（完全版）
-    app_state = {
-        'generation_history': [],
-        'current_image': None,
-        'current_prompt': "",
-        'original_prompt': "",  # 元のプロンプトを保存
-        'api_key': None,
-        'last_response_id': None,  # Responses API用
-        'generation_context': [],  # マルチターン用のコンテキスト
-        'api_mode': 'image',  # 'image' or 'responses'
-        'current_size': '1024x1024 (正方形)'
-    }
+    import gradio as gr
+    
+    # Gradioバージョン確認
+    print(f"Gradio version: {gr.__version__}")
+    
+    # bool型のJSONスキーマで落ちるgradio_clientの不具合を回避（該当バージョンのみ）
+    ensure_gradio_schema_patch()
+    
+    # ベースYAMLテンプレートを起動時に一括読み込み（リクエスト時のファイルI/Oを排除）
+    get_template_registry()
+    
+    # 前回プロセスが残した履歴一時ファイルを整理
+    sweep_orphaned_files()
+    
+    # アプリケーション状態はセッションごとに分離（gr.Requestのセッションハッシュ単位）
+    sessions = SessionStore()
+    
+    # 画像生成・Responses API呼び出しのアドミッション制御（APIキー単位・全体の同時実行数と待ち行列の上限）
+    jobs = get_job_scheduler()
+    
+    async def save_images_to_history(app_state, image_list, prompt_text, purpose, style, format_opt):
+        """生成画像を履歴に追加し、表示用の先頭画像のファイルパスを返す
+        
+        保存はバックグラウンドの履歴ライターで行い（形式が一致すればデコードせずそのまま書き出し）、
+        ハンドラは表示に必要な先頭画像の書き込み完了のみを待つ
+        """
+        with span("history_write", images=len(image_list), bytes=sum(len(data) for data in image_list)):
+            records = []
+            for i, img_data in enumerate(image_list):
+                records.append(app_state.history.add(
+                    img_data,
+                    f"{prompt_text} (画像{i+1}/{len(image_list)})" if len(image_list) > 1 else prompt_text,
+                    purpose,
+                    style,
+                    format_opt
+                ))
+            
+            if not records:
+                return None
+            # 現在画像は履歴レコードを参照（画像バッファを複製しない）
+            app_state['current_image'] = records[0]
+            await asyncio.wrap_future(records[0].write_future)
+            return records[0].temp_file
+    
+    def start_edit_tree(app_state, response_id, image_data, prompt_text, format_opt):
+        """対話型有効の生成結果を編集ツリーのルートにする（現在画像は保存直後の履歴レコード）"""
+        record = app_state.get('current_image')
+        # 履歴と同じバッファを保持する（全セッションの容量計算で重複して数えないため）
+        app_state.edit_tree.add(None, response_id, record.image_data if record is not None else image_data,
+                                prompt_text, format_opt, record_id=record.record_id if record is not None else None)
     
-    def generate_image_fast(api_key, purpose, message, style, colors, elements, additional, 
-                           size, quality, format_opt, transparent, compression, moderation, image_count, use_ai_mode, enable_responses_api):
-        """高速画像生成（AI緻密設計モード無効化で高速化）"""
+    async def edit_node_image(app_state, node):
+        """編集ツリーのノード画像（履歴の一時ファイルが残っていれば再利用、なければ保持中のバイト列をデコード）"""
+        record = app_state.history.get(node.record_id) if node.record_id is not None else None
+        if record is not None:
+            await asyncio.wrap_future(record.write_future)
+            app_state['current_image'] = record
+            return record.temp_file
+        raw, meta = await get_image_executor().arun(decode_to_rgba, node.image_data)
+        return image_from_rgba(raw, meta["size"])
+    
+    async def stream_generation_events(api_key, prompt_text, size_key, quality, format_opt, transparent,
+                                       compression, moderation, partial_count, previous_response_id=None):
+        """Responses APIのストリーミング生成を実行し、部分画像はPIL画像に変換して返す
+        
+        戻り値は (イベント種別, 表示用画像, イベント辞書) の非同期イテレーター
+        """
+        responses_api = AsyncResponsesAPI(api_key)
+        if previous_response_id:
+            events = await responses_api.continue_generation(
+                previous_response_id=previous_response_id,
+                prompt=prompt_text,
+                stream=True,
+                size=size_key,
+                quality=quality,
+                format=format_opt,
+                background="transparent" if transparent else "auto",
+                output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                moderation=moderation,
+                partial_images=int(partial_count)
+            )
+        else:
+            events = await responses_api.generate_with_responses(
+                prompt=prompt_text,
+                size=size_key,
+                quality=quality,
+                format=format_opt,
+                background="transparent" if transparent else "auto",
+                output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                moderation=moderation,
+                stream=True,
+                partial_images=int(partial_count)
+            )
+        
+        if isinstance(events, dict):
+            # ストリーム開始前のエラー
+            yield "error", None, events
+            return
+        
+        async for event in events:
+            if event['type'] == 'partial':
+                with span("partial_decode", bytes=len(event['image_data'])):
+                    # デコードは画像処理プロセスで行い、RGBAの生データから画像を復元
+                    raw, meta = await get_image_executor().arun(decode_to_rgba, event['image_data'])
+                    image = image_from_rgba(raw, meta["size"])
+                yield "partial", image, event
+            elif event['type'] == 'final':
+                if not event.get('image_data'):
+                    yield "error", None, {"error": "最終画像が取得できませんでした"}
+                else:
+                    yield "final", None, event
+            else:
+                yield "error", None, event
+    
+    def format_stream_status(event, partial_count):
+        """部分画像受信時のステータス表示"""
+        return f"🎨 生成中... 部分画像 {event['index'] + 1}/{int(partial_count)}（{event['elapsed']}秒）"
+    
+    def format_queue_status(position, eta):
+        """順番待ち中のステータス表示"""
+        return f"⏳ 順番待ち中... {position}番目（予想待ち時間 約{eta:.0f}秒）"
+    
+    def generation_mode(enable_streaming, enable_responses_api):
+        """トレースに記録する生成方式"""
+        return "streaming" if enable_streaming else "responses" if enable_responses_api else "images"
+    
+    def format_ttfp_info(result):
+        """初回表示時間（time-to-first-pixel）の表示"""
+        ttfp_stats = get_latency_recorder().summary(TIME_TO_FIRST_PIXEL).get(TIME_TO_FIRST_PIXEL, {})
+        return (f"\n**初回表示**: {result.get('time_to_first_pixel', 'N/A')}秒"
+                f"（部分画像{result.get('partial_count', 0)}枚, p50 {ttfp_stats.get('p50', 'N/A')}秒）")
+    
+    async def generate_image_fast(api_key, purpose, message, style, colors, elements, additional, 
+                           size, quality, format_opt, transparent, compression, moderation, image_count, use_ai_mode, enable_responses_api,
+                           enable_streaming=False, partial_count=APP_CONFIG['default_partial_images'], request: gr.Request = None):
+        """高速画像生成（AI緻密設計モード無効化で高速化、ストリーミング時は部分画像を逐次表示）"""
+        app_state = sessions.get(request)
+        trace = start_trace("generate_image", mode=generation_mode(enable_streaming, enable_responses_api),
+                            size=size, quality=quality, image_count=int(image_count))
         try:
             valid, error_msg = validate_api_key(api_key)
             if not valid:
-                return None, f"❌ {error_msg}", "", "", None
+                yield None, f"❌ {error_msg}", "", ""
+                return
             
-            os.environ["OPENAI_API_KEY"] = api_key
             app_state['api_key'] = api_key
             app_state['current_size'] = size  # サイズ情報を保存
             
@@ -272,116 +324,122 @@ def create_optimized_app():
                 prompt = ", ".join([p for p in parts if p.strip()])
             
             if not prompt.strip():
-                return None, "❌ エラー: 内容を入力してください", "", "", None
+                yield None, "❌ エラー: 内容を入力してください", "", ""
+                return
             
             # 画像生成（API選択）
             size_key = SIZE_MAP.get(size, "1024x1024")
             
-            if enable_responses_api:
-                # Responses API使用（対話型編集可能）
-                responses_api = ResponsesAPI(api_key)
-                result = responses_api.generate_with_responses(
-                    prompt=prompt,
-                    size=size_key,
-                    quality=quality,
-                    format=format_opt,
-                    background="transparent" if transparent else "auto",
-                    output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                    moderation=moderation
-                )
-            else:
-                # Image API使用（従来通り）
-                generator = ImageGenerator(api_key)
-                result = generator.generate_image(
-                    prompt=prompt,
-                    size=size_key,
-                    quality=quality,
-                    format=format_opt,
-                    transparent_bg=transparent,
-                    output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                    moderation=moderation,
-                    n=int(image_count)
-                )
-            
-            # 複数画像対応
-            if 'images' in result:
-                # 複数画像の場合：最初の画像を表示用に使用
-                image = Image.open(BytesIO(result['images'][0]))
-                
-                # 全ての画像を履歴に保存
-                for i, img_data in enumerate(result['images']):
-                    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-                    img = Image.open(BytesIO(img_data))
-                    img.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
-                    
-                    history_item = {
-                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                        'image_data': img_data,
-                        'prompt': f"{prompt} (画像{i+1}/{len(result['images'])})",
-                        'purpose': purpose or "画像生成",
-                        'style': style or "標準",
-                        'temp_file': temp_file.name
-                    }
-                    app_state['generation_history'].append(history_item)
+            # 生成ジョブの実行枠を待つ（待機中は順番と予想待ち時間を表示）
+            async with jobs.admission(api_key_id(api_key), PRIORITY_STANDARD) as ticket:
+                with span("queue_wait"):
+                    async for position, eta in ticket.updates():
+                        yield gr.update(), format_queue_status(position, eta), gr.update(), gr.update()
                 
-                app_state['current_image'] = {'image_data': result['images'][0], 'prompt': prompt}
-            else:
-                # 単一画像の場合（従来通り）
-                image = Image.open(BytesIO(result['image_data']))
+                if enable_streaming:
+                    # 部分画像ストリーミング（Responses API使用、1枚のみ）
+                    result = None
+                    async for kind, image, event in stream_generation_events(
+                            api_key, prompt, size_key, quality, format_opt, transparent, compression, moderation, partial_count):
+                        if kind == "partial":
+                            yield image, format_stream_status(event, partial_count), gr.update(), prompt
+                        elif kind == "final":
+                            result = event
+                        else:
+                            yield None, f"❌ 生成エラー: {event.get('error', '不明なエラー')}", "", ""
+                            return
+                    if result is None:
+                        yield None, "❌ 生成エラー: 画像が返されませんでした", "", ""
+                        return
+                    image_count = 1
+                elif enable_responses_api:
+                    # Responses API使用（対話型編集可能）
+                    responses_api = AsyncResponsesAPI(api_key)
+                    result = await responses_api.generate_with_responses(
+                        prompt=prompt,
+                        size=size_key,
+                        quality=quality,
+                        format=format_opt,
+                        background="transparent" if transparent else "auto",
+                        output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                        moderation=moderation
+                    )
+                else:
+                    # Image API使用（複数枚は並列サブリクエストに分割）
+                    generator = AsyncImageGenerator(api_key)
+                    result = await generator.generate_image_split(
+                        prompt=prompt,
+                        size=size_key,
+                        quality=quality,
+                        format=format_opt,
+                        transparent_bg=transparent,
+                        output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                        moderation=moderation,
+                        n=int(image_count)
+                    )
+            
+            # 複数画像対応（全ての画像を履歴に保存し、最初の画像を表示用に使用）
+            image_list = result['images'] if 'images' in result else [result['image_data']]
+            # 履歴・状態の更新は同一セッション内で直列化
+            async with app_state.lock:
+                image = await save_images_to_history(
+                    app_state, image_list, prompt, purpose or "画像生成", style or "標準", format_opt
+                )
                 
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-                image.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
+                app_state['current_prompt'] = prompt
+                app_state['original_prompt'] = prompt  # 元のプロンプトを保存
                 
-                history_item = {
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    'image_data': result['image_data'],
-                    'prompt': prompt,
-                    'purpose': purpose or "画像生成",
-                    'style': style or "標準",
-                    'temp_file': temp_file.name
-                }
-                app_state['generation_history'].append(history_item)
-                app_state['current_image'] = {'image_data': result['image_data'], 'prompt': prompt}
-            
-            app_state['current_prompt'] = prompt
-            app_state['original_prompt'] = prompt  # 元のプロンプトを保存
-            
-            # Responses API用の状態更新（常に更新）
-            if enable_responses_api and 'response_id' in result:
-                app_state['last_response_id'] = result['response_id']
-                print(f"[DEBUG] 詳細設定: response_id更新 - {result['response_id'][:8]}...")
-            elif not enable_responses_api:
-                # 従来API使用時はresponse_idをクリア
-                app_state['last_response_id'] = None
-                print(f"[DEBUG] 詳細設定: 従来API使用、response_idクリア")
+                # Responses API用の状態更新（常に更新）
+                if (enable_responses_api or enable_streaming) and result.get('response_id'):
+                    app_state['last_response_id'] = result['response_id']
+                    print(f"[DEBUG] 詳細設定: response_id更新 - {result['response_id'][:8]}...")
+                    start_edit_tree(app_state, result['response_id'], image_list[0], prompt, format_opt)
+                elif not (enable_responses_api or enable_streaming):
+                    # 従来API使用時はresponse_idをクリア
+                    app_state['last_response_id'] = None
+                    app_state.edit_tree.detach()
+                    print(f"[DEBUG] 詳細設定: 従来API使用、response_idクリア")
             
             # コスト情報（複数画像対応）
             image_count_info = f"x{int(image_count)}" if int(image_count) > 1 else ""
-            cost_data = calculate_image_cost(size_key, quality, int(image_count))
+            # 実行中の同一リクエストと合流した場合も追加のAPI呼び出しは発生しない
+            cost_data = calculate_image_cost(size_key, quality, int(image_count),
+                                             result.get('cache_hit', False) or result.get('coalesced', False))
+            cache_note = "（同時リクエストと共有）" if result.get('coalesced') else "（キャッシュ再利用）" if cost_data.get('cache_hit') else ""
             
             cost_info = f"""**生成完了** ⚡
 **時間**: {result.get('generation_time', 'N/A')}秒
 **画像数**: {result.get('image_count', 1)}枚
-**コスト**: 約${cost_data['cost_usd']} (¥{cost_data['cost_jpy']})
+**コスト**: 約${cost_data['cost_usd']} (¥{cost_data['cost_jpy']}){cache_note}
 **モード**: {'AI最適化' if use_ai_mode else '直接'}
 **詳細**: {size_key}, {quality}品質"""
+            if enable_streaming:
+                cost_info += format_ttfp_info(result)
             
-            return image, "✅ 画像生成完了！", cost_info, prompt
+            yield image, "✅ 画像生成完了！", cost_info, prompt
             
         except Exception as e:
-            return None, f"❌ 生成エラー: {str(e)}", "", ""
+            trace.set_error(e)
+            yield None, f"❌ 生成エラー: {str(e)}", "", ""
+        finally:
+            trace.end()
     
-    def generate_from_prompt_fast(api_key, prompt, size, quality, format_opt, transparent, compression, moderation, image_count, enable_responses_api):
-        """プロンプト直接生成（最高速）"""
+    async def generate_from_prompt_fast(api_key, prompt, size, quality, format_opt, transparent, compression, moderation, image_count, enable_responses_api,
+                                        enable_streaming=False, partial_count=APP_CONFIG['default_partial_images'], request: gr.Request = None):
+        """プロンプト直接生成（最高速、ストリーミング時は部分画像を逐次表示）"""
+        app_state = sessions.get(request)
+        trace = start_trace("generate_from_prompt", mode=generation_mode(enable_streaming, enable_responses_api),
+                            size=size, quality=quality, image_count=int(image_count))
         try:
             valid, error_msg = validate_api_key(api_key)
             if not valid:
-                return None, f"❌ {error_msg}", "", "", None
+                yield None, f"❌ {error_msg}", "", ""
+                return
             
             if not prompt.strip():
-                return None, "❌ プロンプトを入力してください", "", "", None
+                yield None, "❌ プロンプトを入力してください", "", ""
+                return
             
-            os.environ["OPENAI_API_KEY"] = api_key
             app_state['api_key'] = api_key
             
             # サイズ情報をapp_stateに保存
@@ -391,103 +449,106 @@ def create_optimized_app():
             if prompt.strip().startswith('style:') or 'main_texts:' in prompt:
                 final_prompt = prompt
             else:
-                final_prompt = convert_to_yaml_prompt(prompt, api_key, size)
+                final_prompt = await convert_to_yaml_prompt(prompt, api_key, size)
             
             size_key = SIZE_MAP.get(size, "1024x1024")
             
-            if enable_responses_api:
-                # Responses API使用（対話型編集可能）
-                responses_api = ResponsesAPI(api_key)
-                result = responses_api.generate_with_responses(
-                    prompt=final_prompt,
-                    size=size_key,
-                    quality=quality,
-                    format=format_opt,
-                    background="transparent" if transparent else "auto",
-                    output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                    moderation=moderation
-                )
-            else:
-                # Image API使用（従来通り）
-                generator = ImageGenerator(api_key)
-                result = generator.generate_image(
-                    prompt=final_prompt,
-                    size=size_key,
-                    quality=quality,
-                    format=format_opt,
-                    transparent_bg=transparent,
-                    output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                    moderation=moderation,
-                    n=int(image_count)
-                )
-            
-            # 複数画像対応
-            if 'images' in result:
-                # 複数画像の場合
-                image = Image.open(BytesIO(result['images'][0]))
+            # 生成ジョブの実行枠を待つ（待機中は順番と予想待ち時間を表示）
+            async with jobs.admission(api_key_id(api_key), PRIORITY_STANDARD) as ticket:
+                with span("queue_wait"):
+                    async for position, eta in ticket.updates():
+                        yield gr.update(), format_queue_status(position, eta), gr.update(), gr.update()
                 
-                for i, img_data in enumerate(result['images']):
-                    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-                    img = Image.open(BytesIO(img_data))
-                    img.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
-                    
-                    history_item = {
-                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                        'image_data': img_data,
-                        'prompt': f"{final_prompt} (画像{i+1}/{len(result['images'])})",
-                        'purpose': "直接プロンプト",
-                        'style': "カスタム",
-                        'temp_file': temp_file.name
-                    }
-                    app_state['generation_history'].append(history_item)
-                app_state['current_image'] = {'image_data': result['images'][0], 'prompt': final_prompt}
-            else:
-                # 単一画像の場合
-                image = Image.open(BytesIO(result['image_data']))
+                if enable_streaming:
+                    # 部分画像ストリーミング（Responses API使用、1枚のみ）
+                    result = None
+                    async for kind, image, event in stream_generation_events(
+                            api_key, final_prompt, size_key, quality, format_opt, transparent, compression, moderation, partial_count):
+                        if kind == "partial":
+                            yield image, format_stream_status(event, partial_count), gr.update(), final_prompt
+                        elif kind == "final":
+                            result = event
+                        else:
+                            yield None, f"❌ 生成エラー: {event.get('error', '不明なエラー')}", "", ""
+                            return
+                    if result is None:
+                        yield None, "❌ 生成エラー: 画像が返されませんでした", "", ""
+                        return
+                    image_count = 1
+                elif enable_responses_api:
+                    # Responses API使用（対話型編集可能）
+                    responses_api = AsyncResponsesAPI(api_key)
+                    result = await responses_api.generate_with_responses(
+                        prompt=final_prompt,
+                        size=size_key,
+                        quality=quality,
+                        format=format_opt,
+                        background="transparent" if transparent else "auto",
+                        output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                        moderation=moderation
+                    )
+                else:
+                    # Image API使用（複数枚は並列サブリクエストに分割）
+                    generator = AsyncImageGenerator(api_key)
+                    result = await generator.generate_image_split(
+                        prompt=final_prompt,
+                        size=size_key,
+                        quality=quality,
+                        format=format_opt,
+                        transparent_bg=transparent,
+                        output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                        moderation=moderation,
+                        n=int(image_count)
+                    )
+            
+            # 複数画像対応（全ての画像を履歴に保存し、最初の画像を表示用に使用）
+            image_list = result['images'] if 'images' in result else [result['image_data']]
+            # 履歴・状態の更新は同一セッション内で直列化
+            async with app_state.lock:
+                image = await save_images_to_history(
+                    app_state, image_list, final_prompt, "直接プロンプト", "カスタム", format_opt
+                )
                 
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-                image.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
+                app_state['current_prompt'] = final_prompt
+                app_state['original_prompt'] = final_prompt  # 元のプロンプトを保存
                 
-                history_item = {
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    'image_data': result['image_data'],
-                    'prompt': final_prompt,
-                    'purpose': "直接プロンプト",
-                    'style': "カスタム",
-                    'temp_file': temp_file.name
-                }
-                app_state['generation_history'].append(history_item)
-                app_state['current_image'] = {'image_data': result['image_data'], 'prompt': final_prompt}
-            
-            app_state['current_prompt'] = final_prompt
-            app_state['original_prompt'] = final_prompt  # 元のプロンプトを保存
-            
-            # Responses API用の状態更新（プロンプト直接）
-            if enable_responses_api and 'response_id' in result:
-                app_state['last_response_id'] = result['response_id']
-                print(f"[DEBUG] プロンプト直接: response_id更新 - {result['response_id'][:8]}...")
-            elif not enable_responses_api:
-                # 従来API使用時はresponse_idをクリア
-                app_state['last_response_id'] = None
-                print(f"[DEBUG] プロンプト直接: 従来API使用、response_idクリア")
+                # Responses API用の状態更新（プロンプト直接）
+                if (enable_responses_api or enable_streaming) and result.get('response_id'):
+                    app_state['last_response_id'] = result['response_id']
+                    print(f"[DEBUG] プロンプト直接: response_id更新 - {result['response_id'][:8]}...")
+                    start_edit_tree(app_state, result['response_id'], image_list[0], prompt, format_opt)
+                elif not (enable_responses_api or enable_streaming):
+                    # 従来API使用時はresponse_idをクリア
+                    app_state['last_response_id'] = None
+                    app_state.edit_tree.detach()
+                    print(f"[DEBUG] プロンプト直接: 従来API使用、response_idクリア")
             
             # コスト情報（複数画像対応）
-            cost_data = calculate_image_cost(size_key, quality, int(image_count))
+            # 実行中の同一リクエストと合流した場合も追加のAPI呼び出しは発生しない
+            cost_data = calculate_image_cost(size_key, quality, int(image_count),
+                                             result.get('cache_hit', False) or result.get('coalesced', False))
+            cache_note = "（同時リクエストと共有）" if result.get('coalesced') else "（キャッシュ再利用）" if cost_data.get('cache_hit') else ""
             cost_info = f"""**生成完了** ⚡
 **時間**: {result.get('generation_time', 'N/A')}秒
 **画像数**: {result.get('image_count', 1)}枚
-**コスト**: 約${cost_data['cost_usd']} (¥{cost_data['cost_jpy']})
+**コスト**: 約${cost_data['cost_usd']} (¥{cost_data['cost_jpy']}){cache_note}
 **モード**: 直接プロンプト
 **YAML変換**: {'適用済み' if final_prompt != prompt else 'なし'}
 **詳細**: {size_key}, {quality}品質"""
+            if enable_streaming:
+                cost_info += format_ttfp_info(result)
             
-            return image, "✅ 画像生成完了！", cost_info, final_prompt
+            yield image, "✅ 画像生成完了！", cost_info, final_prompt
             
         except Exception as e:
-            return None, f"❌ 生成エラー: {str(e)}", "", ""
+            trace.set_error(e)
+            yield None, f"❌ 生成エラー: {str(e)}", "", ""
+        finally:
+            trace.end()
     
-    def ai_chat_response(api_key, message, chat_history):
+    async def ai_chat_response(api_key, message, chat_history, request: gr.Request = None):
         """GPTsライクなAIチャット機能（STEP0-6フロー）"""
+        app_state = sessions.get(request)
         try:
             if not message.strip():
                 return chat_history, ""
@@ -508,10 +569,7 @@ def create_optimized_app():
             # OpenAI APIでGPTsライクな応答を生成
             system_prompt = get_system_prompt_for_step(current_step)
             
-            # APIコール
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            
+            # APIコール（共有クライアントで接続を再利用、429/5xxは自動再試行）
             # 最近の会話履歴（最大10回分）
             recent_history = chat_history[-20:] if len(chat_history) > 20 else chat_history
             
@@ -519,7 +577,8 @@ def create_optimized_app():
             for msg in recent_history:
                 messages.append({"role": msg["role"], "content": msg["content"]})
             
-            response = client.chat.completions.create(
+            response = await create_chat_completion(
+                api_key,
                 model="gpt-4o",  # より高性能なモデルに変更
                 messages=messages,
                 temperature=0.7,
@@ -536,7 +595,7 @@ def create_optimized_app():
                 # YAML形式でない場合は高精度変換
                 if not (yaml_part.startswith("#") or "style:" in yaml_part):
                     current_size = app_state.get('current_size', '1024x1024 (正方形)')
-                    yaml_part = convert_to_yaml_prompt(yaml_part, api_key, current_size)
+                    yaml_part = await convert_to_yaml_prompt(yaml_part, api_key, current_size)
                 
                 # AIレスポンスにYAML完成メッセージを追加（自動反映は削除）
                 ai_response_clean = ai_response.split("YAML_GENERATE:")[0].strip()
@@ -572,251 +631,82 @@ def create_optimized_app():
         user_messages = [msg for msg in chat_history if msg["role"] == "user"]
         return min(len(user_messages), 6)
     
-    def generate_with_reference_image_fast(api_key, reference_image, prompt, size, quality, format_opt, transparent, compression, moderation):
-        """参照画像を使用した高速画像生成"""
+    async def generate_with_reference_image_fast(api_key, reference_image, prompt, size, quality, format_opt, transparent, compression, moderation,
+                                                 request: gr.Request = None):
+        """参照画像を使用した高速画像生成（待機中は順番と予想待ち時間を表示）"""
+        app_state = sessions.get(request)
+        trace = start_trace("generate_with_reference", mode="responses", size=size, quality=quality)
         try:
             valid, error_msg = validate_api_key(api_key)
             if not valid:
-                return None, f"❌ {error_msg}", "", ""
+                yield None, f"❌ {error_msg}", "", ""
+                return
             
             if reference_image is None:
-                return None, "❌ 参照画像をアップロードしてください", "", ""
+                yield None, "❌ 参照画像をアップロードしてください", "", ""
+                return
             
             if not prompt.strip():
-                return None, "❌ 生成したい内容を入力してください", "", ""
+                yield None, "❌ 生成したい内容を入力してください", "", ""
+                return
             
-            os.environ["OPENAI_API_KEY"] = api_key
             app_state['api_key'] = api_key
             
-            # PIL画像をbytesに変換
-            from io import BytesIO
-            image_buffer = BytesIO()
-            reference_image.save(image_buffer, format='PNG')
-            reference_image_data = image_buffer.getvalue()
-            
-            # 画像生成
-            generator = ImageGenerator(api_key)
             size_key = SIZE_MAP.get(size, "1024x1024")
             
-            result = generator.generate_with_reference_image(
-                prompt=prompt,
-                reference_image_data=reference_image_data,
-                size=size_key,
-                quality=quality,
-                format=format_opt,
-                transparent_bg=transparent,
-                output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                moderation=moderation
-            )
+            # 参照画像は内容ハッシュで識別し、アップロード済みならfile_idを再利用（縮小・エンコードも省略）
+            if reference_image.mode not in ("RGB", "RGBA", "L", "LA"):
+                reference_image = reference_image.convert("RGBA")
+            raw_pixels, image_mode, image_size = reference_image.tobytes(), reference_image.mode, reference_image.size
+            with span("reference_hash", bytes=len(raw_pixels)):
+                ref_key = await asyncio.to_thread(reference_key, raw_pixels, image_mode, image_size, size_key)
             
-            # PIL画像に変換
-            image = Image.open(BytesIO(result['image_data']))
+            async def prepare_reference():
+                # 未アップロードの場合のみ、生成サイズに縮小してPNGに変換（画像処理プロセスで実行）
+                with span("reference_encode") as current:
+                    data = await get_image_executor().arun(prepare_reference_image, raw_pixels, image_mode, image_size, size_key)
+                    current.set(bytes=len(data))
+                return data
             
-            # 一時ファイルとして保存
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-            image.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
+            # 画像生成
+            responses_api = AsyncResponsesAPI(api_key)
             
-            # 履歴に保存
-            history_item = {
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                'image_data': result['image_data'],
-                'prompt': f"参照画像: {prompt}",
-                'purpose': "画像参照生成",
-                'style': "参照ベース",
-                'temp_file': temp_file.name
-            }
-            app_state['generation_history'].append(history_item)
-            app_state['current_image'] = {'image_data': result['image_data'], 'prompt': prompt}
-            app_state['current_prompt'] = prompt
-            app_state['original_prompt'] = prompt
+            # 生成ジョブの実行枠を待つ（待機中は順番と予想待ち時間を表示）
+            async with jobs.admission(api_key_id(api_key), PRIORITY_STANDARD) as ticket:
+                with span("queue_wait"):
+                    async for position, eta in ticket.updates():
+                        yield gr.update(), format_queue_status(position, eta), gr.update(), gr.update()
+                
+                result = await responses_api.generate_with_reference(
+                    prompt=prompt,
+                    reference_key=ref_key,
+                    prepare=prepare_reference,
+                    size=size_key,
+                    quality=quality,
+                    format=format_opt,
+                    moderation=moderation
+                )
             
-            # 最新3件に制限
-            if len(app_state['generation_history']) > 3:
-                app_state['generation_history'] = app_state['generation_history'][-3:]
+            # 一時ファイルとして保存し履歴に追加（状態更新は同一セッション内で直列化）
+            async with app_state.lock:
+                image = await save_images_to_history(
+                    app_state, [result['image_data']], f"参照画像: {prompt}", "画像参照生成", "参照ベース", format_opt
+                )
+                app_state['current_prompt'] = prompt
+                app_state['original_prompt'] = prompt
             
             cost_info = f"""**参照画像生成完了** 🖼️
 **時間**: {result.get('generation_time', 'N/A')}秒
-**API**: Image Edit API
+**API**: Responses API（参照画像はアップロード済みのファイルを再利用）
 **モード**: 参照画像ベース生成"""
             
-            return image, "✅ 参照画像生成完了！", cost_info, prompt
+            yield image, "✅ 参照画像生成完了！", cost_info, prompt
             
         except Exception as e:
-            return None, f"❌ 参照画像生成エラー: {str(e)}", "", ""
-    
-    def convert_to_yaml_prompt(text_prompt, api_key, current_size="1024x1024 (正方形)"):
-        """通常のプロンプトをYAML形式に変換（完全な構造保持）"""
-        try:
-            # 基本設定のサイズに基づいてベースYAMLを選択
-            if "1536x1024" in current_size or "横長" in current_size:
-                base_yaml_path = BASE_DIR / "prompts" / "base_landscape.yaml"
-            elif "1024x1536" in current_size or "縦長" in current_size:
-                base_yaml_path = BASE_DIR / "prompts" / "base_portrait.yaml"
-            else:
-                base_yaml_path = BASE_DIR / "prompts" / "base_square.yaml"
-            
-            # ベースYAMLを読み込み
-            try:
-                with open(base_yaml_path, 'r', encoding='utf-8') as f:
-                    base_yaml = f.read()
-            except FileNotFoundError:
-                print(f"ベースYAMLファイルが見つかりません: {base_yaml_path}")
-                # フォールバック：正方形のベースYAMLを使用
-                with open(BASE_DIR / "prompts" / "base_square.yaml", 'r', encoding='utf-8') as f:
-                    base_yaml = f.read()
-            
-            # ベースYAMLの行数を取得
-            base_yaml_lines = base_yaml.split('\n')
-            total_lines = len(base_yaml_lines)
-            
-            # OpenAI APIでYAMLに変換
-            from openai import OpenAI
-            client = OpenAI(api_key=api_key)
-            
-            # 超厳密なシステムプロンプト（自動推論型メタプロンプト対応）
-            system_prompt = f"""あなたは画像生成プロンプト専門のYAML変換エージェントです。以下のベースYAMLテンプレートを使用して、ユーザーのリクエストを完全にYAML化してください。
-
-## ベースYAMLテンプレート（{total_lines}行）:
-```yaml
-{base_yaml}
-```
-
-## 絶対遵守のルール（違反は絶対禁止）:
-
-### 1. 完全構造保持（必須）
-- 上記ベースYAMLの**全{total_lines}行**を完全に出力
-- **全てのコメント行（#で始まる行）**を一字一句そのまま保持
-- **全てのセクション名**を削除・省略せずに保持
-- 全ての技術的な設定値・座標・サイズは元のまま保持
-
-### 2. AUTO_プレースホルダーの自動推論置換（最重要）
-ベースYAMLには`{{AUTO_*}}`形式のプレースホルダーが含まれています。以下のルールで自動的に最適な値に置換してください：
-
-#### 用途別自動設定
-- YouTube関連 → サイズ:横長、色:鮮やかで高コントラスト、文字:極太で視認性高、背景:目立つグラデーション
-- Instagram関連 → サイズ:正方形、色:おしゃれでトレンド感、文字:シンプルで洗練、背景:統一感
-- ビジネス関連 → 色:信頼感（青・緑系）、文字:読みやすく品格、背景:プロフェッショナル
-- イベント・募集 → 色:明るく親しみやすい、文字:キャッチー、背景:賑やか
-
-#### 自動推論ルール
-- `{{AUTO_STYLE}}` → ユーザーの用途から最適なスタイルを推論
-- `{{AUTO_COLORS}}` → 用途・ムードから最適な配色を自動選択（具体的な色名やHEXコード）
-- `{{AUTO_MOOD}}` → コンテキストから適切な雰囲気を推論
-- `{{AUTO_MAIN_TEXT}}` → ユーザー入力を元に魅力的なキャッチコピーを生成
-- `{{AUTO_SUB_TEXT}}` → メインを補完する効果的なサブテキストを自動生成
-- `{{AUTO_BG_TYPE}}` → solid/gradient/pattern等から最適なものを選択
-- `{{AUTO_FONT_*}}` → 用途に応じた最適なフォント設定
-- その他の`{{AUTO_*}}` → コンテキストから論理的に推論
-
-#### 未指定項目の補完
-- ユーザーが明示的に指定していない項目も、文脈から推論して適切に埋める
-- 空欄や曖昧な値は絶対に残さない
-- 全てのプレースホルダーを具体的な値に置換
-
-### 3. 条件付きセクションの処理
-- 用途に応じて必要なセクションのみ有効化
-- 不要なセクションは適切に省略または最小化
-- YouTube → character, icons重視
-- ビジネス → badge, cta_banner重視
-- SNS → visual_identity, social_elements重視
-
-### 4. 品質保証（必須）
-- 全ての`{{AUTO_*}}`を具体的で適切な値に置換
-- プロ品質の画像生成に必要な全詳細を自動生成
-- 色は具体的な色名またはHEXコードで指定
-- フォントサイズは具体的な値（px）または相対値（large等）で指定
-
-### 5. 出力形式（必須）
-- **ベースYAMLと同じ{total_lines}行**で出力（構造は保持）
-- インデント、配列構造、オブジェクト構造を完全保持
-- コードブロック不要、YAMLのみを出力
-
-## 変換例:
-入力: "YouTubeサムネイル、料理チャンネル"
-- style: "YouTubeサムネイル（料理系チャンネル）" 
-- theme_color: "#FF6B6B, #4ECDC4, #FFFFFF"（食欲をそそる配色）
-- main_texts[0].content: "超簡単！10分で作れる絶品パスタ"
-- background.type: "gradient"
-- character.expression: "笑顔で料理を楽しんでいる"
-
-**注意: 全ての{{AUTO_*}}プレースホルダーを適切な具体値に置換し、プロ品質の完全なYAMLを出力してください。**"""
-            
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"以下のリクエストを完全なYAML形式に変換してください（{total_lines}行で出力）: {text_prompt}"}
-                ],
-                temperature=0.1,  # 一貫性重視で大幅に下げる
-                max_tokens=4000   # トークン数を大幅に増加
-            )
-            
-            yaml_result = response.choices[0].message.content
-            
-            # コードブロックから抽出
-            if "```yaml" in yaml_result:
-                yaml_result = yaml_result.split("```yaml")[1].split("```")[0]
-            elif "```" in yaml_result:
-                yaml_result = yaml_result.split("```")[1].split("```")[0]
-            
-            yaml_result = yaml_result.strip()
-            
-            # 品質検証
-            result_lines = yaml_result.split('\n')
-            if len(result_lines) < total_lines * 0.8:  # 80%未満の場合は警告
-                print(f"警告: YAML出力が短すぎます（{len(result_lines)}行/{total_lines}行）")
-                print("フォールバック処理を実行...")
-                
-                # フォールバック：より強制的なプロンプト
-                fallback_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": f"**絶対に{total_lines}行で出力してください**\n\n{system_prompt}"},
-                        {"role": "user", "content": f"**必ず{total_lines}行で出力**: {text_prompt}"},
-                        {"role": "assistant", "content": yaml_result},
-                        {"role": "user", "content": f"行数が不足しています。ベースYAMLの**全{total_lines}行**を完全に出力してください。"}
-                    ],
-                    temperature=0.05,  # 更に一貫性重視
-                    max_tokens=4500
-                )
-                yaml_result = fallback_response.choices[0].message.content
-                
-                # 再度抽出
-                if "```yaml" in yaml_result:
-                    yaml_result = yaml_result.split("```yaml")[1].split("```")[0]
-                elif "```" in yaml_result:
-                    yaml_result = yaml_result.split("```")[1].split("```")[0]
-                yaml_result = yaml_result.strip()
-            
-            # {{AUTO_BADGE}}プレースホルダーの処理
-            if "{{AUTO_BADGE}}" in yaml_result:
-                # バッジが必要なキーワードをチェック
-                badge_keywords = ["新商品", "新発売", "リリース", "キャンペーン", "限定", "NEW", "期間限定", "特価", "セール", "人気", "おすすめ", "注目"]
-                needs_badge = any(keyword in text_prompt for keyword in badge_keywords)
-                
-                if needs_badge:
-                    # バッジセクションを生成
-                    badge_section = """badge:
-  content: "NEW"
-  font_style: "bold"
-  font_color: "#FFFFFF"
-  background_shape: "circle"
-  background_color: "#FF4444"
-  font_size: "small"
-  position: "top-right"
-  padding: "10px" """
-                else:
-                    # バッジなし（空白）
-                    badge_section = ""
-                
-                yaml_result = yaml_result.replace("{{AUTO_BADGE}}", badge_section)
-            
-            return yaml_result
-            
-        except Exception as e:
-            print(f"YAML変換エラー: {e}")
-            # フォールバック: 元のプロンプトを返す
-            return text_prompt
+            trace.set_error(e)
+            yield None, f"❌ 参照画像生成エラー: {str(e)}", "", ""
+        finally:
+            trace.end()
     
     def get_system_prompt_for_step(step):
         """ステップごとのシステムプロンプトを取得"""
@@ -867,23 +757,49 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
 
         return base_prompt
     
-    def get_history_images():
-        """履歴画像取得（軽量化）"""
-        if not app_state['generation_history']:
-            return []
-        
-        recent = app_state['generation_history'][-3:]  # 最新3件のみ（軽量化）
-        images = []
-        
-        for item in reversed(recent):
-            try:
-                image = Image.open(BytesIO(item['image_data']))
-                images.append(image)
-            except Exception as e:
-                print(f"履歴画像読み込みエラー: {e}")
-                continue
-        
-        return images
+    async def get_history_images(request: gr.Request = None):
+        """履歴画像取得（追加時に作成済みのサムネイルファイルを返す）"""
+        app_state = sessions.get(request)
+        trace = start_trace("history_gallery")
+        try:
+            with span("gallery_render") as current:
+                recent = app_state.history.recent(3)  # 最新3件のみ（軽量化）
+                images = []
+                record_ids = []
+                
+                for record in recent:
+                    try:
+                        await asyncio.wrap_future(record.thumbnail_future)
+                        images.append((record.thumbnail_file, record.prompt[:40]))
+                        record_ids.append(record.record_id)
+                    except Exception as e:
+                        print(f"履歴画像読み込みエラー: {e}")
+                        continue
+                current.set(images=len(images))
+            
+            # ギャラリーの表示順 → 履歴レコードの対応（選択時にフル画像を取得するため）
+            app_state['gallery_record_ids'] = record_ids
+            return images
+        finally:
+            trace.end()
+    
+    async def show_history_image(evt: gr.SelectData, request: gr.Request = None):
+        """履歴ギャラリーで選択された画像のフル解像度版を表示"""
+        app_state = sessions.get(request)
+        record_ids = app_state.get('gallery_record_ids', [])
+        record = app_state.history.get(record_ids[evt.index]) if evt.index < len(record_ids) else None
+        if record is None:
+            return gr.update(), "⚠️ 選択した履歴画像は既に破棄されています"
+        await asyncio.wrap_future(record.write_future)
+        return record.temp_file, f"📚 履歴画像を表示中: {record.prompt[:60]}"
+    
+    def get_edit_tree_choices(request: gr.Request = None):
+        """対話型編集の編集段階の選択肢（深さ優先、子は字下げ）"""
+        tree = sessions.get(request).edit_tree
+        current = tree.current
+        choices = [(f"{'　' * depth}{'└ ' if depth else ''}#{node.node_id} {' '.join(node.instruction.split())[:40]}", node.node_id)
+                   for node, depth in tree.outline()]
+        return gr.update(choices=choices, value=current.node_id if current is not None else None)
     
     # アプリレイアウト構築
     with gr.Blocks(title=APP_CONFIG['title'], css=get_app_css(), theme=gr.themes.Base()) as app:
@@ -975,6 +891,20 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
                         info="⚠️ 制限: PNG形式のみ対応 | 参照画像生成では利用不可"
                     )
                     
+                    with gr.Row():
+                        enable_streaming = gr.Checkbox(
+                            label="🌊 部分画像ストリーミング（Responses API使用）",
+                            value=False,
+                            info="生成途中の画像を順次表示（1枚のみ・対話型編集にも対応）"
+                        )
+                        partial_count_slider = gr.Slider(
+                            label="部分画像数",
+                            minimum=1,
+                            maximum=3,
+                            value=APP_CONFIG['default_partial_images'],
+                            step=1
+                        )
+                    
                 
                 # タブ
                 with gr.Tabs():
@@ -1074,6 +1004,7 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
                     - **継続編集**: 現在の画像をベースに追加の変更を指示
                     - **コンテキスト保持**: 前回の生成内容を覚えて改善
                     - **インタラクティブ**: 細かい調整や追加要求が可能
+                    - **戻る・分岐**: 編集段階を選ぶと再生成せずにその画像に戻り、次の指示はその段階から分岐
                     
                     """)
                     
@@ -1087,6 +1018,15 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
                         continue_btn = gr.Button("🔄 対話型編集", variant="primary")
                         reset_context_btn = gr.Button("🗑️ 履歴リセット", variant="secondary")
                     
+                    with gr.Row():
+                        edit_tree_dropdown = gr.Dropdown(
+                            label="編集段階（選択した段階に戻り、そこから分岐）",
+                            choices=[],
+                            interactive=True,
+                            scale=4
+                        )
+                        undo_edit_btn = gr.Button("↩️ 1つ前へ", variant="secondary", scale=1)
+                    
                     interactive_status = gr.Markdown("💬 画像を生成後、対話型編集が利用可能になります")
                 
                 # アクションボタン
@@ -1100,7 +1040,8 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
                         label="最近の生成",
                         columns=1,
                         rows=3,
-                        height="auto"
+                        height="auto",
+                        allow_preview=False  # 選択時はフル画像を生成画像欄に表示
                     )
                     refresh_btn = gr.Button("🔄 更新", size="sm")
         
@@ -1109,11 +1050,14 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
         # プロンプト直接生成
         direct_btn.click(
             generate_from_prompt_fast,
-            inputs=[api_key, prompt, size, quality, format_option, transparent_bg, compression_slider, moderation_dropdown, image_count_slider, enable_responses_api],
+            inputs=[api_key, prompt, size, quality, format_option, transparent_bg, compression_slider, moderation_dropdown, image_count_slider, enable_responses_api, enable_streaming, partial_count_slider],
             outputs=[output_image, status_display, cost_info, prompt_display]
         ).then(
             get_history_images,
             outputs=[history_gallery]
+        ).then(
+            get_edit_tree_choices,
+            outputs=[edit_tree_dropdown]
         )
         
         # 参照画像生成
@@ -1127,9 +1071,9 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
         )
         
         # AIチャット機能
-        def ai_chat_simple(api_key, message, chat_history, current_size):
-            app_state['current_size'] = current_size
-            return ai_chat_response(api_key, message, chat_history)
+        async def ai_chat_simple(api_key, message, chat_history, current_size, request: gr.Request = None):
+            sessions.get(request)['current_size'] = current_size
+            return await ai_chat_response(api_key, message, chat_history, request)
         
         ai_send_btn.click(
             ai_chat_simple,
@@ -1176,27 +1120,38 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
         # 履歴更新
         refresh_btn.click(get_history_images, outputs=[history_gallery])
         
+        # 履歴選択時にフル画像を表示
+        history_gallery.select(show_history_image, outputs=[output_image, status_display])
+        
         # プロンプト再生成
-        def regenerate_with_edited_prompt(api_key, edited_prompt, enable_responses_api):
+        async def regenerate_with_edited_prompt(api_key, edited_prompt, enable_responses_api, enable_streaming, partial_count,
+                                                request: gr.Request = None):
             """編集されたプロンプトで再生成"""
             if not edited_prompt.strip():
-                return None, "❌ プロンプトを入力してください", "", ""
+                yield None, "❌ プロンプトを入力してください", "", ""
+                return
             
             # 現在の設定を使用して再生成（サイズ、品質等は最後の設定を使用）
-            return generate_from_prompt_fast(api_key, edited_prompt, "1024x1024 (正方形)", "auto", "png", False, APP_CONFIG['default_compression'], "auto", 1, enable_responses_api)
+            async for update in generate_from_prompt_fast(api_key, edited_prompt, "1024x1024 (正方形)", "auto", "png", False, APP_CONFIG['default_compression'], "auto", 1, enable_responses_api,
+                                                          enable_streaming, partial_count, request):
+                yield update
         
         regenerate_btn.click(
             regenerate_with_edited_prompt,
-            inputs=[api_key, prompt_display, enable_responses_api],
+            inputs=[api_key, prompt_display, enable_responses_api, enable_streaming, partial_count_slider],
             outputs=[output_image, status_display, cost_info, prompt_display]
         ).then(
             get_history_images,
             outputs=[history_gallery]
+        ).then(
+            get_edit_tree_choices,
+            outputs=[edit_tree_dropdown]
         )
         
         # プロンプトを元に戻す
-        def reset_to_original_prompt():
+        def reset_to_original_prompt(request: gr.Request = None):
             """元のプロンプトに戻す"""
+            app_state = sessions.get(request)
             if app_state.get('original_prompt'):
                 return app_state['original_prompt']
             return "元のプロンプトがありません"
@@ -1208,8 +1163,19 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
         
         
         # 対話型編集機能
-        def interactive_edit(api_key, user_instruction, size, quality, format_opt, transparent, compression, moderation):
-            """対話型編集実行"""
+        async def interactive_edit(api_key, user_instruction, size, quality, format_opt, transparent, compression, moderation,
+                                   enable_streaming=False, partial_count=APP_CONFIG['default_partial_images'], request: gr.Request = None):
+            """対話型編集実行（同一セッションの継続生成は直列化し、会話の分岐を防ぐ）"""
+            app_state = sessions.get(request)
+            async with app_state.lock:
+                async for update in run_interactive_edit(app_state, api_key, user_instruction, size, quality, format_opt,
+                                                         transparent, compression, moderation, enable_streaming, partial_count):
+                    yield update
+        
+        async def run_interactive_edit(app_state, api_key, user_instruction, size, quality, format_opt, transparent, compression, moderation,
+                                       enable_streaming, partial_count):
+            """対話型編集実行（ストリーミング時は部分画像を逐次表示）"""
+            trace = start_trace("interactive_edit", mode=generation_mode(enable_streaming, True), size=size, quality=quality)
             try:
                 # デバッグ情報
                 current_response_id = app_state.get('last_response_id', 'None')
@@ -1224,96 +1190,161 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
 3. 生成後に対話型編集が利用可能になります
 
 {debug_info}"""
-                    return None, error_msg, ""
+                    yield None, error_msg, ""
+                    return
                 
                 if not user_instruction.strip():
-                    return None, "💬 変更したい内容を入力してください", ""
+                    yield None, "💬 変更したい内容を入力してください", ""
+                    return
                 
                 valid, error_msg = validate_api_key(api_key)
                 if not valid:
-                    return None, f"❌ {error_msg}", ""
+                    yield None, f"❌ {error_msg}", ""
+                    return
+                
+                # 分岐元のノード（選択中の段階から継続生成するため、途中の段階を再生成しない）
+                parent = app_state.edit_tree.current
+                parent_id = parent.node_id if parent is not None and parent.response_id == current_response_id else None
                 
                 # Responses APIで継続生成を実行
-                responses_api = ResponsesAPI(api_key)
+                responses_api = AsyncResponsesAPI(api_key)
                 
                 # 継続生成を実行
                 print(f"[DEBUG] 継続生成実行: previous_response_id={current_response_id[:8]}...")
                 
-                result = responses_api.continue_generation(
-                    previous_response_id=current_response_id,
-                    prompt=user_instruction,
-                    size=SIZE_MAP.get(size, size),
-                    quality=quality,
-                    format=format_opt,
-                    background="transparent" if transparent else "auto",
-                    output_compression=compression if format_opt in ["jpeg", "webp"] else None,
-                    moderation=moderation
-                )
-                
-                # 画像を処理
-                image = Image.open(BytesIO(result['image_data']))
-                
-                # 履歴に追加
-                temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f".{format_opt}")
-                image.save(temp_file.name, format=format_opt.upper() if format_opt != 'jpeg' else 'JPEG')
-                
-                history_item = {
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M"),
-                    'image_data': result['image_data'],
-                    'prompt': f"対話編集: {user_instruction}",
-                    'purpose': "対話型編集",
-                    'style': "継続生成",
-                    'temp_file': temp_file.name
-                }
-                app_state['generation_history'].append(history_item)
+                # 対話型編集は通常・一括生成より優先して実行枠を割り当てる
+                async with jobs.admission(api_key_id(api_key), PRIORITY_INTERACTIVE) as ticket:
+                    with span("queue_wait"):
+                        async for position, eta in ticket.updates():
+                            yield gr.update(), format_queue_status(position, eta), gr.update()
+                    
+                    if enable_streaming:
+                        result = None
+                        async for kind, image, event in stream_generation_events(
+                                api_key, user_instruction, SIZE_MAP.get(size, size), quality, format_opt, transparent,
+                                compression, moderation, partial_count, previous_response_id=current_response_id):
+                            if kind == "partial":
+                                yield image, format_stream_status(event, partial_count), gr.update()
+                            elif kind == "final":
+                                result = event
+                                result['previous_response_id'] = current_response_id
+                            else:
+                                raise Exception(event.get('error', '不明なエラー'))
+                        if result is None:
+                            raise Exception("画像が返されませんでした")
+                    else:
+                        result = await responses_api.continue_generation(
+                            previous_response_id=current_response_id,
+                            prompt=user_instruction,
+                            size=SIZE_MAP.get(size, size),
+                            quality=quality,
+                            format=format_opt,
+                            background="transparent" if transparent else "auto",
+                            output_compression=compression if format_opt in ["jpeg", "webp"] else None,
+                            moderation=moderation
+                        )
                 
-                # 最新3件に制限
-                if len(app_state['generation_history']) > 3:
-                    app_state['generation_history'] = app_state['generation_history'][-3:]
+                # 画像を処理して履歴に追加
+                image = await save_images_to_history(
+                    app_state, [result['image_data']], f"対話編集: {user_instruction}", "対話型編集", "継続生成", format_opt
+                )
                 
                 # 状態更新（重要：新しいresponse_idに更新）
-                app_state['current_image'] = {'image_data': result['image_data'], 'prompt': user_instruction}
                 new_response_id = result['response_id']
                 app_state['last_response_id'] = new_response_id
+                record = app_state['current_image']
+                node = app_state.edit_tree.add(parent_id, new_response_id, record.image_data, user_instruction, format_opt,
+                                               record_id=record.record_id)
                 print(f"[DEBUG] 対話型編集完了: 新response_id={new_response_id[:8]}...")
                 
                 # コスト情報
                 cost_info = f"""**対話型編集完了**
 ⏱️ 生成時間: {result['generation_time']}秒
 🔄 前回ID: {result['previous_response_id'][:8]}...
-🆕 新規ID: {result['response_id'][:8]}..."""
+🆕 新規ID: {result['response_id'][:8]}...
+🌳 編集段階: #{node.node_id}（{len(app_state.edit_tree.path())}段目）"""
+                if enable_streaming:
+                    cost_info += format_ttfp_info(result)
                 
-                return image, "💬 対話型編集が完了しました！", cost_info
+                yield image, "💬 対話型編集が完了しました！", cost_info
                 
             except Exception as e:
+                trace.set_error(e)
                 error_detail = f"""❌ **対話型編集エラー**
 
 **エラー詳細**: {str(e)}
 **last_response_id**: {app_state.get('last_response_id', 'None')}
 
 **解決方法**: 「💬 対話型有効」をチェックして画像を生成してから再試行してください"""
-                return None, error_detail, ""
+                yield None, error_detail, ""
+            finally:
+                trace.end()
         
         # 対話型編集イベント
         continue_btn.click(
             interactive_edit,
-            inputs=[api_key, interactive_prompt, size, quality, format_option, transparent_bg, compression_slider, moderation_dropdown],
+            inputs=[api_key, interactive_prompt, size, quality, format_option, transparent_bg, compression_slider, moderation_dropdown, enable_streaming, partial_count_slider],
             outputs=[output_image, interactive_status, cost_info]
         ).then(
             get_history_images,
             outputs=[history_gallery]
+        ).then(
+            get_edit_tree_choices,
+            outputs=[edit_tree_dropdown]
         )
         
         # 対話履歴リセット
-        def reset_interactive_context():
+        def reset_interactive_context(request: gr.Request = None):
             """対話コンテキストをリセット"""
+            app_state = sessions.get(request)
             app_state['last_response_id'] = None
             app_state['generation_context'] = []
-            return "💬 対話履歴をリセットしました。新しい画像を生成してください。"
+            app_state.edit_tree.clear()
+            return "💬 対話履歴をリセットしました。新しい画像を生成してください。", gr.update(choices=[], value=None)
         
         reset_context_btn.click(
             reset_interactive_context,
-            outputs=[interactive_status]
+            outputs=[interactive_status, edit_tree_dropdown]
+        )
+        
+        # 編集ツリー（段階の選択・1つ前へ）
+        async def show_edit_node(app_state, node):
+            """ノードを選択中にして画像を表示（response_idも切り替え、次の編集はここから分岐）"""
+            app_state['last_response_id'] = node.response_id
+            image = await edit_node_image(app_state, node)
+            depth = len(app_state.edit_tree.path(node.node_id))
+            return image, f"🌳 編集段階 #{node.node_id}（{depth}段目）に戻りました。次の指示はこの段階から分岐します"
+        
+        async def checkout_edit_node(node_id, request: gr.Request = None):
+            """選択した編集段階に戻る（実行中の対話型編集の完了を待ってから切り替える）"""
+            app_state = sessions.get(request)
+            async with app_state.lock:
+                node = app_state.edit_tree.checkout(node_id) if node_id is not None else None
+                if node is None:
+                    return gr.update(), "⚠️ 選択した編集段階は既に破棄されています"
+                return await show_edit_node(app_state, node)
+        
+        async def undo_edit(request: gr.Request = None):
+            """1つ前の編集段階に戻る（実行中の対話型編集の完了を待ってから戻る）"""
+            app_state = sessions.get(request)
+            async with app_state.lock:
+                node = app_state.edit_tree.undo()
+                if node is None:
+                    return gr.update(), "💬 これ以上戻れる編集段階がありません"
+                return await show_edit_node(app_state, node)
+        
+        edit_tree_dropdown.input(
+            checkout_edit_node,
+            inputs=[edit_tree_dropdown],
+            outputs=[output_image, interactive_status]
+        )
+        
+        undo_edit_btn.click(
+            undo_edit,
+            outputs=[output_image, interactive_status]
+        ).then(
+            get_edit_tree_choices,
+            outputs=[edit_tree_dropdown]
         )
         
         # フォーマット変更時の制御
@@ -1348,6 +1379,18 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
             outputs=[enable_responses_api]
         )
         
+        def enforce_png_for_streaming(format_value):
+            """PNG以外を選んだら部分画像ストリーミングを自動OFF（Responses APIと同じ制限）"""
+            if format_value != "png":
+                return gr.update(value=False, interactive=False)
+            return gr.update(interactive=True)
+        
+        format_option.change(
+            enforce_png_for_streaming,
+            inputs=[format_option],
+            outputs=[enable_streaming]
+        )
+        
         # タブ選択による対話型有効の制御
         def disable_responses_for_ref_tab():
             """参照画像タブ選択時は対話型有効を自動OFF"""
@@ -1381,15 +1424,38 @@ YAML_GENERATE: YouTubeサムネイル、エンタメ系チャンネル、「爆
             enable_responses_for_other_tabs,
             outputs=[enable_responses_api]
         )
+        
+        # ブラウザ切断時にセッション状態と履歴ファイルを解放
+        def release_session(request: gr.Request):
+            sessions.drop(request)
+        
+        app.unload(release_session)
     
+    # 状態はセッション単位で分離しているため、イベントの同時実行数を引き上げる
+    app.queue(default_concurrency_limit=APP_CONFIG['concurrency_limit'])
     return app
 
 # HuggingFace Spaces用のメイン実行部
 if __name__ == "__main__":
-    app = create_optimized_app()
-    # Hugging Face Spaces用の設定
-    app.launch(
-        server_name="0.0.0.0",
-        server_port=int(os.getenv("PORT", 7860)),
-        share=False  # Hugging Face Spacesでは不要
-    )
\ No newline at end of file
+    port = int(os.getenv("PORT", 7860))
+    if API_SETTINGS["enabled"] and APP_CONFIG['fast_startup']:
+        # 高速起動: APIでポートを先に開き、UIは裏で構築してからマウント
+        import uvicorn
+        from src.api.fast_startup import create_fast_startup_app
+        uvicorn.run(create_fast_startup_app(create_optimized_app), host="0.0.0.0", port=port)
+    elif API_SETTINGS["enabled"]:
+        # REST/ストリーミングAPIと同じサーバーにGradio UIをマウント
+        import gradio as gr
+        import uvicorn
+        from src.api.routes import create_api_app
+        app = create_optimized_app()
+        server = gr.mount_gradio_app(create_api_app(), app, path="/")
+        uvicorn.run(server, host="0.0.0.0", port=port)
+    else:
+        app = create_optimized_app()
+        # Hugging Face Spaces用の設定
+        app.launch(
+            server_name="0.0.0.0",
+            server_port=port,
+            share=False  # Hugging Face Spacesでは不要
+        )
@@ -0,0 +1,344 @@
+"""ベンチマーク用のOpenAI互換ローカルサーバー（ネットワーク接続・課金なし）
+
+パイプライン自体のオーバーヘッドを計測するため、以下のエンドポイントを固定の応答で模擬する。
+
+- POST /v1/images/generations, /v1/images/edits: 指定サイズ・枚数のbase64画像
+- POST /v1/responses: 画像生成ツールの結果（stream=true の場合は部分画像→完了のSSE）
+- POST /v1/chat/completions: 指定行数のYAML（YAML変換がフォールバックしない行数）、
+  JSONモード（スロット埋め込み）の場合はシステムプロンプトのスロット一覧の全キーの値
+- POST /v1/files: アップロード済みファイルの情報（DELETE /v1/files/{id} は削除結果）
+
+応答の遅延（固定 + ジッター）、画像サイズ、画像の種類（ノイズ/単色）、部分画像数は設定で変更できる。
+レート制限ヘッダーも返すため、再試行スケジューラは十分な送信速度を学習する。
+
+単体起動:
+    python benchmarks/fake_openai.py --port 18080 --latency 0.2
+    OPENAI_BASE_URL=http://127.0.0.1:18080/v1 python app.py
+"""
+
+import argparse
+import base64
+import functools
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+
+@dataclass
+class FakeOpenAIConfig:
+    """模擬サーバーの応答設定"""
+    latency: float = 0.05          # 応答までの固定遅延（秒）
+    jitter: float = 0.0            # 遅延に加える一様乱数の上限（秒）
+    image_size: int = 0            # 返す画像の長辺px（0ならリクエストのsizeに従う）
+    image_kind: str = "noise"      # noise（実際に近いファイルサイズ） / solid（最小サイズ）
+    partial_images: int = 2        # ストリーミング時の部分画像数（リクエストの指定が優先）
+    chat_lines: int = 160          # チャット補完で返すYAMLの行数
+    rate_limit_rpm: int = 100000   # x-ratelimit-limit-requests として返す値
+
+
+@functools.lru_cache(maxsize=16)
+def canned_image_b64(width: int, height: int, kind: str = "noise") -> str:
+    """固定の画像をPNGで作成してbase64で返す（サイズ・種類ごとにキャッシュ）"""
+    if kind == "solid":
+        image = Image.new("RGB", (width, height), (200, 40, 40))
+    else:
+        # 乱数画像はPNGでほぼ圧縮されず、実際の生成画像と同程度以上のサイズになる
+        image = Image.frombytes("RGB", (width, height), random.Random(width * height).randbytes(width * height * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def _parse_size(size: Optional[str]) -> Tuple[int, int]:
+    try:
+        width, height = (int(v) for v in str(size).split("x"))
+        return width, height
+    except (TypeError, ValueError):
+        return 1024, 1024
+
+
+class FakeOpenAIServer:
+    """バックグラウンドスレッドで動く模擬サーバー（with文で起動・停止）"""
+
+    def __init__(self, config: Optional[FakeOpenAIConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or FakeOpenAIConfig()
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """現在のスレッドで待ち受け（単体起動用）"""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def image_b64(self, size: Optional[str]) -> str:
+        if self.config.image_size:
+            width = height = self.config.image_size
+        else:
+            width, height = _parse_size(size)
+        return canned_image_b64(width, height, self.config.image_kind)
+
+    def delay(self) -> float:
+        return self.config.latency + (random.uniform(0, self.config.jitter) if self.config.jitter else 0.0)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, payload: Dict, status: int = 200):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                self._rate_limit_headers()
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _rate_limit_headers(self):
+                rpm = server.config.rate_limit_rpm
+                self.send_header("x-ratelimit-limit-requests", str(rpm))
+                self.send_header("x-ratelimit-remaining-requests", str(rpm - 1))
+                self.send_header("x-ratelimit-reset-requests", "1s")
+
+            def _json_body(self, body: bytes) -> Dict:
+                try:
+                    return json.loads(body or b"{}")
+                except ValueError:
+                    return {}  # multipart（images.edit・files）は内容を使わない
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                path = self.path.split("?")[0].rstrip("/")
+                endpoint = path.rsplit("/v1/", 1)[-1]
+                server.count(endpoint)
+                request = self._json_body(body)
+
+                if endpoint == "responses" and request.get("stream"):
+                    self._stream_response(request)
+                    return
+
+                time.sleep(server.delay())
+                if endpoint in ("images/generations", "images/edits"):
+                    image = server.image_b64(request.get("size"))
+                    n = int(request.get("n", 1) or 1)
+                    self._send_json({"created": int(time.time()),
+                                     "data": [{"b64_json": image, "revised_prompt": request.get("prompt")}
+                                              for _ in range(n)]})
+                elif endpoint == "responses":
+                    self._send_json(self._response_object(request))
+                elif endpoint == "chat/completions":
+                    self._send_json(self._chat_completion(request))
+                elif endpoint == "files":
+                    self._send_json({"id": f"file-{os.urandom(8).hex()}", "object": "file", "bytes": len(body),
+                                     "created_at": int(time.time()), "filename": "upload.png",
+                                     "purpose": "vision", "status": "processed"})
+                else:
+                    self._send_json({"error": {"message": f"未対応のエンドポイント: {path}"}}, status=404)
+
+            def do_DELETE(self):
+                path = self.path.split("?")[0].rstrip("/")
+                endpoint = path.rsplit("/v1/", 1)[-1]
+                server.count("files:delete" if endpoint.startswith("files/") else endpoint)
+                if endpoint.startswith("files/"):
+                    self._send_json({"id": endpoint.split("/", 1)[1], "object": "file", "deleted": True})
+                else:
+                    self._send_json({"error": {"message": f"未対応のエンドポイント: {path}"}}, status=404)
+
+            def _response_object(self, request: Dict) -> Dict:
+                tool = (request.get("tools") or [{}])[0]
+                return {
+                    "id": f"resp_{os.urandom(8).hex()}",
+                    "object": "response",
+                    "created_at": int(time.time()),
+                    "model": request.get("model", "gpt-4o-mini"),
+                    "output": [{"type": "image_generation_call", "id": f"ig_{os.urandom(4).hex()}",
+                                "status": "completed", "result": server.image_b64(tool.get("size")),
+                                "revised_prompt": request.get("input") if isinstance(request.get("input"), str) else None}],
+                    "parallel_tool_calls": True,
+                    "tool_choice": "auto",
+                    "tools": []
+                }
+
+            def _stream_response(self, request: Dict):
+                """部分画像→完了イベントをSSEで送信（遅延は各イベントに分散）"""
+                tool = (request.get("tools") or [{}])[0]
+                partial_count = int(tool.get("partial_images", server.config.partial_images) or 0)
+                step = server.delay() / (partial_count + 1)
+                image = server.image_b64(tool.get("size"))
+
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("transfer-encoding", "chunked")
+                self._rate_limit_headers()
+                self.end_headers()
+
+                events = [{"type": "response.image_generation_call.partial_image", "partial_image_index": i,
+                           "partial_image_b64": image, "output_index": 0, "item_id": "ig_stream",
+                           "sequence_number": i} for i in range(partial_count)]
+                events.append({"type": "response.completed", "sequence_number": partial_count,
+                               "response": self._response_object(request)})
+                for event in events:
+                    time.sleep(step)
+                    data = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chat_completion(self, request: Dict) -> Dict:
+                if (request.get("response_format") or {}).get("type") == "json_object":
+                    # スロット埋め込み: システムプロンプトのスロット一覧（"- KEY (位置)"）の全キーに値を返す
+                    system = next((m.get("content", "") for m in request.get("messages", [])
+                                   if m.get("role") == "system"), "")
+                    keys = re.findall(r"^- ([A-Z0-9_]+) \(", system, re.MULTILINE)
+                    content = json.dumps({key: f"value {i}" for i, key in enumerate(keys)}, ensure_ascii=False)
+                    completion_tokens = len(keys) * 6
+                else:
+                    lines = "\n".join(f"line_{i}: \"value {i}\"" for i in range(server.config.chat_lines))
+                    content = f"```yaml\n{lines}\n```"
+                    completion_tokens = server.config.chat_lines * 8
+                return {
+                    "id": f"chatcmpl-{os.urandom(6).hex()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "gpt-4o"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": completion_tokens,
+                              "total_tokens": 100 + completion_tokens}
+                }
+
+        return Handler
+
+
+class FakeOpenAIProcess:
+    """模擬サーバーを別プロセスで起動（with文で起動・停止）
+
+    同じプロセスで動かすと、応答のJSON生成がGILを取り合って計測対象の処理時間に混ざるため、
+    ベンチマークではこちらを使う。
+    """
+
+    def __init__(self, config: Optional[FakeOpenAIConfig] = None, host: str = "127.0.0.1",
+                 port: int = 0, startup_timeout: float = 30.0):
+        self.config = config or FakeOpenAIConfig()
+        self.host = host
+        self.port = port or _free_port(host)
+        self.startup_timeout = startup_timeout
+        self._process: Optional[subprocess.Popen] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def start(self) -> "FakeOpenAIProcess":
+        c = self.config
+        self._process = subprocess.Popen(
+            [sys.executable, __file__, "--host", self.host, "--port", str(self.port),
+             "--latency", str(c.latency), "--jitter", str(c.jitter), "--image-size", str(c.image_size),
+             "--image-kind", c.image_kind, "--partial-images", str(c.partial_images)],
+            stdout=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"模擬サーバーが終了しました（終了コード {self._process.returncode}）")
+            try:
+                socket.create_connection((self.host, self.port), timeout=0.2).close()
+                return self
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise TimeoutError(f"模擬サーバーが{self.startup_timeout}秒以内に起動しませんでした")
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+    def __enter__(self) -> "FakeOpenAIProcess":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ベンチマーク用のOpenAI互換ローカルサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=FakeOpenAIConfig.latency, help="応答遅延（秒）")
+    parser.add_argument("--jitter", type=float, default=FakeOpenAIConfig.jitter, help="遅延のジッター上限（秒）")
+    parser.add_argument("--image-size", type=int, default=FakeOpenAIConfig.image_size,
+                        help="画像の長辺px（0ならリクエストのsize）")
+    parser.add_argument("--image-kind", choices=["noise", "solid"], default=FakeOpenAIConfig.image_kind)
+    parser.add_argument("--partial-images", type=int, default=FakeOpenAIConfig.partial_images)
+    args = parser.parse_args(argv)
+
+    config = FakeOpenAIConfig(latency=args.latency, jitter=args.jitter, image_size=args.image_size,
+                              image_kind=args.image_kind, partial_images=args.partial_images)
+    if config.image_size:
+        canned_image_b64(config.image_size, config.image_size, config.image_kind)  # 初回応答の遅延を避ける
+    else:
+        for size in ("1024x1024", "1536x1024", "1024x1536"):
+            canned_image_b64(*_parse_size(size), config.image_kind)
+    server = FakeOpenAIServer(config, host=args.host, port=args.port)
+    print(f"模擬OpenAIサーバーを起動しました: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
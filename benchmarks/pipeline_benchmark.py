@@ -0,0 +1,293 @@
+"""生成パイプラインのオフラインベンチマーク（模擬OpenAIサーバー使用）
+
+ネットワーク接続・課金なしで、サービス層とapp.pyのハンドラのオーバーヘッドを計測する。
+模擬サーバーの応答遅延は固定のため、遅延の増加はパイプライン側（デコード・形式変換・
+キューイング・履歴保存など）の変化を表す。
+
+シナリオごとにp50/p95/p99・スループットを出力し、--check を指定すると保存済みの
+基準値（baselines.json）と比較して、許容幅を超えて悪化した場合は終了コード1を返す。
+基準値は計測したマシンに依存するため、同じ環境（CIなど）で --update-baseline により更新する。
+
+使い方:
+    python benchmarks/pipeline_benchmark.py                      # 計測のみ
+    python benchmarks/pipeline_benchmark.py --check              # 基準値と比較
+    python benchmarks/pipeline_benchmark.py --update-baseline    # 基準値を更新
+    python benchmarks/pipeline_benchmark.py --scenario responses_stream --requests 100
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+from fake_openai import FakeOpenAIConfig, FakeOpenAIProcess
+
+BASELINE_PATH = BENCH_DIR / "baselines.json"
+LATENCY_KEYS = ("p50", "p95", "p99")
+
+
+class _Request:
+    """ハンドラに渡すgr.Request相当（セッションハッシュのみ）"""
+
+    def __init__(self, session_hash: str):
+        self.session_hash = session_hash
+
+
+def _api_key(index: int) -> str:
+    """仮想ユーザーごとのAPIキー（キー単位の同時実行数制限・合流の影響を実運用に合わせる）"""
+    return f"sk-bench-{index:04d}-" + "x" * 32
+
+
+class Scenario:
+    """ベンチマークシナリオ（1リクエスト分の処理。同期ならスレッドプール、非同期ならタスクで並列実行）"""
+
+    def __init__(self, name: str, description: str, run: Callable, is_async: bool = True, uses_app: bool = False):
+        self.name = name
+        self.description = description
+        self.run = run
+        self.is_async = is_async
+        self.uses_app = uses_app
+
+
+def _image_generator(index: int, user: int):
+    from src.services.image_generator import ImageGenerator
+    result = ImageGenerator(_api_key(user)).generate_image(prompt=f"bench image_generator {index}")
+    assert result.get("image_data")
+
+
+async def _async_image_split(index: int, user: int):
+    from src.services.image_generator import AsyncImageGenerator
+    result = await AsyncImageGenerator(_api_key(user)).generate_image_split(
+        prompt=f"bench async_image_split {index}", n=2, format="webp", output_compression=80)
+    assert result.get("image_count") == 2, result
+
+
+def _responses_api(index: int, user: int):
+    from src.services.responses_api import ResponsesAPI
+    result = ResponsesAPI(_api_key(user)).generate_with_responses(prompt=f"bench responses_api {index}")
+    assert result.get("image_data")
+
+
+async def _async_responses_api(index: int, user: int):
+    from src.services.responses_api import AsyncResponsesAPI
+    result = await AsyncResponsesAPI(_api_key(user)).generate_with_responses(prompt=f"bench async_responses {index}")
+    assert result.get("image_data")
+
+
+async def _responses_stream(index: int, user: int):
+    from src.services.responses_api import AsyncResponsesAPI
+    events = await AsyncResponsesAPI(_api_key(user)).generate_with_responses(
+        prompt=f"bench responses_stream {index}", stream=True, partial_images=2)
+    kinds = [event["type"] async for event in events]
+    assert kinds and kinds[-1] == "final", kinds
+
+
+_handlers: Dict[str, Callable] = {}
+
+
+def _app_handlers() -> Dict[str, Callable]:
+    """app.pyのUIを一度だけ構築し、ハンドラ関数を取得"""
+    if not _handlers:
+        import app as app_module
+        blocks = app_module.create_optimized_app()
+        _handlers.update({fn.name: fn.fn for fn in blocks.fns.values()})
+    return _handlers
+
+
+async def _consume(generator) -> tuple:
+    last = None
+    async for last in generator:
+        pass
+    assert last is not None and str(last[1]).startswith("✅"), last
+    return last
+
+
+async def _app_prompt_yaml(index: int, user: int):
+    # YAML変換（チャット補完）→ Image API → 履歴保存
+    await _consume(_app_handlers()["generate_from_prompt_fast"](
+        _api_key(user), f"bench app_prompt_yaml {index} 新商品の告知バナー", "1024x1024 (正方形)", "auto", "png",
+        False, 80, "auto", 1, False, False, 2, _Request(f"bench-{user}")))
+
+
+async def _app_stream(index: int, user: int):
+    # 部分画像ストリーミング（部分画像のPILデコード）→ 履歴保存
+    await _consume(_app_handlers()["generate_from_prompt_fast"](
+        _api_key(user), f"style: bench app_stream {index}", "1024x1024 (正方形)", "auto", "png",
+        False, 80, "auto", 1, True, True, 2, _Request(f"bench-{user}")))
+
+
+SCENARIOS: Dict[str, Scenario] = {s.name: s for s in [
+    Scenario("image_generator", "ImageGenerator.generate_image（同期・1枚）", _image_generator, is_async=False),
+    Scenario("async_image_split", "AsyncImageGenerator.generate_image_split（n=2・WebP変換）", _async_image_split),
+    Scenario("responses_api", "ResponsesAPI.generate_with_responses（同期）", _responses_api, is_async=False),
+    Scenario("async_responses_api", "AsyncResponsesAPI.generate_with_responses", _async_responses_api),
+    Scenario("responses_stream", "AsyncResponsesAPI ストリーミング（部分画像2枚）", _responses_stream),
+    Scenario("app_prompt_yaml", "app: generate_from_prompt_fast（YAML変換 + Image API）", _app_prompt_yaml, uses_app=True),
+    Scenario("app_stream", "app: generate_from_prompt_fast（ストリーミング）", _app_stream, uses_app=True),
+]}
+
+
+async def run_scenario(scenario: Scenario, requests: int, concurrency: int) -> Dict:
+    """シナリオをrequests回（同時実行数concurrency）実行し、レイテンシとスループットを集計
+
+    非同期クライアントやロックはイベントループに紐づくため、全シナリオを同じループで実行する。
+    """
+    from src.utils.metrics import LatencyRecorder
+
+    recorder = LatencyRecorder(max_samples=requests)
+    errors: List[str] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def one(index: int, pool: ThreadPoolExecutor):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if scenario.is_async:
+                    await scenario.run(index, index % concurrency)
+                else:
+                    await loop.run_in_executor(pool, scenario.run, index, index % concurrency)
+                recorder.record(scenario.name, time.perf_counter() - started)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i, pool) for i in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    summary = recorder.summary(scenario.name).get(scenario.name, {})
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "mean": summary.get("mean", 0.0),
+        **{key: summary.get(key, 0.0) for key in LATENCY_KEYS},
+        "throughput": round((requests - len(errors)) / elapsed, 2) if elapsed else 0.0
+    }
+
+
+async def run_scenarios(names: List[str], requests: int, concurrency: int) -> Dict[str, Dict]:
+    results = {}
+    for name in names:
+        print(f"実行中: {name} - {SCENARIOS[name].description}", file=sys.stderr)
+        results[name] = await run_scenario(SCENARIOS[name], requests, concurrency)
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict, tolerance: float, slack: float) -> List[str]:
+    """基準値と比較し、悪化した項目の説明を返す（空なら合格）
+
+    レイテンシは「基準値 × (1 + tolerance) + slack秒」を超えたら、スループットは
+    「基準値 × (1 - tolerance)」を下回ったら悪化とみなす。エラーが出たシナリオは常に不合格。
+    """
+    failures = []
+    for name, result in results.items():
+        if result["errors"]:
+            failures.append(f"{name}: エラー {result['errors']}件（{result['first_error']}）")
+        expected = baseline.get("scenarios", {}).get(name)
+        if expected is None:
+            continue
+        for key in LATENCY_KEYS:
+            limit = expected[key] * (1 + tolerance) + slack
+            if result[key] > limit:
+                failures.append(f"{name}: {key} {result[key]:.3f}秒 > 許容 {limit:.3f}秒（基準 {expected[key]:.3f}秒）")
+        floor = expected["throughput"] * (1 - tolerance)
+        if result["throughput"] < floor:
+            failures.append(f"{name}: スループット {result['throughput']:.2f}/秒 < 許容 {floor:.2f}/秒"
+                            f"（基準 {expected['throughput']:.2f}/秒）")
+    return failures
+
+
+def format_report(results: Dict[str, Dict], settings: Dict) -> str:
+    lines = [f"模擬サーバー遅延 {settings['latency']}秒, 画像 {settings['image_kind']}, "
+             f"{settings['requests']}リクエスト × 同時実行 {settings['concurrency']}",
+             f"  {'シナリオ':<22}{'p50':>8}{'p95':>8}{'p99':>8}{'件/秒':>9}{'エラー':>6}"]
+    for name, r in results.items():
+        lines.append(f"  {name:<24}{r['p50']:>8.3f}{r['p95']:>8.3f}{r['p99']:>8.3f}{r['throughput']:>9.2f}{r['errors']:>6}")
+    return "\n".join(lines)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="生成パイプラインのオフラインベンチマーク")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="実行するシナリオ（複数指定可）")
+    parser.add_argument("--skip-app", action="store_true", help="app.pyのハンドラを使うシナリオを省略（UI構築を省く）")
+    parser.add_argument("--requests", type=int, default=40, help="シナリオごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時実行数（仮想ユーザー数）")
+    parser.add_argument("--latency", type=float, default=0.05, help="模擬サーバーの応答遅延（秒）")
+    parser.add_argument("--image-kind", choices=["noise", "solid"], default="noise", help="模擬サーバーが返す画像")
+    parser.add_argument("--check", action="store_true", help="基準値と比較し、悪化していれば終了コード1")
+    parser.add_argument("--update-baseline", action="store_true", help="計測結果で基準値を更新")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH, help="基準値ファイル")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="悪化とみなす割合（0.25 = 25%%）")
+    parser.add_argument("--slack", type=float, default=0.02, help="レイテンシ比較に加える絶対秒数（計測ノイズ対策）")
+    parser.add_argument("--json", type=Path, help="結果をJSONで保存するパス")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    names = args.scenario or [name for name, s in SCENARIOS.items() if not (args.skip_app and s.uses_app)]
+    settings = {"latency": args.latency, "image_kind": args.image_kind,
+                "requests": args.requests, "concurrency": args.concurrency}
+
+    config = FakeOpenAIConfig(latency=args.latency, image_kind=args.image_kind)
+    with FakeOpenAIProcess(config) as server:
+        # 共有クライアントは初回作成時に環境変数の接続先を読む。結果キャッシュは計測を歪めるため無効化し、
+        # 履歴の一時ファイルは専用ディレクトリに書いて終了時に削除する（設定はsrc読み込み時に確定）
+        history_dir = tempfile.mkdtemp(prefix="bench_history_")
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["HISTORY_TEMP_DIR"] = history_dir
+        os.environ.pop("IMAGE_RESULT_CACHE_DIR", None)
+        try:
+            results = asyncio.run(run_scenarios(names, args.requests, args.concurrency))
+        finally:
+            shutil.rmtree(history_dir, ignore_errors=True)
+
+    print(format_report(results, settings))
+    if args.json:
+        args.json.write_text(json.dumps({"settings": settings, "scenarios": results}, ensure_ascii=False, indent=2),
+                             encoding="utf-8")
+
+    if args.update_baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8")) if args.baseline.exists() else {}
+        if baseline.get("settings", settings) != settings:
+            baseline = {}  # 条件が変わった場合は作り直す
+        baseline["settings"] = settings
+        baseline.setdefault("scenarios", {}).update(
+            {name: {key: r[key] for key in (*LATENCY_KEYS, "throughput")} for name, r in results.items()})
+        args.baseline.write_text(json.dumps(baseline, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"基準値を更新しました: {args.baseline}")
+
+    if args.check:
+        if not args.baseline.exists():
+            print(f"基準値ファイルがありません: {args.baseline}")
+            return 1
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if baseline.get("settings") != settings:
+            print(f"計測条件が基準値と異なります（基準: {baseline.get('settings')}）")
+            return 1
+        failures = compare(results, baseline, args.tolerance, args.slack)
+        if failures:
+            print("性能の悪化を検出しました:")
+            for failure in failures:
+                print(f"  - {failure}")
+            return 1
+        print("基準値との比較: 問題なし")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
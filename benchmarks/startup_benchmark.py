@@ -0,0 +1,169 @@
+"""起動時間のベンチマーク（インポート時間・UI構築・初回リクエストまで）
+
+毎回新しいPythonプロセスで計測するため、Spacesのスリープ復帰（コールドスタート）に近い値になる。
+
+計測項目:
+- import_app: ``import app`` の所要時間
+- build_ui: ``create_optimized_app()`` の所要時間（gradioの読み込みを含む）
+- server: ``python app.py`` を起動し、APIが最初に応答するまで / UIが表示できるまでの時間
+  （通常起動と高速起動モード FAST_STARTUP=1 の両方）
+- importtime: ``-X importtime`` によるトップレベルパッケージ別の読み込み時間の内訳
+
+使い方:
+    python benchmarks/startup_benchmark.py --runs 5 --json startup.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+BUILD_SNIPPET = ("import time; import app; t = time.perf_counter(); app.create_optimized_app(); "
+                 "print(time.perf_counter() - t)")
+
+
+def _env(extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(extra or {})
+    return env
+
+
+def _run_python(snippet: str, extra_env: Optional[Dict[str, str]] = None) -> float:
+    """新しいプロセスでスニペットを実行し、最終行に出力された秒数を返す"""
+    output = subprocess.run([sys.executable, "-c", snippet], cwd=ROOT_DIR, env=_env(extra_env),
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url: str) -> Optional[int]:
+    """ステータスコードを返す（接続できなければNone）"""
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+
+def measure_server(fast_startup: bool, timeout: float = 120.0) -> Dict[str, float]:
+    """app.pyを起動し、API応答・UI表示・初回UIリクエストまでの秒数を計測"""
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    env = _env({"PORT": str(port), "FAST_STARTUP": "1" if fast_startup else "0", "ENABLE_REST_API": "1"})
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result: Dict[str, float] = {}
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"app.py が終了しました（終了コード {process.returncode}）")
+            if "api_ready" not in result and _get(f"{base}/api/v1/openapi.json") == 200:
+                result["api_ready"] = time.perf_counter() - start
+            if "api_ready" in result and _get(f"{base}/") == 200:
+                result["ui_ready"] = time.perf_counter() - start
+                break
+            time.sleep(0.05)
+        else:
+            raise TimeoutError(f"{timeout}秒以内に起動しませんでした")
+
+        # UI表示後の最初のリクエスト（Gradioの設定取得）
+        request_start = time.perf_counter()
+        _get(f"{base}/config")
+        result["first_ui_request"] = time.perf_counter() - request_start
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return result
+
+
+def import_breakdown(top: int = 10) -> List[Dict]:
+    """-X importtime の出力をトップレベルパッケージごとに集計（自己時間の合計）"""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT_DIR, env=_env(),
+                            capture_output=True, text=True, check=True).stderr
+    totals: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # 見出し行など
+        package = fields[2].strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(fields[0])
+    ordered = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": package, "seconds": round(us / 1e6, 3)} for package, us in ordered]
+
+
+def _summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "median": round(statistics.median(samples), 3),
+        "min": round(min(samples), 3),
+        "max": round(max(samples), 3)
+    }
+
+
+def run(runs: int, server: bool) -> Dict:
+    """各項目をruns回計測して集計"""
+    report: Dict = {
+        "python": sys.version.split()[0],
+        "runs": runs,
+        "import_app": _summarize([_run_python(IMPORT_SNIPPET) for _ in range(runs)]),
+        "build_ui": _summarize([_run_python(BUILD_SNIPPET) for _ in range(runs)]),
+        "import_breakdown": import_breakdown()
+    }
+    if server:
+        for mode, fast in (("server", False), ("server_fast_startup", True)):
+            samples = [measure_server(fast) for _ in range(runs)]
+            report[mode] = {key: _summarize([s[key] for s in samples]) for key in samples[0]}
+    return report
+
+
+def format_report(report: Dict) -> str:
+    lines = [f"Python {report['python']}, {report['runs']}回計測（中央値 [最小-最大] 秒）"]
+    for key in ("import_app", "build_ui"):
+        s = report[key]
+        lines.append(f"  {key:<24} {s['median']:>7.3f} [{s['min']:.3f}-{s['max']:.3f}]")
+    for mode in ("server", "server_fast_startup"):
+        for key, s in report.get(mode, {}).items():
+            lines.append(f"  {mode + '.' + key:<40} {s['median']:>7.3f} [{s['min']:.3f}-{s['max']:.3f}]")
+    lines.append("  import app の内訳（パッケージ別の自己時間）:")
+    for item in report["import_breakdown"]:
+        lines.append(f"    {item['package']:<22} {item['seconds']:>7.3f}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=3, help="各項目の計測回数")
+    parser.add_argument("--no-server", action="store_true", help="サーバー起動の計測を省略")
+    parser.add_argument("--json", type=Path, help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    report = run(max(1, args.runs), server=not args.no_server)
+    print(format_report(report))
+    if args.json:
+        args.json.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
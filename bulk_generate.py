@@ -0,0 +1,327 @@
+"""JSONLマニフェストによる一括画像生成（ヘッドレス実行）
+
+キャンペーン用サムネイルなど大量の画像をGradio UIを介さずに生成する。
+入力JSONLの1行が1件の生成指定:
+
+    {"id": "banner-001", "prompt": "...", "size": "1024x1536", "quality": "medium",
+     "format": "png", "n": 2, "yaml": true}
+
+必須は prompt のみ。size はUIのラベル（"1024x1536 (縦長)"）も受け付ける。
+任意で transparent / compression / moderation も指定できる。
+
+出力ディレクトリには画像と manifest.jsonl を書き出す。マニフェストには1件ごとに
+レイテンシ・コスト・保存ファイルを記録し、完了ごとに追記・fsyncする。再実行時は
+マニフェストをチェックポイントとして読み込み、成功済みの項目を飛ばして再開する。
+タイムアウトは既定で無効（--timeout で指定）。タイムアウトした項目はAPI側で課金済みの
+可能性があるため possibly_billed として記録し、再開時は --retry-timeouts を指定した場合のみ再実行する。
+コストには画像生成に加えてYAML変換（gpt-4o）のトークン料金を含める。
+画像生成はジョブスケジューラの一括生成の優先度で実行枠を取得する（同じプロセスで
+UI・REST APIを動かしている場合は、対話型編集・通常生成が先に実行される）。
+
+使い方:
+    python bulk_generate.py specs.jsonl --output-dir out/ --concurrency 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+BASE_DIR = Path(__file__).parent
+sys.path.append(str(BASE_DIR))
+
+from src.services.fan_out import fan_out
+from src.services.history_writer import write_image_file
+from src.services.image_generator import AsyncImageGenerator
+from src.services.job_scheduler import PRIORITY_BULK, JobScheduler, get_job_scheduler
+from src.services.rate_limit import api_key_id
+from src.services.yaml_converter import convert_to_yaml_prompt
+from src.utils.config import FAN_OUT_SETTINGS
+from src.utils.metrics import LatencyRecorder
+from src.utils.pricing import image_cost_usd
+from src.utils.tracing import span, traced
+
+MANIFEST_NAME = "manifest.jsonl"
+SUMMARY_NAME = "summary.json"
+ITEM_LATENCY = "item_latency"
+
+_SAFE_ID_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_SIZE_RE = re.compile(r"\d+x\d+")
+
+
+def load_specs(path: Path) -> List[Dict]:
+    """入力JSONLを読み込み、idを補完した生成指定のリストを返す"""
+    specs = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                spec = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_no}: JSONの解析に失敗しました: {e}")
+            if not str(spec.get("prompt", "")).strip():
+                raise ValueError(f"{path}:{line_no}: prompt がありません")
+
+            spec_id = _SAFE_ID_RE.sub("_", str(spec.get("id") or f"{line_no:05d}"))
+            if spec_id in seen:
+                raise ValueError(f"{path}:{line_no}: id が重複しています: {spec_id}")
+            seen.add(spec_id)
+            spec["id"] = spec_id
+            specs.append(spec)
+    return specs
+
+
+def load_checkpoint(manifest_path: Path) -> Dict[str, Dict]:
+    """既存マニフェストからidごとの最新の結果を読み込む（途中で切れた行は無視）"""
+    entries: Dict[str, Dict] = {}
+    if not manifest_path.exists():
+        return entries
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry["id"]] = entry
+    return entries
+
+
+def normalize_size(size: str) -> str:
+    """UIラベル（"1024x1536 (縦長)"）からAPI用のサイズを取り出す"""
+    match = _SIZE_RE.search(size or "")
+    return match.group(0) if match else "1024x1024"
+
+
+class ManifestWriter:
+    """結果を1件ずつ追記し、クラッシュ時も完了分が残るようfsyncする"""
+
+    def __init__(self, path: Path):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, entry: Dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class BulkRunner:
+    """生成指定を上限付きの並列数で実行し、画像とマニフェストを書き出す"""
+
+    def __init__(self, api_key: str, output_dir: Path,
+                 concurrency: int = FAN_OUT_SETTINGS["concurrency"],
+                 timeout: Optional[float] = None,
+                 scheduler: Optional[JobScheduler] = None):
+        self.generator = AsyncImageGenerator(api_key)
+        self.api_key = api_key
+        self.jobs = scheduler or get_job_scheduler()
+        self.output_dir = output_dir
+        self.image_dir = output_dir / "images"
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.latency = LatencyRecorder()
+
+    async def generate(self, spec: Dict) -> Dict:
+        """1件分の生成・保存を行い、マニフェスト用の結果を返す（トレースIDを記録）"""
+        with traced("bulk_item", id=spec["id"]) as trace:
+            entry = await self._generate(spec)
+            # YAML変換のトークン料金（キャッシュ再利用・合流時は0）
+            yaml_cost = trace.attributes.get("chat_cost_usd") or 0.0
+            entry["yaml_cost_usd"] = round(yaml_cost, 6)
+            entry["cost_usd"] = round(entry["cost_usd"] + yaml_cost, 4)
+            entry["trace_id"] = trace.trace_id
+            return entry
+
+    async def _generate(self, spec: Dict) -> Dict:
+        size = normalize_size(spec.get("size", "1024x1024"))
+        quality = spec.get("quality", "auto")
+        format = spec.get("format", "png")
+        prompt = spec["prompt"]
+
+        yaml_applied = False
+        if spec.get("yaml") and not (prompt.strip().startswith("style:") or "main_texts:" in prompt):
+            converted = await convert_to_yaml_prompt(prompt, self.api_key, size)
+            yaml_applied = converted != prompt
+            prompt = converted
+
+        compression = spec.get("compression")
+        async with self.jobs.admission(api_key_id(self.api_key), PRIORITY_BULK) as ticket:
+            await ticket.wait()
+            result = await self.generator.generate_image_split(
+                prompt=prompt,
+                size=size,
+                quality=quality,
+                format=format,
+                transparent_bg=bool(spec.get("transparent", False)),
+                output_compression=compression if format in ["jpeg", "webp"] else None,
+                moderation=spec.get("moderation", "auto"),
+                n=int(spec.get("n", 1))
+            )
+
+        images = result["images"] if "images" in result else [result["image_data"]]
+        files = []
+        for i, image_data in enumerate(images):
+            path = self.image_dir / f"{spec['id']}_{i + 1}.{format}"
+            with span("output_write", bytes=len(image_data)):
+                await asyncio.to_thread(write_image_file, str(path), image_data, format)
+            files.append(str(path.relative_to(self.output_dir)))
+
+        # キャッシュ再利用・同時リクエストとの合流ではAPI呼び出しが発生しない
+        free = result.get("cache_hit", False) or result.get("coalesced", False)
+        return {
+            "files": files,
+            "image_count": len(images),
+            "requested_count": int(spec.get("n", 1)),
+            "failed_requests": len(result.get("failed_requests", [])),
+            "generation_time": result.get("generation_time"),
+            "cost_usd": 0.0 if free else round(image_cost_usd(size, quality, len(images)), 4),
+            "cache_hit": result.get("cache_hit", False),
+            "yaml_applied": yaml_applied,
+            "size": size,
+            "quality": quality,
+            "format": format
+        }
+
+    async def run(self, specs: List[Dict], retry_failed: bool = True, retry_timeouts: bool = False) -> Dict:
+        """未完了の指定を実行し、集計結果を返す
+
+        タイムアウトした項目は課金済みの可能性があるため、retry_timeouts=True の場合のみ再実行する。
+        """
+        self.image_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = self.output_dir / MANIFEST_NAME
+        checkpoint = load_checkpoint(manifest_path)
+
+        pending = []
+        skipped = 0
+        for spec in specs:
+            previous = checkpoint.get(spec["id"])
+            if previous and (previous["status"] == "ok" or not retry_failed or
+                             (previous.get("possibly_billed") and not retry_timeouts)):
+                skipped += 1
+                continue
+            pending.append(spec)
+
+        print(f"一括生成: {len(specs)}件中 {len(pending)}件を実行（チェックポイントから{skipped}件をスキップ、並列数 {self.concurrency}）")
+
+        writer = ManifestWriter(manifest_path)
+        totals = {"ok": 0, "error": 0, "timeout": 0, "images": 0, "cost_usd": 0.0, "possibly_billed_usd": 0.0}
+        start_time = time.time()
+        try:
+            async for outcome in fan_out(pending, self.generate, self.concurrency, self.timeout):
+                spec = pending[outcome["index"]]
+                entry = {
+                    "id": spec["id"],
+                    "status": outcome["status"],
+                    "latency": outcome["elapsed"],
+                    "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "prompt": spec["prompt"]
+                }
+                if outcome["status"] == "ok":
+                    entry.update(outcome["result"])
+                    totals["images"] += entry["image_count"]
+                    totals["cost_usd"] += entry["cost_usd"]
+                    self.latency.record(ITEM_LATENCY, outcome["elapsed"])
+                else:
+                    entry["error"] = outcome["error"]
+                if outcome["status"] == "timeout":
+                    # 打ち切った時点でAPI呼び出しが完了している可能性がある（最大の見積もりを記録）
+                    entry["possibly_billed"] = True
+                    entry["possibly_billed_usd"] = round(image_cost_usd(
+                        normalize_size(spec.get("size", "1024x1024")), spec.get("quality", "auto"),
+                        int(spec.get("n", 1))), 4)
+                    totals["possibly_billed_usd"] += entry["possibly_billed_usd"]
+                totals[outcome["status"]] += 1
+                writer.append(entry)
+
+                done = totals["ok"] + totals["error"] + totals["timeout"]
+                mark = "✅" if outcome["status"] == "ok" else "❌"
+                print(f"{mark} [{done}/{len(pending)}] {spec['id']} ({outcome['elapsed']}秒)"
+                      + (f": {entry['error']}" if outcome["status"] != "ok" else ""))
+        finally:
+            writer.close()
+
+        elapsed = time.time() - start_time
+        summary = {
+            "total_specs": len(specs),
+            "executed": len(pending),
+            "skipped": skipped,
+            "succeeded": totals["ok"],
+            "failed": totals["error"],
+            "timed_out": totals["timeout"],
+            "images": totals["images"],
+            "cost_usd": round(totals["cost_usd"], 4),
+            "possibly_billed_usd": round(totals["possibly_billed_usd"], 4),
+            "wall_time": round(elapsed, 2),
+            "items_per_minute": round(totals["ok"] / elapsed * 60, 2) if elapsed else 0.0,
+            "images_per_minute": round(totals["images"] / elapsed * 60, 2) if elapsed else 0.0,
+            "latency": self.latency.summary(ITEM_LATENCY).get(ITEM_LATENCY, {}),
+            "concurrency": self.concurrency
+        }
+        with open(self.output_dir / SUMMARY_NAME, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        return summary
+
+
+def format_summary(summary: Dict) -> str:
+    """集計結果の表示"""
+    latency = summary["latency"]
+    return "\n".join([
+        "=== 一括生成 完了 ===",
+        f"成功: {summary['succeeded']}件 / 失敗: {summary['failed']}件 / タイムアウト: {summary['timed_out']}件"
+        f"（スキップ {summary['skipped']}件）",
+        f"画像: {summary['images']}枚, コスト: 約${summary['cost_usd']}"
+        + (f"（タイムアウト分の課金の可能性: 最大${summary['possibly_billed_usd']}）"
+           if summary['possibly_billed_usd'] else ""),
+        f"所要時間: {summary['wall_time']}秒, スループット: {summary['items_per_minute']}件/分"
+        f"（{summary['images_per_minute']}枚/分）",
+        f"レイテンシ: p50 {latency.get('p50', 'N/A')}秒, p95 {latency.get('p95', 'N/A')}秒"
+    ])
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="JSONLマニフェストによる一括画像生成")
+    parser.add_argument("specs", type=Path, help="生成指定のJSONLファイル")
+    parser.add_argument("--output-dir", type=Path, default=Path("bulk_output"), help="画像とマニフェストの出力先")
+    parser.add_argument("--api-key", default=os.getenv("OPENAI_API_KEY"), help="OpenAI APIキー（既定: OPENAI_API_KEY）")
+    parser.add_argument("--concurrency", type=int, default=FAN_OUT_SETTINGS["concurrency"], help="同時に生成する件数")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="1件あたりのタイムアウト秒数（既定: なし。打ち切った項目も課金済みの可能性がある）")
+    parser.add_argument("--skip-failed", action="store_true", help="前回失敗した項目を再実行しない")
+    parser.add_argument("--retry-timeouts", action="store_true",
+                        help="前回タイムアウトした項目も再実行する（二重課金の可能性がある）")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not args.api_key:
+        print("❌ APIキーがありません（--api-key または OPENAI_API_KEY を指定してください）")
+        return 2
+
+    try:
+        specs = load_specs(args.specs)
+    except (OSError, ValueError) as e:
+        print(f"❌ 生成指定の読み込みエラー: {e}")
+        return 2
+
+    # CLIは単独のプロセスで実行するため、--concurrency をそのまま実行枠にする（待ち行列の上限なし）
+    scheduler = JobScheduler(max_concurrency=args.concurrency, per_key_concurrency=args.concurrency,
+                             max_queue=0, per_key_queue=0)
+    runner = BulkRunner(args.api_key, args.output_dir, args.concurrency, args.timeout, scheduler)
+    summary = asyncio.run(runner.run(specs, retry_failed=not args.skip_failed, retry_timeouts=args.retry_timeouts))
+    print(format_summary(summary))
+    return 0 if not (summary["failed"] or summary["timed_out"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
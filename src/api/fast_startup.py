@@ -0,0 +1,76 @@
+"""高速起動モード（ポートを先に開き、Gradio UIは裏で構築してからマウント）
+
+Spacesのスリープ復帰時は、gradioの読み込みとBlocksの構築が終わるまでポートが開かず、
+その間はAPIも応答しない。高速起動モードではAPIだけを載せたサーバーを先に起動し、
+UIの構築は別スレッドで行う。構築完了までの "/" は自動更新する準備中ページを返す。
+
+UIを起動後にマウントするため、通常はサーバーの起動時に実行されるGradioの
+lifespan・startupイベントをここで実行する。
+"""
+
+import asyncio
+import contextlib
+import time
+from typing import Callable, Dict
+
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse
+
+from src.api.routes import create_api_app
+
+LOADING_PAGE = """<!DOCTYPE html>
+<html lang="ja"><head><meta charset="utf-8"><meta http-equiv="refresh" content="2">
+<title>起動中...</title></head>
+<body style="background:#1a1a1a;color:#e0e0e0;font-family:sans-serif;text-align:center;padding-top:20vh">
+<h2>🎨 AI画像生成を起動しています...</h2><p>数秒後に自動で表示されます。</p></body></html>"""
+
+
+def create_fast_startup_app(build_ui: Callable[[], object]) -> FastAPI:
+    """APIを即時に提供し、build_ui() で構築したGradio UIを準備でき次第 "/" にマウントする"""
+    app = create_api_app()
+    status: Dict = {"ui_ready": False, "ui_build_time": None, "ui_error": None}
+    app.state.startup_status = status
+
+    @app.get("/", include_in_schema=False)
+    async def loading_page():
+        if status["ui_error"]:
+            return HTMLResponse(f"<p>UIの起動に失敗しました: {status['ui_error']}</p>", status_code=500)
+        return HTMLResponse(LOADING_PAGE, status_code=503, headers={"Retry-After": "2"})
+
+    placeholder = app.router.routes[-1]
+
+    @app.get("/startup", include_in_schema=False)
+    async def startup_status():
+        return status
+
+    async def mount_ui(stack: contextlib.AsyncExitStack):
+        start_time = time.perf_counter()
+        try:
+            blocks = await asyncio.to_thread(build_ui)
+            import gradio as gr
+
+            gr.mount_gradio_app(app, blocks, path="/")
+            gradio_app = app.router.routes[-1].app
+            app.router.routes.remove(placeholder)
+
+            # 起動済みサーバーへのマウントのため、Gradioのlifespan・startupイベントをここで実行
+            await stack.enter_async_context(gradio_app.router.lifespan_context(gradio_app))
+            gradio_app.get_blocks().run_startup_events()
+            await gradio_app.get_blocks().run_extra_startup_events()
+        except Exception as e:
+            status["ui_error"] = str(e)
+            print(f"UI構築エラー: {e}")
+            return
+        status["ui_ready"] = True
+        status["ui_build_time"] = round(time.perf_counter() - start_time, 3)
+        print(f"UIの準備が完了しました（{status['ui_build_time']}秒）")
+
+    @contextlib.asynccontextmanager
+    async def lifespan(_app: FastAPI):
+        async with contextlib.AsyncExitStack() as stack:
+            task = asyncio.create_task(mount_ui(stack))
+            yield
+            task.cancel()
+
+    app.router.lifespan_context = lifespan
+    return app
@@ -0,0 +1,139 @@
+"""冪等キーによるレスポンスの再利用
+
+社内ツールのリトライ（タイムアウト後の再送など）で同じ生成が二重に課金されないよう、
+Idempotency-Key ヘッダー付きのリクエストは完了したレスポンスを保持して再送時に返す。
+実行中の同じキーには合流し、同じキーで内容の異なるリクエストは拒否する。
+"""
+
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from src.services.rate_limit import api_key_id
+from src.services.single_flight import SingleFlight
+from src.utils.config import API_SETTINGS
+from src.utils.lru_cache import LRUCache
+
+
+class IdempotencyConflict(Exception):
+    """同じ冪等キーで異なる内容のリクエスト、または実行中のストリームへの再送"""
+
+
+class StoredResponse:
+    """保持したレスポンス（本文・メディアタイプ・ヘッダー）"""
+
+    __slots__ = ("body", "media_type", "headers", "fingerprint")
+
+    def __init__(self, body: bytes, media_type: str, headers: Optional[Dict[str, str]] = None,
+                 fingerprint: str = ""):
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers or {}
+        self.fingerprint = fingerprint
+
+
+def request_fingerprint(payload: Any) -> str:
+    """リクエスト内容のハッシュ（同じキーでの内容違いを検出するため）"""
+    if isinstance(payload, bytes):
+        data = payload
+    else:
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class IdempotencyStore:
+    """APIキー・エンドポイント・冪等キー単位で完了レスポンスを保持するストア"""
+
+    def __init__(self,
+                 max_items: int = API_SETTINGS["idempotency_max_items"],
+                 ttl: float = API_SETTINGS["idempotency_ttl"]):
+        self._responses = LRUCache(max_items=max_items, ttl=ttl)
+        self._flight = SingleFlight()
+        self._in_flight: Dict[str, str] = {}  # スコープ → 実行中リクエストのハッシュ
+        self._streaming: Set[str] = set()
+        self._lock = threading.Lock()
+        self._replays = 0
+
+    @staticmethod
+    def scope(api_key: str, route: str, key: str) -> str:
+        """保持用のキー（冪等キーは利用者ごと・エンドポイントごとに独立）"""
+        return f"{api_key_id(api_key)}:{route}:{key}"
+
+    def lookup(self, scope: str, fingerprint: str) -> Optional[StoredResponse]:
+        """完了済みのレスポンスを取得（内容が異なればIdempotencyConflict）"""
+        stored = self._responses.get(scope)
+        if stored is None:
+            return None
+        if stored.fingerprint != fingerprint:
+            raise IdempotencyConflict("同じIdempotency-Keyで異なる内容のリクエストが送信されました")
+        with self._lock:
+            self._replays += 1
+        return stored
+
+    async def run(self, scope: str, fingerprint: str,
+                  fn: Callable[[], Awaitable[StoredResponse]]) -> Tuple[StoredResponse, bool]:
+        """完了済みなら保持したレスポンスを、実行中なら合流した結果を返す。(レスポンス, 再利用したか)"""
+        stored = self.lookup(scope, fingerprint)
+        if stored is not None:
+            return stored, True
+
+        with self._lock:
+            if scope in self._streaming:
+                raise IdempotencyConflict("同じIdempotency-Keyのストリーミング生成が実行中です")
+            running = self._in_flight.setdefault(scope, fingerprint)
+        if running != fingerprint:
+            raise IdempotencyConflict("同じIdempotency-Keyで異なる内容のリクエストが実行中です")
+
+        async def execute() -> StoredResponse:
+            try:
+                response = await fn()
+                response.fingerprint = fingerprint
+                self._responses.set(scope, response)
+                return response
+            finally:
+                with self._lock:
+                    self._in_flight.pop(scope, None)
+
+        response, shared = await self._flight.do(scope, execute)
+        return response, shared
+
+    def check_stream(self, scope: str, fingerprint: str) -> Optional[StoredResponse]:
+        """ストリーミング生成を始められるか確認（登録はしない。完了済みなら保持したレスポンスを返す）"""
+        stored = self.lookup(scope, fingerprint)
+        if stored is not None:
+            return stored
+        with self._lock:
+            if scope in self._streaming or scope in self._in_flight:
+                raise IdempotencyConflict("同じIdempotency-Keyの生成が実行中です")
+        return None
+
+    def begin_stream(self, scope: str, fingerprint: str) -> Optional[StoredResponse]:
+        """ストリーミング生成の開始を登録（完了済みなら保持したレスポンスを返す）
+
+        登録したら必ず end_stream を呼ぶこと（レスポンス本文の生成開始後に呼び、終了処理と対にする）。
+        """
+        stored = self.lookup(scope, fingerprint)
+        if stored is not None:
+            return stored
+        with self._lock:
+            if scope in self._streaming or scope in self._in_flight:
+                raise IdempotencyConflict("同じIdempotency-Keyの生成が実行中です")
+            self._streaming.add(scope)
+        return None
+
+    def end_stream(self, scope: str, response: Optional[StoredResponse], fingerprint: str):
+        """ストリーミング生成の終了を登録（成功時は最終イベントを保持）"""
+        with self._lock:
+            self._streaming.discard(scope)
+        if response is not None:
+            response.fingerprint = fingerprint
+            self._responses.set(scope, response)
+
+    def stats(self) -> Dict:
+        """保持数・再利用数などの統計を取得"""
+        stats = self._responses.stats()
+        with self._lock:
+            stats.update({"replays": self._replays, "in_flight": len(self._in_flight) + len(self._streaming)})
+        stats.update({"coalesced": self._flight.stats()["coalesced"]})
+        return stats
@@ -0,0 +1,379 @@
+"""Gradio UIと同じサーバーに載せるREST/ストリーミングAPI
+
+社内ツールがUIのスクレイピングやGradioクライアント経由で生成しなくて済むよう、
+サービス層を直接呼び出すHTTP APIを提供する（Blocksのシリアライズを経由しない）。
+
+- 認証: 利用者自身のOpenAI APIキーを ``Authorization: Bearer sk-...`` で渡す
+- 単一画像はバイナリ本文（image/png 等）、複数枚・``Accept: application/json`` はbase64のJSON
+- ``stream: true`` は部分画像をServer-Sent Events（partial / final / error）で返す
+- ``Idempotency-Key`` ヘッダー付きのリクエストは完了レスポンスを保持し、再送時に同じ結果を返す
+"""
+
+import base64
+import json
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+
+from src.api.idempotency import IdempotencyConflict, IdempotencyStore, StoredResponse, request_fingerprint
+from src.services.image_executor import get_image_executor
+from src.services.image_generator import AsyncImageGenerator
+from src.services.job_scheduler import (PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_STANDARD, QueueFullError,
+                                        get_job_scheduler)
+from src.services.rate_limit import api_key_id
+from src.services.reference_cache import get_reference_cache
+from src.services.responses_api import AsyncResponsesAPI
+from src.services.yaml_converter import convert_to_yaml_prompt
+from src.services.yaml_validator import get_yaml_validator
+from src.utils.config import API_SETTINGS
+from src.utils.pricing import image_cost_usd
+from src.utils.tracing import get_tracer
+
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+SIZES = ("1024x1024", "1024x1536", "1536x1024", "auto")
+
+
+class ImageOptions(BaseModel):
+    """生成オプション（UIの基本設定と同じ項目）"""
+    size: str = "1024x1024"
+    quality: str = "auto"
+    format: str = "png"
+    transparent: bool = False
+    compression: Optional[int] = Field(default=None, ge=0, le=100)
+    moderation: str = "auto"
+    stream: bool = False
+    partial_images: int = Field(default=2, ge=1, le=3)
+
+
+class GenerateRequest(ImageOptions):
+    prompt: str
+    n: int = Field(default=1, ge=1, le=10)
+    yaml: bool = False               # YAMLプロンプトに変換してから生成
+    use_responses_api: bool = False  # Responses APIで生成（response_idが返り継続生成に使える）
+    bulk: bool = False               # 一括処理（対話型編集・通常生成の後に実行枠を割り当てる）
+
+
+class ContinueRequest(ImageOptions):
+    previous_response_id: str
+    prompt: str
+
+
+class YamlRequest(BaseModel):
+    prompt: str
+    size: str = "1024x1024"
+
+
+def require_api_key(authorization: Optional[str] = Header(default=None),
+                    x_openai_api_key: Optional[str] = Header(default=None)) -> str:
+    """リクエストからOpenAI APIキーを取得"""
+    api_key = x_openai_api_key
+    if not api_key and authorization and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    if not api_key or not api_key.startswith("sk-"):
+        raise HTTPException(status_code=401, detail="OpenAI APIキーを Authorization: Bearer ヘッダーで指定してください")
+    return api_key
+
+
+def _validate_options(options: ImageOptions, n: int = 1):
+    """生成オプションの検証"""
+    if options.size not in SIZES:
+        raise HTTPException(status_code=400, detail=f"size は {', '.join(SIZES)} のいずれかを指定してください")
+    if options.format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format は {', '.join(MEDIA_TYPES)} のいずれかを指定してください")
+    if options.stream and n > 1:
+        raise HTTPException(status_code=400, detail="ストリーミングは1枚のみ対応しています")
+
+
+def _compression(options: ImageOptions) -> Optional[int]:
+    return options.compression if options.format in ["jpeg", "webp"] else None
+
+
+def _result_images(result: Dict) -> List[bytes]:
+    return result["images"] if "images" in result else [result["image_data"]]
+
+
+def _result_headers(result: Dict, options: ImageOptions, image_count: int) -> Dict[str, str]:
+    """生成結果のメタデータをレスポンスヘッダーに変換（ASCIIのみ）"""
+    free = result.get("cache_hit", False) or result.get("coalesced", False)
+    headers = {
+        "X-Generation-Time": str(result.get("generation_time", "")),
+        "X-Image-Count": str(image_count),
+        "X-Cost-USD": "0.000" if free else f"{image_cost_usd(options.size, options.quality, image_count):.3f}",
+        "X-Cache-Hit": str(bool(free)).lower()
+    }
+    if result.get("response_id"):
+        headers["X-Response-Id"] = result["response_id"]
+    return headers
+
+
+def _image_response(result: Dict, options: ImageOptions, as_json: bool) -> StoredResponse:
+    """生成結果をバイナリ本文（単一画像）またはbase64のJSONに変換"""
+    images = _result_images(result)
+    headers = _result_headers(result, options, len(images))
+    if len(images) == 1 and not as_json:
+        return StoredResponse(images[0], MEDIA_TYPES[options.format], headers)
+
+    payload = {
+        "images": [base64.b64encode(image).decode("ascii") for image in images],
+        "format": options.format,
+        "generation_time": result.get("generation_time"),
+        "revised_prompt": result.get("revised_prompt"),
+        "response_id": result.get("response_id"),
+        "failed_requests": result.get("failed_requests", []),
+        "cost_usd": float(headers["X-Cost-USD"])
+    }
+    return StoredResponse(json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json", headers)
+
+
+def _sse(event: str, data: Dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _stream_event_payload(event: Dict) -> Dict:
+    """ストリームイベントからSSEのデータ部を作成（画像はbase64）"""
+    payload = {k: v for k, v in event.items() if k not in ("image_data", "type")}
+    if event.get("image_data"):
+        payload["image_b64"] = base64.b64encode(event["image_data"]).decode("ascii")
+    return payload
+
+
+def _wants_json(request: Request) -> bool:
+    return "application/json" in request.headers.get("accept", "")
+
+
+def _to_response(stored: StoredResponse, replayed: bool) -> Response:
+    headers = dict(stored.headers)
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+    if stored.media_type == "text/event-stream":
+        return StreamingResponse(iter([stored.body]), media_type=stored.media_type, headers=headers)
+    return Response(stored.body, media_type=stored.media_type, headers=headers)
+
+
+def create_api_router(idempotency: Optional[IdempotencyStore] = None) -> APIRouter:
+    """APIルーターを作成"""
+    router = APIRouter()
+    jobs = get_job_scheduler()
+    idempotency = idempotency or IdempotencyStore()
+
+    async def run_with_idempotency(api_key: str, route: str, idempotency_key: Optional[str],
+                                   fingerprint_source, fn) -> Response:
+        """冪等キーがあれば完了レスポンスを保持・再利用して実行"""
+        if not idempotency_key:
+            return _to_response(await fn(), False)
+        stored, replayed = await idempotency.run(
+            idempotency.scope(api_key, route, idempotency_key), request_fingerprint(fingerprint_source), fn
+        )
+        return _to_response(stored, replayed)
+
+    def stream_response(api_key: str, route: str, idempotency_key: Optional[str], fingerprint_source,
+                        open_stream, priority: int) -> Response:
+        """部分画像をSSEで返す（冪等キーがあれば最終イベントを保持し、再送時はそれを返す）"""
+        scope = idempotency.scope(api_key, route, idempotency_key) if idempotency_key else None
+        fingerprint = request_fingerprint(fingerprint_source) if scope else ""
+        if scope:
+            stored = idempotency.check_stream(scope, fingerprint)
+            if stored is not None:
+                return _to_response(stored, True)
+
+        async def events() -> AsyncIterator[bytes]:
+            # 実行中の登録は本文の生成開始後に行う（送信前に切断されると finally が実行されず、登録が残るため）
+            if scope:
+                try:
+                    stored = idempotency.begin_stream(scope, fingerprint)
+                except IdempotencyConflict as e:
+                    yield _sse("error", {"error": str(e), "status": 409})
+                    return
+                if stored is not None:
+                    yield stored.body
+                    return
+            final = None
+            try:
+                async with jobs.admission(api_key_id(api_key), priority) as ticket:
+                    async for position, eta in ticket.updates():
+                        yield _sse("queued", {"position": position, "eta": eta})
+                    stream = await open_stream()
+                    if isinstance(stream, dict):
+                        yield _sse("error", {"error": stream.get("error", "不明なエラー")})
+                        return
+                    async for event in stream:
+                        kind = event["type"] if event["type"] in ("partial", "final") else "error"
+                        chunk = _sse(kind, _stream_event_payload(event))
+                        if kind == "final":
+                            final = chunk
+                        yield chunk
+            except QueueFullError as e:
+                yield _sse("error", {"error": str(e), "status": 429})
+            except Exception as e:
+                yield _sse("error", {"error": str(e)})
+            finally:
+                if scope:
+                    idempotency.end_stream(scope, StoredResponse(final, "text/event-stream") if final else None,
+                                           fingerprint)
+
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def admitted(api_key: str, priority: int, fn):
+        """ジョブスケジューラの実行枠を取得してから実行"""
+        async with jobs.admission(api_key_id(api_key), priority) as ticket:
+            await ticket.wait()
+            try:
+                return await fn()
+            except Exception as e:
+                # サービス層は失敗を「〇〇エラー: ...」の例外で返す
+                raise HTTPException(status_code=502, detail=str(e))
+
+    @router.post("/generate")
+    async def generate(body: GenerateRequest, request: Request, api_key: str = Depends(require_api_key),
+                       idempotency_key: Optional[str] = Header(default=None)):
+        """プロンプトから画像を生成"""
+        _validate_options(body, body.n)
+        priority = PRIORITY_BULK if body.bulk else PRIORITY_STANDARD
+        prompt = body.prompt
+        if body.yaml and not (prompt.strip().startswith("style:") or "main_texts:" in prompt):
+            prompt = await convert_to_yaml_prompt(prompt, api_key, body.size)
+
+        if body.stream:
+            responses_api = AsyncResponsesAPI(api_key)
+            return stream_response(api_key, "generate", idempotency_key, body.model_dump(), lambda: responses_api.generate_with_responses(
+                prompt=prompt,
+                size=body.size,
+                quality=body.quality,
+                format=body.format,
+                background="transparent" if body.transparent else "auto",
+                output_compression=_compression(body),
+                moderation=body.moderation,
+                stream=True,
+                partial_images=body.partial_images
+            ), priority)
+
+        async def run() -> StoredResponse:
+            if body.use_responses_api:
+                result = await admitted(api_key, priority, lambda: AsyncResponsesAPI(api_key).generate_with_responses(
+                    prompt=prompt,
+                    size=body.size,
+                    quality=body.quality,
+                    format=body.format,
+                    background="transparent" if body.transparent else "auto",
+                    output_compression=_compression(body),
+                    moderation=body.moderation
+                ))
+            else:
+                result = await admitted(api_key, priority, lambda: AsyncImageGenerator(api_key).generate_image_split(
+                    prompt=prompt,
+                    size=body.size,
+                    quality=body.quality,
+                    format=body.format,
+                    transparent_bg=body.transparent,
+                    output_compression=_compression(body),
+                    moderation=body.moderation,
+                    n=body.n
+                ))
+            return _image_response(result, body, _wants_json(request))
+
+        return await run_with_idempotency(api_key, "generate", idempotency_key,
+                                          [body.model_dump(), _wants_json(request)], run)
+
+    @router.post("/reference")
+    async def generate_with_reference(request: Request,
+                                      image: UploadFile = File(...),
+                                      prompt: str = Form(...),
+                                      size: str = Form("1024x1024"),
+                                      quality: str = Form("auto"),
+                                      format: str = Form("png"),
+                                      transparent: bool = Form(False),
+                                      compression: Optional[int] = Form(None),
+                                      moderation: str = Form("auto"),
+                                      api_key: str = Depends(require_api_key),
+                                      idempotency_key: Optional[str] = Header(default=None)):
+        """参照画像（multipart）を使用して画像を生成"""
+        options = ImageOptions(size=size, quality=quality, format=format, transparent=transparent,
+                               compression=compression, moderation=moderation)
+        _validate_options(options)
+        reference_image_data = await image.read()
+        if not reference_image_data:
+            raise HTTPException(status_code=400, detail="参照画像が空です")
+
+        async def run() -> StoredResponse:
+            result = await admitted(api_key, PRIORITY_STANDARD, lambda: AsyncImageGenerator(api_key).generate_with_reference_image(
+                prompt=prompt,
+                reference_image_data=reference_image_data,
+                size=options.size,
+                quality=options.quality,
+                format=options.format,
+                transparent_bg=options.transparent,
+                output_compression=_compression(options),
+                moderation=options.moderation
+            ))
+            return _image_response(result, options, _wants_json(request))
+
+        fingerprint_source = [options.model_dump(), prompt, request_fingerprint(reference_image_data), _wants_json(request)]
+        return await run_with_idempotency(api_key, "reference", idempotency_key, fingerprint_source, run)
+
+    @router.post("/continue")
+    async def continue_generation(body: ContinueRequest, request: Request, api_key: str = Depends(require_api_key),
+                                  idempotency_key: Optional[str] = Header(default=None)):
+        """前回のresponse_idから継続生成（対話型編集）"""
+        _validate_options(body)
+        responses_api = AsyncResponsesAPI(api_key)
+
+        def call(stream: bool):
+            kwargs = dict(partial_images=body.partial_images) if stream else {}
+            return responses_api.continue_generation(
+                previous_response_id=body.previous_response_id,
+                prompt=body.prompt,
+                stream=stream,
+                size=body.size,
+                quality=body.quality,
+                format=body.format,
+                background="transparent" if body.transparent else "auto",
+                output_compression=_compression(body),
+                moderation=body.moderation,
+                **kwargs
+            )
+
+        if body.stream:
+            return stream_response(api_key, "continue", idempotency_key, body.model_dump(),
+                                   lambda: call(True), PRIORITY_INTERACTIVE)
+
+        async def run() -> StoredResponse:
+            result = await admitted(api_key, PRIORITY_INTERACTIVE, lambda: call(False))
+            return _image_response(result, body, _wants_json(request))
+
+        return await run_with_idempotency(api_key, "continue", idempotency_key,
+                                          [body.model_dump(), _wants_json(request)], run)
+
+    @router.post("/yaml")
+    async def convert_yaml(body: YamlRequest, api_key: str = Depends(require_api_key)):
+        """依頼文をYAMLプロンプトに変換（変換結果はキャッシュされるため冪等キーは不要）"""
+        yaml_prompt = await convert_to_yaml_prompt(body.prompt, api_key, body.size)
+        return {"yaml": yaml_prompt, "converted": yaml_prompt != body.prompt}
+
+    @router.get("/stats")
+    async def stats(api_key: str = Depends(require_api_key)):
+        """ジョブキュー・冪等キー・画像処理プロセス・参照画像アップロード・YAML修復・トレースの統計（要APIキー）"""
+        return {"jobs": jobs.stats(), "idempotency": idempotency.stats(),
+                "image_executor": get_image_executor().stats(), "reference_uploads": get_reference_cache().stats(),
+                "yaml_validation": get_yaml_validator().stats(), "traces": get_tracer().stats()}
+
+    return router
+
+
+def create_api_app() -> FastAPI:
+    """APIを載せたFastAPIアプリを作成（Gradio UIはこのアプリにマウントする）"""
+    app = FastAPI(title="AI画像生成 API", docs_url=f"{API_SETTINGS['prefix']}/docs",
+                  openapi_url=f"{API_SETTINGS['prefix']}/openapi.json")
+    app.include_router(create_api_router(), prefix=API_SETTINGS["prefix"])
+
+    @app.exception_handler(QueueFullError)
+    async def queue_full_handler(request: Request, exc: QueueFullError):
+        return JSONResponse({"detail": str(exc)}, status_code=429, headers={"Retry-After": "10"})
+
+    @app.exception_handler(IdempotencyConflict)
+    async def idempotency_conflict_handler(request: Request, exc: IdempotencyConflict):
+        return JSONResponse({"detail": str(exc)}, status_code=409)
+
+    return app
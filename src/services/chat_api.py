@@ -0,0 +1,26 @@
+"""チャット補完APIの呼び出し
+
+AIチャットとYAML変換で共有する。共有クライアントで接続を再利用し、
+429/5xxはrate_limitのスケジューラで再試行する。
+"""
+
+from src.services.client_pool import get_async_openai_client
+from src.services.rate_limit import api_key_id, get_retry_scheduler, rate_limit_group
+from src.utils.pricing import chat_cost_usd
+from src.utils.tracing import record_total, span
+
+
+async def create_chat_completion(api_key: str, **kwargs):
+    """チャット補完の呼び出し（共有クライアント + レート制限を考慮した再試行）"""
+    client = get_async_openai_client(api_key)
+    with span("api_call", endpoint="chat.completions.create", model=kwargs.get("model")) as current:
+        response = await get_retry_scheduler().acall(api_key_id(api_key), lambda: client.chat.completions.create(**kwargs),
+                                                     group=rate_limit_group(client.chat.completions.create))
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            input_tokens = getattr(usage, "prompt_tokens", None) or 0
+            output_tokens = getattr(usage, "completion_tokens", None) or 0
+            current.set(input_tokens=input_tokens, output_tokens=output_tokens)
+            # 一括生成のマニフェストなどで、リクエスト単位のチャット補完コストを集計できるようにする
+            record_total("chat_cost_usd", chat_cost_usd(kwargs.get("model", ""), input_tokens, output_tokens))
+        return response
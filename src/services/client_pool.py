@@ -0,0 +1,245 @@
+"""OpenAIクライアントのプロセス共有レジストリ
+
+クリック毎にクライアントを生成するとHTTPコネクションプール・DNS解決・TLSハンドシェイクが
+毎回発生するため、APIキー単位でクライアントを共有しkeep-aliveで接続を再利用する。
+
+SDK内蔵のリトライは無効化し（max_retries=0）、再試行はrate_limitのスケジューラで一元管理する。
+レスポンスフックで全レスポンスのレート制限ヘッダーをスケジューラに渡す。
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from src.services.rate_limit import api_key_id, get_retry_scheduler, rate_limit_group_from_path
+from src.utils.compat import ensure_openai_compat
+from src.utils.config import CLIENT_POOL_SETTINGS
+
+
+def _fingerprint(api_key: str) -> str:
+    """APIキーをレジストリ用のキーに変換（生のキーを辞書キーに残さない）"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _mask(api_key: str) -> str:
+    """統計表示用にAPIキーをマスク"""
+    if len(api_key) <= 8:
+        return "sk-****"
+    return f"{api_key[:3]}...{api_key[-4:]}"
+
+
+class _PooledClient:
+    """レジストリ内の1エントリ"""
+
+    __slots__ = ("client", "label", "loop", "created_at", "last_used", "hits")
+
+    def __init__(self, client, label: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+        now = time.time()
+        self.client = client
+        self.label = label
+        self.loop = loop  # 非同期クライアントの接続が紐づくイベントループ
+        self.created_at = now
+        self.last_used = now
+        self.hits = 0
+
+
+class ClientPool:
+    """APIキー単位でOpenAIクライアントを共有するLRU + アイドルTTLレジストリ
+
+    async_mode=True の場合はAsyncOpenAIを保持する。非同期クライアントの接続は
+    イベントループに紐づくため、キーには実行中のループも含める。閉じたループの
+    クライアントは取得時に破棄し、別のループ（idの再利用）に渡さない。
+    """
+
+    def __init__(self,
+                 async_mode: bool = False,
+                 max_clients: int = CLIENT_POOL_SETTINGS["max_clients"],
+                 idle_ttl: float = CLIENT_POOL_SETTINGS["idle_ttl"],
+                 max_connections: int = CLIENT_POOL_SETTINGS["max_connections"],
+                 max_keepalive: int = CLIENT_POOL_SETTINGS["max_keepalive"],
+                 keepalive_expiry: float = CLIENT_POOL_SETTINGS["keepalive_expiry"]):
+        self.async_mode = async_mode
+        self.max_clients = max(1, max_clients)
+        self.idle_ttl = idle_ttl
+        # httpx.Limitsに渡す値（openai・httpxは初回のクライアント作成時に読み込む）
+        self.limits = {
+            "max_connections": max_connections,
+            "max_keepalive_connections": max_keepalive,
+            "keepalive_expiry": keepalive_expiry
+        }
+        self._entries: "OrderedDict[str, _PooledClient]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._misses: Dict[str, int] = {}
+        self._evictions = 0
+
+    def _create_client(self, api_key: str):
+        """keep-alive接続プール付きのクライアントを生成"""
+        ensure_openai_compat()
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+        
+        key_id = api_key_id(api_key)
+        scheduler = get_retry_scheduler()
+        limits = httpx.Limits(**self.limits)
+        
+        def observe(response: httpx.Response):
+            scheduler.observe(key_id, response.status_code, response.headers,
+                              rate_limit_group_from_path(response.request.url.path))
+        
+        if self.async_mode:
+            async def observe_async(response: httpx.Response):
+                observe(response)
+            
+            http_client = DefaultAsyncHttpxClient(limits=limits, event_hooks={"response": [observe_async]})
+            return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        http_client = DefaultHttpxClient(limits=limits, event_hooks={"response": [observe]})
+        return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+    def _key(self, api_key: str) -> str:
+        """レジストリキーを作成"""
+        key = _fingerprint(api_key)
+        if self.async_mode:
+            try:
+                key = f"{key}:{id(asyncio.get_running_loop())}"
+            except RuntimeError:
+                pass
+        return key
+
+    def get(self, api_key: str):
+        """APIキーに対応するクライアントを取得（なければ生成）"""
+        key = self._key(api_key)
+        loop = self._running_loop()
+        with self._lock:
+            evicted = self._evict_expired_locked()
+
+            entry = self._entries.get(key)
+            if entry is not None and entry.loop is not loop:
+                # 同じidの別ループ（破棄済みループのidが再利用された）
+                evicted.append(self._entries.pop(key))
+                self._evictions += 1
+                entry = None
+            if entry is not None:
+                entry.hits += 1
+                entry.last_used = time.time()
+                self._entries.move_to_end(key)
+            else:
+                entry = _PooledClient(self._create_client(api_key), _mask(api_key), loop)
+                self._entries[key] = entry
+                self._misses[key] = self._misses.get(key, 0) + 1
+
+                # 上限超過時は最も使われていないクライアントから破棄
+                while len(self._entries) > self.max_clients:
+                    evicted_key, evicted_entry = self._entries.popitem(last=False)
+                    self._misses.pop(evicted_key, None)
+                    self._evictions += 1
+                    evicted.append(evicted_entry)
+
+        self._close(evicted)
+        return entry.client
+
+    def _running_loop(self) -> Optional[asyncio.AbstractEventLoop]:
+        if not self.async_mode:
+            return None
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def _close(self, entries: List[_PooledClient]):
+        """破棄したクライアントの接続プールを閉じる（ロックの外で呼ぶ）"""
+        for entry in entries:
+            try:
+                if not self.async_mode:
+                    entry.client.close()
+                elif entry.loop is not None and not entry.loop.is_closed():
+                    # 非同期クライアントは接続が紐づくループ上で閉じる
+                    asyncio.run_coroutine_threadsafe(entry.client.close(), entry.loop)
+            except Exception as e:
+                print(f"クライアントのクローズに失敗: {entry.label} ({e})")
+
+    def _evict_expired_locked(self) -> List[_PooledClient]:
+        """アイドルTTLを超えた・ループが閉じたクライアントをレジストリから外して返す（ロック取得済み前提）"""
+        deadline = time.time() - self.idle_ttl if self.idle_ttl else None
+        expired = [k for k, e in self._entries.items()
+                   if (deadline is not None and e.last_used < deadline)
+                   or (e.loop is not None and e.loop.is_closed())]
+        evicted = []
+        for key in expired:
+            evicted.append(self._entries.pop(key))
+            self._misses.pop(key, None)
+            self._evictions += 1
+        return evicted
+
+    def evict_idle(self) -> int:
+        """アイドル状態のクライアントを明示的に破棄し、残数を返す"""
+        with self._lock:
+            evicted = self._evict_expired_locked()
+            remaining = len(self._entries)
+        self._close(evicted)
+        return remaining
+
+    def clear(self):
+        """全クライアントを破棄"""
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+            self._misses.clear()
+        self._close(evicted)
+
+    def stats(self) -> Dict:
+        """APIキー別のプール統計（再利用率など）を取得"""
+        now = time.time()
+        with self._lock:
+            per_key = {}
+            for key, entry in self._entries.items():
+                requests = entry.hits + self._misses.get(key, 0)
+                per_key[entry.label] = {
+                    "requests": requests,
+                    "reuses": entry.hits,
+                    "reuse_rate": round(entry.hits / requests, 3) if requests else 0.0,
+                    "age_sec": round(now - entry.created_at, 1),
+                    "idle_sec": round(now - entry.last_used, 1)
+                }
+            return {
+                "clients": len(self._entries),
+                "max_clients": self.max_clients,
+                "evictions": self._evictions,
+                "per_key": per_key
+            }
+
+
+# プロセス共有のデフォルトレジストリ（同期/非同期）
+_default_pools: Dict[bool, ClientPool] = {}
+_default_pool_lock = threading.Lock()
+
+
+def get_client_pool(async_mode: bool = False) -> ClientPool:
+    """プロセス共有のクライアントレジストリを取得"""
+    pool = _default_pools.get(async_mode)
+    if pool is None:
+        with _default_pool_lock:
+            pool = _default_pools.get(async_mode)
+            if pool is None:
+                pool = _default_pools[async_mode] = ClientPool(async_mode=async_mode)
+    return pool
+
+
+def get_openai_client(api_key: str):
+    """共有レジストリからOpenAIクライアントを取得"""
+    return get_client_pool().get(api_key)
+
+
+def get_async_openai_client(api_key: str):
+    """共有レジストリからAsyncOpenAIクライアントを取得（実行中のループ単位）"""
+    return get_client_pool(async_mode=True).get(api_key)
+
+
+def get_pool_stats() -> Dict:
+    """共有レジストリのプール統計を取得"""
+    return {
+        "sync": get_client_pool().stats(),
+        "async": get_client_pool(async_mode=True).stats()
+    }
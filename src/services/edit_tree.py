@@ -0,0 +1,176 @@
+"""対話型編集の編集ツリー（セッション単位）
+
+対話型編集は直前の response_id だけを保持していたため、前の段階に戻る・前の段階から
+別の指示を試すには生成し直す必要があった。継続生成の結果ごとに
+response_id・画像・指示をノードとして保持し、任意のノードへ即時に戻れるようにする。
+次の継続生成は選択中のノードの response_id を previous_response_id として送るため、
+途中の段階から分岐しても連鎖を再生成しない。
+
+- ルートは対話型有効で生成した画像、子は継続生成の結果
+- 上限（段階数・画像バイト数）を超えた場合は、選択中の段階とその祖先を除く古い末端から破棄
+- 画像バッファは履歴ストアと共有する（同じbytesオブジェクトを参照）
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from src.utils.config import EDIT_TREE_SETTINGS
+
+
+class EditNode:
+    """編集ツリーの1段階"""
+
+    __slots__ = ("node_id", "parent_id", "response_id", "image_data", "instruction", "format",
+                 "record_id", "created_at", "children")
+
+    def __init__(self, node_id: int, parent_id: Optional[int], response_id: str, image_data: bytes,
+                 instruction: str, format: str, record_id: Optional[int] = None):
+        self.node_id = node_id
+        self.parent_id = parent_id
+        self.response_id = response_id
+        self.image_data = image_data
+        self.instruction = instruction
+        self.format = format
+        self.record_id = record_id  # 対応する履歴レコード（表示用の一時ファイル）
+        self.created_at = time.time()
+        self.children: List[int] = []
+
+
+class EditTree:
+    """response_idの分岐を保持するツリー（選択中のノードから継続生成する）"""
+
+    def __init__(self,
+                 max_nodes: int = EDIT_TREE_SETTINGS["max_nodes"],
+                 max_bytes: int = EDIT_TREE_SETTINGS["max_bytes"]):
+        self.max_nodes = max(1, max_nodes)
+        self.max_bytes = max_bytes
+        self._nodes: "OrderedDict[int, EditNode]" = OrderedDict()  # 追加順
+        self._next_id = 1
+        self._current: Optional[int] = None
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def add(self, parent_id: Optional[int], response_id: str, image_data: bytes, instruction: str,
+            format: str = "png", record_id: Optional[int] = None) -> EditNode:
+        """ノードを追加して選択中にする（parent_idがNone・破棄済みならルート）"""
+        with self._lock:
+            parent = self._nodes.get(parent_id) if parent_id is not None else None
+            node = EditNode(self._next_id, parent.node_id if parent else None, response_id,
+                            image_data, instruction, format, record_id)
+            self._next_id += 1
+            self._nodes[node.node_id] = node
+            self._bytes += len(image_data)
+            if parent is not None:
+                parent.children.append(node.node_id)
+            self._current = node.node_id
+            self._evict_locked()
+            return node
+
+    def get(self, node_id: Optional[int]) -> Optional[EditNode]:
+        with self._lock:
+            return self._nodes.get(node_id) if node_id is not None else None
+
+    @property
+    def current(self) -> Optional[EditNode]:
+        """選択中のノード（未選択ならNone）"""
+        with self._lock:
+            return self._nodes.get(self._current) if self._current is not None else None
+
+    def checkout(self, node_id: int) -> Optional[EditNode]:
+        """ノードを選択（次の継続生成はこのノードから分岐）。破棄済みならNone"""
+        with self._lock:
+            node = self._nodes.get(node_id)
+            if node is not None:
+                self._current = node_id
+            return node
+
+    def undo(self) -> Optional[EditNode]:
+        """選択中のノードの親を選択（ルート・未選択ならNone）"""
+        with self._lock:
+            node = self._nodes.get(self._current) if self._current is not None else None
+            parent = self._nodes.get(node.parent_id) if node and node.parent_id is not None else None
+            if parent is not None:
+                self._current = parent.node_id
+            return parent
+
+    def detach(self):
+        """選択を解除（対話型以外の生成後。ノードは残るため後から戻れる）"""
+        with self._lock:
+            self._current = None
+
+    def path(self, node_id: Optional[int] = None) -> List[EditNode]:
+        """ルートからノード（省略時は選択中）までの経路"""
+        with self._lock:
+            return self._path_locked(self._current if node_id is None else node_id)
+
+    def outline(self) -> List[Tuple[EditNode, int]]:
+        """表示用に (ノード, 深さ) を深さ優先の順で返す"""
+        with self._lock:
+            items: List[Tuple[EditNode, int]] = []
+            stack = [(node, 0) for node in reversed(self._nodes.values()) if node.parent_id is None]
+            while stack:
+                node, depth = stack.pop()
+                items.append((node, depth))
+                stack.extend((self._nodes[child], depth + 1) for child in reversed(node.children))
+            return items
+
+    def trim(self, max_bytes: int) -> int:
+        """画像バイト数がmax_bytes以下になるまで古い末端ノードを破棄し、破棄数を返す（選択中の経路は残す）"""
+        with self._lock:
+            before = self._evictions
+            self._evict_locked(max_bytes)
+            return self._evictions - before
+
+    def clear(self):
+        """全ノードを破棄"""
+        with self._lock:
+            self._nodes.clear()
+            self._current = None
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "nodes": len(self._nodes),
+                "max_nodes": self.max_nodes,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "current": self._current,
+                "evictions": self._evictions
+            }
+
+    def buffer_sizes(self) -> Dict[int, int]:
+        """保持中の画像バッファ（id → バイト数）。履歴と共有するバッファの重複計上を避けるため"""
+        with self._lock:
+            return {id(node.image_data): len(node.image_data) for node in self._nodes.values()}
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def _path_locked(self, node_id: Optional[int]) -> List[EditNode]:
+        path = []
+        node = self._nodes.get(node_id) if node_id is not None else None
+        while node is not None:
+            path.append(node)
+            node = self._nodes.get(node.parent_id) if node.parent_id is not None else None
+        return path[::-1]
+
+    def _evict_locked(self, max_bytes: Optional[int] = None):
+        """上限を超えた分を古い末端ノードから破棄（選択中の経路は残す。ロック取得済み前提）"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes or None  # 0は無制限
+        protected = {node.node_id for node in self._path_locked(self._current)}
+        while len(self._nodes) > self.max_nodes or (max_bytes is not None and self._bytes > max_bytes):
+            victim = next((node for node in self._nodes.values()
+                           if not node.children and node.node_id not in protected), None)
+            if victim is None:
+                break
+            del self._nodes[victim.node_id]
+            self._bytes -= len(victim.image_data)
+            self._evictions += 1
+            parent = self._nodes.get(victim.parent_id) if victim.parent_id is not None else None
+            if parent is not None:
+                parent.children.remove(victim.node_id)
@@ -0,0 +1,106 @@
+"""並列ファンアウト実行エンジン
+
+バリエーション生成・バッチ生成・大きなnの分割生成で使用する。
+同時実行数の上限と項目ごとのタイムアウトを設け、完了した順に結果を返す。
+失敗は項目単位で結果に記録し、他の項目には影響させない。
+"""
+
+import asyncio
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence
+
+from src.utils.config import FAN_OUT_SETTINGS
+
+
+def _item_result(index: int, status: str, elapsed: float, result: Any = None, error: Optional[str] = None) -> Dict:
+    """項目ごとの結果辞書を作成"""
+    return {
+        "index": index,
+        "status": status,  # ok / error / timeout
+        "result": result,
+        "error": error,
+        "elapsed": round(elapsed, 3)
+    }
+
+
+def split_count(n: int, chunk_size: int) -> List[int]:
+    """n枚を chunk_size 枚ずつのサブリクエストに分割（例: 5, 2 → [2, 2, 1]）"""
+    chunk_size = max(1, chunk_size)
+    return [min(chunk_size, n - start) for start in range(0, max(0, n), chunk_size)]
+
+
+async def fan_out(items: Sequence[Any],
+                  worker: Callable[[Any], Awaitable[Any]],
+                  concurrency: int = FAN_OUT_SETTINGS["concurrency"],
+                  timeout: Optional[float] = FAN_OUT_SETTINGS["item_timeout"]) -> AsyncIterator[Dict]:
+    """非同期ワーカーを並列実行し、完了順に結果を返す"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(index: int, item: Any) -> Dict:
+        async with semaphore:
+            start_time = time.time()
+            try:
+                result = await asyncio.wait_for(worker(item), timeout) if timeout else await worker(item)
+                return _item_result(index, "ok", time.time() - start_time, result=result)
+            except asyncio.TimeoutError:
+                return _item_result(index, "timeout", time.time() - start_time,
+                                    error=f"タイムアウト（{timeout}秒）")
+            except Exception as e:
+                return _item_result(index, "error", time.time() - start_time, error=str(e))
+
+    tasks = [asyncio.ensure_future(run(i, item)) for i, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # 呼び出し側が途中で打ち切った場合は残りをキャンセル
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def fan_out_sync(items: Sequence[Any],
+                 worker: Callable[[Any], Any],
+                 concurrency: int = FAN_OUT_SETTINGS["concurrency"],
+                 timeout: Optional[float] = FAN_OUT_SETTINGS["item_timeout"]) -> Iterator[Dict]:
+    """同期ワーカーをスレッドで並列実行し、完了順に結果を返す
+
+    タイムアウトした項目は結果を待たずに打ち切る（実行中のスレッド自体は止められない）。
+    """
+    started: Dict[int, float] = {}
+
+    def run(index: int, item: Any) -> Any:
+        started[index] = time.time()
+        return worker(item)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        # スレッドプールはContextを引き継がないため、呼び出し元のトレースを項目ごとに複製して渡す
+        futures = {pool.submit(contextvars.copy_context().run, run, i, item): i for i, item in enumerate(items)}
+        pending = set(futures)
+
+        while pending:
+            done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                index = futures[future]
+                elapsed = time.time() - started.get(index, time.time())
+                try:
+                    yield _item_result(index, "ok", elapsed, result=future.result())
+                except Exception as e:
+                    yield _item_result(index, "error", elapsed, error=str(e))
+
+            if not timeout:
+                continue
+            now = time.time()
+            for future in list(pending):
+                index = futures[future]
+                if index in started and now - started[index] > timeout:
+                    pending.discard(future)
+                    future.cancel()
+                    yield _item_result(index, "timeout", now - started[index],
+                                       error=f"タイムアウト（{timeout}秒）")
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
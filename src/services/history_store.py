@@ -0,0 +1,226 @@
+"""生成履歴の容量制限付きストア
+
+履歴は画像バイト列と一時ファイルを保持するため、長時間稼働するSpaceではメモリと
+/tmp が際限なく増える。件数・バイト数の上限を超えた分は古いものから破棄し、
+一時ファイルも同時に削除する。同一内容の画像バッファは1つだけ保持して共有する。
+ギャラリー表示用のサムネイルは追加時に一度だけ作成する。
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from src.services.history_writer import HistoryWriter, get_history_writer
+from src.utils.config import HISTORY_SETTINGS
+
+
+class HistoryRecord:
+    """履歴1件分のコンパクトなレコード（画像バッファはストア内で共有）"""
+
+    __slots__ = ("record_id", "digest", "image_data", "prompt", "purpose", "style",
+                 "format", "timestamp", "temp_file", "write_future", "thumbnail_file", "thumbnail_future")
+
+    def __init__(self, record_id: int, digest: str, image_data: bytes, prompt: str, purpose: str,
+                 style: str, format: str, temp_file: str, write_future: Optional[Future] = None):
+        self.record_id = record_id
+        self.digest = digest
+        self.image_data = image_data
+        self.prompt = prompt
+        self.purpose = purpose
+        self.style = style
+        self.format = format
+        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
+        self.temp_file = temp_file
+        self.write_future = write_future
+        self.thumbnail_file: Optional[str] = None
+        self.thumbnail_future: Optional[Future] = None
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.image_data)
+
+
+def _remove_file(path: str):
+    """一時ファイルを削除（既に無い場合は無視）"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"履歴一時ファイル削除エラー: {e}")
+
+
+def sweep_orphaned_files(temp_dir: str = HISTORY_SETTINGS["temp_dir"],
+                         min_age: float = HISTORY_SETTINGS["orphan_min_age"]) -> int:
+    """前回プロセスが残した履歴一時ファイルを削除し、削除数を返す（起動時に実行）
+
+    他プロセスが書き込み中のファイルを消さないよう、min_age秒より新しいファイルは残す。
+    """
+    directory = Path(temp_dir)
+    if not directory.is_dir():
+        return 0
+    deadline = time.time() - min_age
+    removed = 0
+    for path in directory.iterdir():
+        try:
+            if path.is_file() and path.stat().st_mtime < deadline:
+                path.unlink()
+                removed += 1
+        except OSError as e:
+            print(f"履歴一時ファイル削除エラー: {e}")
+    if removed:
+        print(f"履歴一時ファイルを整理しました: {removed}件")
+    return removed
+
+
+class HistoryStore:
+    """件数・バイト数上限付きのLRU履歴ストア"""
+
+    def __init__(self,
+                 max_items: int = HISTORY_SETTINGS["max_items"],
+                 max_bytes: int = HISTORY_SETTINGS["max_bytes"],
+                 temp_dir: str = HISTORY_SETTINGS["temp_dir"],
+                 writer: Optional[HistoryWriter] = None):
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        self.temp_dir = temp_dir
+        self.writer = writer or get_history_writer()
+        self._records: "OrderedDict[int, HistoryRecord]" = OrderedDict()
+        self._buffers: Dict[str, bytes] = {}      # ダイジェスト → 共有バッファ
+        self._buffer_refs: Dict[str, int] = {}    # ダイジェスト → 参照レコード数
+        self._bytes = 0
+        self._next_id = 1
+        self._evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def add(self, image_data: bytes, prompt: str, purpose: str, style: str, format: str) -> HistoryRecord:
+        """画像を履歴に追加（ファイル書き込みはバックグラウンドで実行）"""
+        digest = hashlib.sha256(image_data).hexdigest()
+        temp_path = self._reserve_path(format)
+        thumbnail_path = self._reserve_path(HISTORY_SETTINGS["thumbnail_format"], prefix="thumb_")
+
+        with self._lock:
+            shared = self._buffers.get(digest)
+            if shared is None:
+                shared = self._buffers[digest] = image_data
+                self._bytes += len(image_data)
+            self._buffer_refs[digest] = self._buffer_refs.get(digest, 0) + 1
+
+            record = HistoryRecord(self._next_id, digest, shared, prompt, purpose, style, format, temp_path)
+            self._next_id += 1
+            # 破棄時に書き込み完了を待てるよう、登録前に書き込みを予約
+            _, record.write_future = self.writer.submit(shared, format, path=temp_path)
+            record.thumbnail_file, record.thumbnail_future = self.writer.submit_thumbnail(shared, path=thumbnail_path)
+            self._records[record.record_id] = record
+            evicted = self._evict_locked()
+
+        for old in evicted:
+            self._release_file(old)
+        return record
+
+    def _reserve_path(self, format: str, prefix: str = "tmp") -> str:
+        """専用ディレクトリに一時ファイルパスを確保"""
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix=f".{format}", dir=self.temp_dir)
+        os.close(fd)
+        return path
+
+    def get(self, record_id: int) -> Optional[HistoryRecord]:
+        """レコードを取得（最近使用として扱う）"""
+        with self._lock:
+            record = self._records.get(record_id)
+            if record is not None:
+                self._records.move_to_end(record_id)
+            return record
+
+    def recent(self, limit: Optional[int] = None) -> List[HistoryRecord]:
+        """生成の新しい順にレコードを取得（LRU順ではなく追加順）"""
+        with self._lock:
+            records = sorted(self._records.values(), key=lambda r: r.record_id, reverse=True)
+        return records[:limit] if limit else records
+
+    def clear(self):
+        """全レコードと一時ファイルを破棄"""
+        with self._lock:
+            records = list(self._records.values())
+            self._records.clear()
+            self._buffers.clear()
+            self._buffer_refs.clear()
+            self._bytes = 0
+        for record in records:
+            self._release_file(record)
+
+    def stats(self) -> Dict:
+        """履歴ストアの統計を取得"""
+        with self._lock:
+            return {
+                "items": len(self._records),
+                "max_items": self.max_items,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "shared_buffers": len(self._buffers),
+                "evictions": self._evictions
+            }
+
+    def buffer_sizes(self) -> Dict[int, int]:
+        """保持中の画像バッファ（id → バイト数）。編集ツリーと共有するバッファの重複計上を避けるため"""
+        with self._lock:
+            return {id(buffer): len(buffer) for buffer in self._buffers.values()}
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def trim(self, max_bytes: int, keep: Optional[Set[int]] = None) -> int:
+        """画像バイト数がmax_bytes以下になるまで古いレコードを破棄し、破棄件数を返す（最新1件は残す）
+
+        keepに含まれるバッファ（id）のレコードは残す（編集ツリーと共有し、破棄しても解放されないため）。
+        """
+        with self._lock:
+            evicted = self._evict_locked(max_bytes, keep)
+        for old in evicted:
+            self._release_file(old)
+        return len(evicted)
+
+    def _evict_locked(self, max_bytes: Optional[int] = None, keep: Optional[Set[int]] = None) -> List[HistoryRecord]:
+        """上限を超えた古いレコードを破棄（ロック取得済み前提、最新1件は必ず残す）"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes or None  # 0は無制限
+        evicted = []
+        while len(self._records) > 1 and (len(self._records) > self.max_items or
+                                          (max_bytes is not None and self._bytes > max_bytes)):
+            if keep:
+                candidates = list(self._records.values())[:-1]
+                record = next((r for r in candidates if id(r.image_data) not in keep), None)
+                if record is None:
+                    break
+                del self._records[record.record_id]
+            else:
+                _, record = self._records.popitem(last=False)
+            refs = self._buffer_refs.get(record.digest, 1) - 1
+            if refs <= 0:
+                self._buffer_refs.pop(record.digest, None)
+                self._bytes -= len(self._buffers.pop(record.digest, b""))
+            else:
+                self._buffer_refs[record.digest] = refs
+            self._evictions += 1
+            evicted.append(record)
+        return evicted
+
+    @staticmethod
+    def _release_file(record: HistoryRecord):
+        """レコードの一時ファイル・サムネイルを削除（書き込み中なら完了後に削除）"""
+        for path, future in ((record.temp_file, record.write_future),
+                             (record.thumbnail_file, record.thumbnail_future)):
+            if path is None:
+                continue
+            if future is not None and not future.done():
+                future.add_done_callback(lambda _, path=path: _remove_file(path))
+            else:
+                _remove_file(path)
@@ -0,0 +1,249 @@
+"""履歴画像のライトビハインド保存
+
+生成結果の保存のたびにPILでデコード・再エンコードすると、n枚・大サイズの場合に
+数秒単位のCPU時間がハンドラの応答前に発生する。保存先パスだけを同期的に確保し、
+書き込みはバックグラウンドスレッドで行う。要求形式と一致するバイト列はそのまま書き出し、
+形式が異なる場合のみ再エンコードする。履歴ギャラリー用のサムネイルも挿入時に一度だけ作成する。
+再エンコード・縮小は画像処理プロセス（image_executor）に投入し、完了を待たずに次の書き込みへ進む。
+"""
+
+import contextvars
+import itertools
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+from src.services.image_executor import get_image_executor
+from src.utils.config import HISTORY_SETTINGS
+from src.utils.image_utils import convert_image_format, render_thumbnail
+from src.utils.tracing import record_span
+
+
+def detect_image_format(data: bytes) -> Optional[str]:
+    """マジックバイトから画像形式を判定（png / jpeg / webp、不明はNone）"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def _normalize_format(format: str) -> str:
+    """形式名を正規化（jpg → jpeg）"""
+    format = (format or "png").lower()
+    return "jpeg" if format == "jpg" else format
+
+
+def _write_bytes(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def write_image_file(path: str, image_data: bytes, format: str) -> bool:
+    """画像を保存（形式が一致すればそのまま書き出し）。再エンコードした場合はTrue"""
+    format = _normalize_format(format)
+    if detect_image_format(image_data) == format:
+        _write_bytes(path, image_data)
+        return False
+
+    # JPEGは透過非対応のため白背景に合成（デコード・エンコードは画像処理プロセスで実行）
+    _write_bytes(path, get_image_executor().run(convert_image_format, image_data, format, None))
+    return True
+
+
+def write_thumbnail_file(path: str, image_data: bytes,
+                         max_size: int = HISTORY_SETTINGS["thumbnail_size"],
+                         format: str = HISTORY_SETTINGS["thumbnail_format"],
+                         quality: int = HISTORY_SETTINGS["thumbnail_quality"]):
+    """長辺max_sizeの縮小画像を保存（縮小は画像処理プロセスで実行）"""
+    format = _normalize_format(format)
+    _write_bytes(path, get_image_executor().run(render_thumbnail, image_data, max_size, format, quality))
+
+
+# 書き込みの優先度（小さいほど先）。表示に使う画像本体をサムネイルより先に書き込む
+_PRIORITY_IMAGE = 0
+_PRIORITY_THUMBNAIL = 1
+_PRIORITY_FLUSH = 2
+
+
+class _WriteTask:
+    """1件の書き込み（画像本体またはサムネイル）"""
+
+    __slots__ = ("thumbnail", "path", "image_data", "format", "future", "context", "start_time")
+
+    def __init__(self, thumbnail: bool, path: str, image_data: bytes, format: Optional[str], future: Future,
+                 context: contextvars.Context):
+        self.thumbnail = thumbnail
+        self.path = path
+        self.image_data = image_data
+        self.format = format
+        self.future = future
+        self.context = context  # 呼び出し元のトレースに書き込み時間を記録するため、Contextを引き継ぐ
+        self.start_time = 0.0
+
+    @property
+    def priority(self) -> int:
+        return _PRIORITY_THUMBNAIL if self.thumbnail else _PRIORITY_IMAGE
+
+
+class HistoryWriter:
+    """保存先パスを即時に返し、書き込みはバックグラウンドで行うライター
+
+    書き込みスレッドは再エンコード・縮小を画像処理プロセスに投入するだけで完了を待たず、
+    結果が届いた時点でファイルに書き出す（複数セッションの画像をワーカー数まで並列に処理）。
+    キューは優先度付きで、画像本体の書き込みをサムネイルより先に行う。
+    """
+
+    def __init__(self, temp_dir: Optional[str] = None):
+        self.temp_dir = temp_dir
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._stats = {"written": 0, "reencoded": 0, "thumbnails": 0, "errors": 0, "bytes": 0, "write_time": 0.0}
+
+    def reserve_path(self, format: str) -> str:
+        """保存先の一時ファイルパスを確保（ファイルは空で作成される）"""
+        fd, path = tempfile.mkstemp(suffix=f".{_normalize_format(format)}", dir=self.temp_dir)
+        os.close(fd)
+        return path
+
+    def submit(self, image_data: bytes, format: str, path: Optional[str] = None) -> Tuple[str, Future]:
+        """書き込みを予約し、(保存先パス, 完了Future) を返す"""
+        path = path or self.reserve_path(format)
+        return path, self._submit(_WriteTask(False, path, image_data, format, Future(), contextvars.copy_context()))
+
+    def submit_thumbnail(self, image_data: bytes, path: Optional[str] = None) -> Tuple[str, Future]:
+        """サムネイル作成を予約し、(保存先パス, 完了Future) を返す"""
+        path = path or self.reserve_path(HISTORY_SETTINGS["thumbnail_format"])
+        return path, self._submit(_WriteTask(True, path, image_data, None, Future(), contextvars.copy_context()))
+
+    def _submit(self, task: _WriteTask) -> Future:
+        with self._lock:
+            self._pending += 1
+        self._ensure_worker()
+        self._put(task.priority, self._dispatch, task)
+        return task.future
+
+    def _put(self, priority: int, step, *args):
+        self._queue.put((priority, next(self._sequence), step, args))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """予約済みの書き込み（画像処理プロセスで処理中のものを含む）が全て完了するまで待機"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stats(self) -> Dict:
+        """書き込み統計を取得"""
+        with self._lock:
+            stats = dict(self._stats, pending=self._pending)
+        stats["write_time"] = round(stats["write_time"], 3)
+        return stats
+
+    def _ensure_worker(self):
+        """書き込みスレッドを起動（初回のみ）"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+
+    def _dispatch(self, task: _WriteTask):
+        """そのまま書き出せる画像は書き込み、再エンコード・縮小は画像処理プロセスに投入（完了は待たない）"""
+        if not task.future.set_running_or_notify_cancel():
+            self._done()
+            return
+        task.start_time = time.time()
+        if task.thumbnail:
+            encoded = get_image_executor().submit(
+                render_thumbnail, task.image_data, HISTORY_SETTINGS["thumbnail_size"],
+                _normalize_format(HISTORY_SETTINGS["thumbnail_format"]), HISTORY_SETTINGS["thumbnail_quality"]
+            )
+        elif detect_image_format(task.image_data) == _normalize_format(task.format):
+            self._finish(task, task.image_data, False)
+            return
+        else:
+            # JPEGは透過非対応のため白背景に合成
+            encoded = get_image_executor().submit(convert_image_format, task.image_data,
+                                                  _normalize_format(task.format), None)
+        # 結果はプロセスプールの管理スレッドで受け取るため、書き込みはこのスレッドに戻して行う
+        encoded.add_done_callback(lambda future: self._put(task.priority, self._write_encoded, task, future))
+
+    def _write_encoded(self, task: _WriteTask, encoded: Future):
+        try:
+            data = encoded.result()
+        except Exception as e:
+            self._fail(task, e)
+            return
+        self._finish(task, data, not task.thumbnail)
+
+    def _finish(self, task: _WriteTask, data: bytes, reencoded: bool):
+        """変換済みのバイト列を書き出して完了を通知"""
+        try:
+            _write_bytes(task.path, data)
+        except Exception as e:
+            self._fail(task, e)
+            return
+
+        elapsed = time.time() - task.start_time
+        if task.thumbnail:
+            task.context.run(record_span, "thumbnail_write", elapsed, bytes=len(task.image_data))
+        else:
+            task.context.run(record_span, "history_file_write", elapsed, bytes=len(task.image_data),
+                             format=task.format, reencoded=reencoded)
+        with self._lock:
+            if task.thumbnail:
+                self._stats["thumbnails"] += 1
+            else:
+                self._stats["written"] += 1
+                self._stats["reencoded"] += int(reencoded)
+                self._stats["bytes"] += len(task.image_data)
+            self._stats["write_time"] += elapsed
+        task.future.set_result(task.path)
+        self._done()
+
+    def _fail(self, task: _WriteTask, error: Exception):
+        with self._lock:
+            self._stats["errors"] += 1
+        print(f"履歴画像保存エラー: {error}")
+        task.future.set_exception(error)
+        self._done()
+
+    def _done(self):
+        with self._idle:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _run(self):
+        """書き込みキューを優先度順に処理"""
+        while True:
+            _, _, step, args = self._queue.get()
+            try:
+                step(*args)
+            except Exception as e:
+                print(f"履歴画像保存エラー: {e}")
+
+
+# プロセス共有のデフォルトライター
+_default_writer: Optional[HistoryWriter] = None
+_default_writer_lock = threading.Lock()
+
+
+def get_history_writer() -> HistoryWriter:
+    """プロセス共有の履歴ライターを取得"""
+    global _default_writer
+    if _default_writer is None:
+        with _default_writer_lock:
+            if _default_writer is None:
+                _default_writer = HistoryWriter()
+    return _default_writer
@@ -0,0 +1,200 @@
+"""Pillowによる画像処理のプロセスプール実行
+
+形式変換・透過画像の白背景合成・部分画像のデコード・参照画像のPNGエンコード・
+サムネイル作成はCPU処理で、スレッドで実行してもGILを奪い合うため、同時リクエスト時に
+直列化して遅延の裾が伸びる。これらを専用のプロセスプールで実行する。
+
+- 画像バイト列は共有メモリで受け渡し、pickleでコピーしない（引数・メタ情報のみpickle）
+- 処理関数はモジュールのトップレベル関数で、(data: bytes, *args) を受け取り
+  bytes または (bytes, dict) を返すこと（ワーカーは処理関数のモジュールを読み込んで実行する）
+- 複数画像はmap/amapでまとめて投入し、ワーカー数まで並列に処理する
+- ワーカー数0・小さな画像・プールの異常終了時は呼び出し元のスレッドで実行する
+"""
+
+import asyncio
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from src.utils.config import IMAGE_EXECUTOR_SETTINGS
+from src.utils.tracing import span
+
+# 共有メモリのハンドル: (名前, バイト数)。空データは名前None
+_Handle = Tuple[Optional[str], int]
+
+
+def _to_shared(data: bytes) -> Tuple[_Handle, Optional[shared_memory.SharedMemory]]:
+    """バイト列を共有メモリに書き込む（作成側がunlinkする）"""
+    if not data:
+        return (None, 0), None
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return (shm.name, len(data)), shm
+
+
+def _read_shared(handle: _Handle, unlink: bool = False) -> bytes:
+    """共有メモリからバイト列を取り出す"""
+    name, size = handle
+    if name is None:
+        return b""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _release(shm: Optional[shared_memory.SharedMemory]):
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def _invoke(fn: Callable, handle: _Handle, args: tuple) -> Tuple[_Handle, Optional[Dict], bool]:
+    """ワーカープロセス側: 入力を共有メモリから読み、結果を新しい共有メモリに書いて返す"""
+    result = fn(_read_shared(handle), *args)
+    payload, meta = result if isinstance(result, tuple) else (result, None)
+    output, shm = _to_shared(payload or b"")
+    if shm is not None:
+        shm.close()  # 受け取った親プロセスがunlinkする
+    return output, meta, isinstance(result, tuple)
+
+
+def _unpack(output: _Handle, meta: Optional[Dict], is_tuple: bool):
+    data = _read_shared(output, unlink=True)
+    return (data, meta) if is_tuple else data
+
+
+class ImageExecutor:
+    """画像処理用のプロセスプール（初回投入時に起動）"""
+
+    def __init__(self,
+                 workers: int = IMAGE_EXECUTOR_SETTINGS["workers"],
+                 inline_max_bytes: int = IMAGE_EXECUTOR_SETTINGS["inline_max_bytes"]):
+        self.workers = max(0, workers)
+        self.inline_max_bytes = inline_max_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats = {"offloaded": 0, "inline": 0, "bytes": 0, "restarts": 0}
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers == 0:
+            return None
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # Gradio・uvicornのスレッドを抱えたままforkしないようspawnで起動
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _restart(self, pool: ProcessPoolExecutor):
+        """異常終了したプールを破棄（次回の投入で作り直す）"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+                self._stats["restarts"] += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn: Callable, data: bytes, *args) -> Future:
+        """処理を投入し、結果（bytes または (bytes, dict)）のFutureを返す"""
+        pool = self._get_pool()
+        if pool is None or len(data) <= self.inline_max_bytes:
+            return self._inline(fn, data, args)
+
+        handle, shm = _to_shared(data)
+        try:
+            inner = pool.submit(_invoke, fn, handle, args)
+        except (BrokenProcessPool, RuntimeError):
+            # 異常終了・停止済みのプール（次回の投入で作り直す）
+            _release(shm)
+            self._restart(pool)
+            return self._inline(fn, data, args)
+        self._count("offloaded")
+        self._count("bytes", len(data))
+
+        outer: Future = Future()
+
+        def done(inner_future: Future):
+            _release(shm)
+            try:
+                outer.set_result(_unpack(*inner_future.result()))
+            except BrokenProcessPool:
+                # ワーカーが落ちた場合はプールを作り直し、この処理はスレッドで実行
+                self._restart(pool)
+                try:
+                    outer.set_result(fn(data, *args))
+                except Exception as e:
+                    outer.set_exception(e)
+            except Exception as e:
+                outer.set_exception(e)
+
+        inner.add_done_callback(done)
+        return outer
+
+    def _inline(self, fn: Callable, data: bytes, args: tuple) -> Future:
+        """呼び出し元のスレッドで実行し、完了済みのFutureを返す"""
+        self._count("inline")
+        future: Future = Future()
+        try:
+            future.set_result(fn(data, *args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def run(self, fn: Callable, data: bytes, *args) -> Any:
+        """同期実行（結果が出るまで待機）"""
+        with span("image_process", op=fn.__name__, bytes=len(data)):
+            return self.submit(fn, data, *args).result()
+
+    async def arun(self, fn: Callable, data: bytes, *args) -> Any:
+        """非同期実行（イベントループをブロックしない）"""
+        with span("image_process", op=fn.__name__, bytes=len(data)):
+            return await asyncio.wrap_future(self.submit(fn, data, *args))
+
+    def map(self, fn: Callable, items: Sequence[bytes], *args) -> List[Any]:
+        """複数画像をまとめて投入し、入力順に結果を返す（同期）"""
+        with span("image_process", op=fn.__name__, images=len(items), bytes=sum(len(d) for d in items)):
+            futures = [self.submit(fn, data, *args) for data in items]
+            return [future.result() for future in futures]
+
+    async def amap(self, fn: Callable, items: Sequence[bytes], *args) -> List[Any]:
+        """複数画像をまとめて投入し、入力順に結果を返す（非同期）"""
+        with span("image_process", op=fn.__name__, images=len(items), bytes=sum(len(d) for d in items)):
+            futures = [asyncio.wrap_future(self.submit(fn, data, *args)) for data in items]
+            return list(await asyncio.gather(*futures))
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, workers=self.workers, running=self._pool is not None)
+
+
+_default_executor: Optional[ImageExecutor] = None
+_default_executor_lock = threading.Lock()
+
+
+def get_image_executor() -> ImageExecutor:
+    """プロセス共有の画像処理エグゼキューターを取得"""
+    global _default_executor
+    if _default_executor is None:
+        with _default_executor_lock:
+            if _default_executor is None:
+                _default_executor = ImageExecutor()
+                atexit.register(_default_executor.shutdown)
+    return _default_executor
@@ -1,14 +1,36 @@
-from openai import OpenAI
-import base64
-from typing import Dict, Optional, List
+from src.services.client_pool import get_openai_client, get_async_openai_client
+from src.services.result_cache import ResultCache, get_result_cache, make_cache_key
+from src.services.fan_out import fan_out, fan_out_sync, split_count
+from src.services.rate_limit import (api_endpoint_name, api_key_id, get_retry_scheduler, rate_limit_group,
+                                     rewind_uploads, upload_size)
+from src.services.single_flight import get_single_flight
+from src.utils.config import FAN_OUT_SETTINGS
+from src.services.image_executor import get_image_executor
+from src.utils.image_utils import convert_image_format, decode_response_image, decode_response_images
+from src.utils.tracing import span
+import asyncio
+from typing import AsyncIterator, Dict, Iterator, Optional, List
 import time
 
 class ImageGenerator:
     """GPT Image 1を使用した画像生成サービス"""
     
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        
+    def __init__(self, api_key: str, result_cache: Optional[ResultCache] = None):
+        self.client = get_openai_client(api_key)  # 共有レジストリから取得（接続再利用）
+        # 結果キャッシュ（未指定時は設定で有効な場合のみ共有キャッシュを使用）
+        self.result_cache = result_cache if result_cache is not None else get_result_cache()
+        # 実行中の同一リクエストを合流させる（APIキー単位。失敗が他のキーの利用者に波及しないように）
+        self.single_flight = get_single_flight("images", async_mode=False)
+        self._key_id = api_key_id(api_key)
+    
+    def _call_api(self, method, **kwargs):
+        """API呼び出し（レート制限を考慮した再試行付き。ファイル引数は試行ごとに先頭へ戻す）"""
+        def attempt():
+            rewind_uploads(kwargs)
+            return method(**kwargs)
+        with span("api_call", endpoint=api_endpoint_name(method), upload_bytes=upload_size(kwargs)):
+            return get_retry_scheduler().call(self._key_id, attempt, group=rate_limit_group(method))
+    
     def generate_image(self,
                       prompt: str,
                       size: str = "1024x1024",
@@ -25,71 +47,125 @@ class ImageGenerator:
             # 実際のコスト計算をアプリ側で行うため、プレースホルダーのみ
             cost_estimate = {"cost_usd": "計算中", "cost_jpy": "計算中", "tokens": "N/A"}
             
-            # 生成パラメータの準備
-            generation_params = {
-                "model": "gpt-image-1",
-                "prompt": prompt,
-                "size": size,
-                "quality": quality,
-                "n": max(1, min(n, 10))  # 1-10の範囲で制限
-            }
+            generation_params = self._build_generation_params(
+                prompt, size, quality, format, transparent_bg, output_compression, moderation, n
+            )
             
-            # オプションパラメータの追加（SDK互換性考慮）
-            if format != "png":
-                generation_params["format"] = format
+            # 同一パラメータの結果がキャッシュにあれば再利用（API呼び出しなし）
+            cache_key = self._make_cache_key(generation_params, format, moderation)
+            if cache_key is not None:
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+            
+            def generate() -> Dict:
+                # 参考画像がある場合もプロンプトに含めて通常生成
+                result = self._generate_simple(generation_params, cost_estimate, format, output_compression)
+                result["cache_hit"] = False
                 
-            if transparent_bg and format in ["png", "webp"]:
-                generation_params["background"] = "transparent"
-            
-            # 圧縮設定（JPEG/WebPのみ有効）
-            if output_compression is not None and format in ["jpeg", "webp"]:
-                if 0 <= output_compression <= 100:
-                    generation_params["output_compression"] = output_compression
-                else:
-                    raise ValueError("output_compressionは0-100の範囲で指定してください")
-            
-            # モデレーション設定
-            if moderation in ["auto", "low"]:
-                generation_params["moderation"] = moderation
-            elif moderation != "auto":
-                raise ValueError("moderationは'auto'または'low'で指定してください")
-            
-            # 参考画像がある場合もプロンプトに含めて通常生成
-            return self._generate_simple(generation_params, cost_estimate, format, output_compression)
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, result, format)
+                return result
+            
+            # 同一パラメータの呼び出しが実行中なら合流（API呼び出しは1回）
+            result, shared = self.single_flight.do(
+                self._flight_key("generate", generation_params, format, moderation), generate
+            )
+            return self._coalesced_result(result, shared)
                 
         except Exception as e:
             raise Exception(f"画像生成エラー: {str(e)}")
     
+    def _build_generation_params(self, prompt: str, size: str, quality: str, format: str,
+                                 transparent_bg: bool, output_compression: Optional[int],
+                                 moderation: str, n: int) -> Dict:
+        """images.generate用パラメータを構築"""
+        generation_params = {
+            "model": "gpt-image-1",
+            "prompt": prompt,
+            "size": size,
+            "quality": quality,
+            "n": max(1, min(n, 10))  # 1-10の範囲で制限
+        }
+        
+        # オプションパラメータの追加（SDK互換性考慮）
+        if format != "png":
+            generation_params["format"] = format
+            
+        if transparent_bg and format in ["png", "webp"]:
+            generation_params["background"] = "transparent"
+        
+        # 圧縮設定（JPEG/WebPのみ有効）
+        if output_compression is not None and format in ["jpeg", "webp"]:
+            if 0 <= output_compression <= 100:
+                generation_params["output_compression"] = output_compression
+            else:
+                raise ValueError("output_compressionは0-100の範囲で指定してください")
+        
+        # モデレーション設定
+        if moderation in ["auto", "low"]:
+            generation_params["moderation"] = moderation
+        elif moderation != "auto":
+            raise ValueError("moderationは'auto'または'low'で指定してください")
+        
+        return generation_params
+    
+    def _make_cache_key(self, params: Dict, format: str, moderation: str) -> Optional[str]:
+        """結果キャッシュのキーを作成（キャッシュ無効時はNone）"""
+        if self.result_cache is None:
+            return None
+        return self._canonical_key(params, format, moderation)
+    
+    @staticmethod
+    def _canonical_key(params: Dict, format: str, moderation: str) -> str:
+        """生成パラメータの正規化キー"""
+        return make_cache_key(
+            params["prompt"], params["size"], params["quality"], format,
+            params.get("background", "auto"),
+            params.get("output_compression"),
+            moderation, params["n"]
+        )
+    
+    def _flight_key(self, kind: str, params: Dict, format: str, moderation: str) -> str:
+        """single-flight用のキー（APIキー + 呼び出し種別 + 正規化パラメータ）"""
+        return f"{self._key_id}:{kind}:{self._canonical_key(params, format, moderation)}"
+    
+    @staticmethod
+    def _coalesced_result(result: Dict, shared: bool) -> Dict:
+        """合流した呼び出し側には共有結果の浅いコピーに印を付けて返す"""
+        if not shared:
+            return result
+        return dict(result, coalesced=True)
+    
     def _generate_simple(self, params: Dict, cost_estimate: Dict, target_format: str = "png", compression: int = None) -> Dict:
         """シンプルな画像生成（format互換性対応）"""
         start_time = time.time()
         
         try:
             # 新しいSDKでformat引数を試行
-            response = self.client.images.generate(**params)
+            response = self._call_api(self.client.images.generate, **params)
         except TypeError as e:
             if 'format' in str(e) or 'output_compression' in str(e):
                 # 古いSDKの場合：format関連パラメータを除去してPNGで生成
-                fallback_params = {k: v for k, v in params.items() 
-                                 if k not in ['format', 'output_compression', 'background']}
-                response = self.client.images.generate(**fallback_params)
+                response = self._call_api(self.client.images.generate, **self._fallback_params(params))
                 # 後でPILで形式変換する（実装は後述）
             else:
                 raise
         
         generation_time = time.time() - start_time
-        
+        return self._build_images_result(response, params, generation_time, cost_estimate, target_format, compression)
+    
+    def _build_images_result(self, response, params: Dict, generation_time: float, cost_estimate: Dict,
+                             target_format: str = "png", compression: int = None) -> Dict:
+        """images.generateのレスポンスから結果を構築"""
         # 画像データの取得（複数対応）
-        images = []
-        for data in response.data:
-            image_base64 = data.b64_json
-            image_data = base64.b64decode(image_base64)
-            
-            # 形式変換が必要な場合（古いSDK対応）
-            if target_format != "png" and target_format in ["jpeg", "webp"]:
-                image_data = self._convert_image_format(image_data, target_format, compression)
-            
-            images.append(image_data)
+        # デコード済みのBase64は順に解放（n枚・大サイズでもピークメモリを抑える）
+        images = decode_response_images(response.data)
+        
+        # 形式変換が必要な場合（古いSDK対応）。複数画像はまとめて画像処理プロセスに投入
+        if target_format != "png" and target_format in ["jpeg", "webp"]:
+            with span("format_convert", format=target_format, bytes=sum(len(data) for data in images)):
+                images = self._convert_image_formats(images, target_format, compression)
         
         # 単一画像の場合は従来の形式を保持（互換性）
         if len(images) == 1:
@@ -113,6 +189,12 @@ class ImageGenerator:
                 "prompt": params.get('prompt', '')
             }
     
+    @staticmethod
+    def _fallback_params(params: Dict) -> Dict:
+        """古いSDK向けにformat関連パラメータを除去"""
+        return {k: v for k, v in params.items()
+                if k not in ['format', 'output_compression', 'background']}
+    
     def generate_with_reference_image(self,
                                     prompt: str,
                                     reference_image_data: bytes,
@@ -127,70 +209,192 @@ class ImageGenerator:
         try:
             start_time = time.time()
             
-            # 画像データをファイルライクオブジェクトに変換
-            from io import BytesIO
-            image_file = BytesIO(reference_image_data)
-            image_file.name = "reference.png"
-            
-            # 生成パラメータの準備（Image Edit APIは基本パラメータのみ）
-            edit_params = {
-                "model": "gpt-image-1",
-                "image": image_file,
-                "prompt": prompt,
-                "size": size,
-                "quality": quality
-            }
-            
-            # Image Edit APIはresponse_formatとoutput_compressionをサポートしていない
-            # PNG以外が必要な場合は後でconvertするか、images.generateにフォールバック
-            # 現在はPNGのみ対応
-            
-            # モデレーション設定（Image Edit APIではサポートされていない可能性があるため注意）
-            # if moderation in ["auto", "low"]:
-            #     edit_params["moderation"] = moderation
-            
-            response = self.client.images.edit(**edit_params)
+            edit_params = self._build_reference_params(prompt, reference_image_data, size, quality)
+            response = self._call_api(self.client.images.edit, **edit_params)
             
             generation_time = time.time() - start_time
+            return self._build_reference_result(response, prompt, generation_time)
             
-            # 画像データの取得
-            image_base64 = response.data[0].b64_json
-            image_data = base64.b64decode(image_base64)
+        except Exception as e:
+            raise Exception(f"参照画像生成エラー: {str(e)}")
+    
+    @staticmethod
+    def _build_reference_params(prompt: str, reference_image_data: bytes, size: str, quality: str) -> Dict:
+        """images.edit用パラメータを構築"""
+        # 画像データをファイルライクオブジェクトに変換
+        from io import BytesIO
+        image_file = BytesIO(reference_image_data)
+        image_file.name = "reference.png"
+        
+        # 生成パラメータの準備（Image Edit APIは基本パラメータのみ）
+        edit_params = {
+            "model": "gpt-image-1",
+            "image": image_file,
+            "prompt": prompt,
+            "size": size,
+            "quality": quality
+        }
+        
+        # Image Edit APIはresponse_formatとoutput_compressionをサポートしていない
+        # PNG以外が必要な場合は後でconvertするか、images.generateにフォールバック
+        # 現在はPNGのみ対応
+        
+        # モデレーション設定（Image Edit APIではサポートされていない可能性があるため注意）
+        # if moderation in ["auto", "low"]:
+        #     edit_params["moderation"] = moderation
+        
+        return edit_params
+    
+    @staticmethod
+    def _build_reference_result(response, prompt: str, generation_time: float) -> Dict:
+        """images.editのレスポンスから結果を構築"""
+        # 画像データの取得
+        image_data = decode_response_image(response.data[0])
+        
+        return {
+            "image_data": image_data,
+            "generation_time": round(generation_time, 2),
+            "estimated_cost": "参照画像生成のため計算複雑",
+            "tokens_used": "N/A",
+            "revised_prompt": getattr(response.data[0], 'revised_prompt', None),
+            "prompt": prompt,
+            "generation_type": "reference_image"
+        }
+    
+    
+    def generate_image_split(self,
+                             prompt: str,
+                             size: str = "1024x1024",
+                             quality: str = "auto",
+                             format: str = "png",
+                             transparent_bg: bool = False,
+                             output_compression: Optional[int] = None,
+                             moderation: str = "auto",
+                             n: int = 1,
+                             chunk_size: Optional[int] = None,
+                             concurrency: Optional[int] = None,
+                             timeout: Optional[float] = None) -> Dict:
+        """n枚の生成を並列サブリクエストに分割して実行し、1つの結果にまとめる"""
+        
+        try:
+            cost_estimate = {"cost_usd": "計算中", "cost_jpy": "計算中", "tokens": "N/A"}
+            params = self._build_generation_params(
+                prompt, size, quality, format, transparent_bg, output_compression, moderation, n
+            )
+            chunks = split_count(params["n"], chunk_size or FAN_OUT_SETTINGS["split_chunk_size"])
+            
+            cache_key = self._make_cache_key(params, format, moderation)
+            if cache_key is not None:
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+            
+            def generate() -> Dict:
+                # サブリクエストはキャッシュを経由しない（同一画像の重複返却を防ぐ）
+                start_time = time.time()
+                outcomes = list(fan_out_sync(
+                    [dict(params, n=count) for count in chunks],
+                    lambda sub_params: self._generate_simple(sub_params, cost_estimate, format, output_compression),
+                    concurrency or FAN_OUT_SETTINGS["concurrency"],
+                    timeout or FAN_OUT_SETTINGS["item_timeout"]
+                ))
+                result = self._merge_split_results(outcomes, params, time.time() - start_time, cost_estimate)
+                
+                if cache_key is not None and not result["failed_requests"]:
+                    self.result_cache.put(cache_key, result, format)
+                return result
             
-            return {
-                "image_data": image_data,
-                "generation_time": round(generation_time, 2),
-                "estimated_cost": "参照画像生成のため計算複雑",
-                "tokens_used": "N/A",
-                "revised_prompt": getattr(response.data[0], 'revised_prompt', None),
-                "prompt": prompt,
-                "generation_type": "reference_image"
-            }
+            result, shared = self.single_flight.do(self._flight_key("split", params, format, moderation), generate)
+            return self._coalesced_result(result, shared)
             
         except Exception as e:
-            raise Exception(f"参照画像生成エラー: {str(e)}")
+            raise Exception(f"画像生成エラー: {str(e)}")
+    
+    @staticmethod
+    def _merge_split_results(outcomes: List[Dict], params: Dict, generation_time: float, cost_estimate: Dict) -> Dict:
+        """分割サブリクエストの結果を1つにまとめる（失敗はfailed_requestsに記録）"""
+        images = []
+        revised_prompt = None
+        failed_requests = []
+        
+        for outcome in sorted(outcomes, key=lambda o: o["index"]):
+            if outcome["status"] != "ok":
+                failed_requests.append({"index": outcome["index"], "status": outcome["status"], "error": outcome["error"]})
+                continue
+            sub_result = outcome["result"]
+            images.extend(sub_result["images"] if "images" in sub_result else [sub_result["image_data"]])
+            revised_prompt = revised_prompt or sub_result.get("revised_prompt")
+        
+        if not images:
+            raise Exception(failed_requests[0]["error"] if failed_requests else "画像生成に失敗しました")
+        
+        result = {
+            "generation_time": round(generation_time, 2),
+            "estimated_cost": f"${cost_estimate['cost_usd']} (¥{cost_estimate['cost_jpy']})",
+            "tokens_used": cost_estimate['tokens'],
+            "revised_prompt": revised_prompt,
+            "prompt": params.get('prompt', ''),
+            "requested_count": params["n"],
+            "failed_requests": failed_requests,
+            "cache_hit": False
+        }
+        if len(images) == 1:
+            result["image_data"] = images[0]
+        else:
+            result["images"] = images
+            result["image_count"] = len(images)
+        return result
     
+    def generate_batch(self,
+                       requests: List[Dict],
+                       concurrency: Optional[int] = None,
+                       timeout: Optional[float] = None) -> Iterator[Dict]:
+        """複数の生成リクエスト（generate_imageの引数辞書）を並列実行し、完了順に結果を返す"""
+        return fan_out_sync(
+            requests,
+            lambda request: self.generate_image(**request),
+            concurrency or FAN_OUT_SETTINGS["concurrency"],
+            timeout or FAN_OUT_SETTINGS["item_timeout"]
+        )
     
-    def generate_variations(self, original_prompt: str, num_variations: int = 3, **kwargs) -> List[Dict]:
-        """バリエーション生成"""
-        variations = []
+    def generate_variations(self, original_prompt: str, num_variations: int = 3,
+                            concurrency: Optional[int] = None, timeout: Optional[float] = None, **kwargs) -> List[Dict]:
+        """バリエーション生成（並列実行、失敗は項目ごとにerror付きで返す）"""
+        prompts = self._variation_prompts(original_prompt, num_variations)
+        variations = [None] * len(prompts)
         
+        for outcome in self.generate_batch([dict(kwargs, prompt=p) for p in prompts], concurrency, timeout):
+            variations[outcome["index"]] = self._variation_entry(outcome)
+                
+        return variations
+    
+    @staticmethod
+    def _variation_entry(outcome: Dict) -> Dict:
+        """ファンアウト結果をバリエーション結果に変換"""
+        variation_number = outcome["index"] + 1
+        if outcome["status"] == "ok":
+            result = outcome["result"]
+            result['variation_number'] = variation_number
+            result['status'] = "ok"
+            return result
+        
+        # 失敗は出力せず、status・error付きの項目として呼び出し元に返す
+        return {
+            "variation_number": variation_number,
+            "status": outcome["status"],
+            "error": outcome["error"]
+        }
+    
+    
+    @staticmethod
+    def _variation_prompts(original_prompt: str, num_variations: int) -> List[str]:
+        """バリエーション用プロンプトを作成"""
         variation_prompts = [
             f"{original_prompt}, variation 1 with different composition",
             f"{original_prompt}, variation 2 with different color scheme", 
             f"{original_prompt}, variation 3 with different style approach"
         ]
-        
-        for i, prompt in enumerate(variation_prompts[:num_variations]):
-            try:
-                result = self.generate_image(prompt=prompt, **kwargs)
-                result['variation_number'] = i + 1
-                variations.append(result)
-            except Exception as e:
-                print(f"バリエーション{i+1}の生成に失敗: {e}")
-                
-        return variations
-    
+        return variation_prompts[:num_variations]
     
     def validate_prompt(self, prompt: str) -> Dict:
         """プロンプトの妥当性チェック"""
@@ -252,7 +456,8 @@ class ImageGenerator:
             image_file = BytesIO(image_data)
             image_file.name = "image.png"
             
-            response = self.client.images.edit(
+            response = self._call_api(
+                self.client.images.edit,
                 model="gpt-image-1",
                 image=image_file,
                 prompt=prompt,
@@ -263,8 +468,7 @@ class ImageGenerator:
             generation_time = time.time() - start_time
             
             # 画像データの取得（base64形式）
-            image_base64 = response.data[0].b64_json
-            image_data = base64.b64decode(image_base64)
+            image_data = decode_response_image(response.data[0])
             
             return {
                 "image_data": image_data,
@@ -292,7 +496,8 @@ class ImageGenerator:
             image_file.name = "image.png"
             
             # バリエーション生成APIはqualityパラメータをサポートしていない
-            response = self.client.images.create_variation(
+            response = self._call_api(
+                self.client.images.create_variation,
                 image=image_file,
                 n=1,
                 size=variation_size
@@ -302,8 +507,7 @@ class ImageGenerator:
             
             # 画像データの取得（base64形式またはURL）
             if hasattr(response.data[0], 'b64_json') and response.data[0].b64_json:
-                image_base64 = response.data[0].b64_json
-                image_data = base64.b64decode(image_base64)
+                image_data = decode_response_image(response.data[0])
             else:
                 # URLから画像をダウンロード
                 import requests
@@ -321,48 +525,274 @@ class ImageGenerator:
         except Exception as e:
             raise Exception(f"バリエーション生成エラー: {str(e)}")
     
+    def _convert_image_formats(self, images: List[bytes], target_format: str, compression: int = None) -> List[bytes]:
+        """複数画像の形式変換（失敗した画像は元のデータのまま）"""
+        try:
+            return get_image_executor().map(convert_image_format, images, target_format, compression)
+        except Exception as e:
+            print(f"画像形式変換エラー: {e}")
+            return [self._convert_image_format(data, target_format, compression) for data in images]
+    
     def _convert_image_format(self, image_data: bytes, target_format: str, compression: int = None) -> bytes:
-        """PIL使用して画像形式を変換（古いSDK対応）"""
+        """PIL使用して画像形式を変換（古いSDK対応、画像処理プロセスで実行）"""
         try:
-            from PIL import Image
+            return get_image_executor().run(convert_image_format, image_data, target_format, compression)
+        except Exception as e:
+            # 変換に失敗した場合は元の画像データを返す
+            print(f"画像形式変換エラー: {e}")
+            return image_data
+
+
+class AsyncImageGenerator(ImageGenerator):
+    """ImageGeneratorの非同期版（AsyncOpenAI使用、メソッド構成は同期版と同一）
+
+    ネットワーク待ちの間にワーカースレッドを占有しないよう、API呼び出しはawaitし、
+    デコードや形式変換などのCPU処理とキャッシュのディスクI/Oはスレッドへ逃がす。
+    """
+    
+    def __init__(self, api_key: str, result_cache: Optional[ResultCache] = None):
+        self.client = get_async_openai_client(api_key)  # 共有レジストリから取得（接続再利用）
+        # 結果キャッシュ（未指定時は設定で有効な場合のみ共有キャッシュを使用）
+        self.result_cache = result_cache if result_cache is not None else get_result_cache()
+        # 実行中の同一リクエストを合流させる（APIキー単位）
+        self.single_flight = get_single_flight("images")
+        self._key_id = api_key_id(api_key)
+    
+    async def _call_api(self, method, **kwargs):
+        """API呼び出し（レート制限を考慮した再試行付き。ファイル引数は試行ごとに先頭へ戻す）"""
+        def attempt():
+            rewind_uploads(kwargs)
+            return method(**kwargs)
+        with span("api_call", endpoint=api_endpoint_name(method), upload_bytes=upload_size(kwargs)):
+            return await get_retry_scheduler().acall(self._key_id, attempt, group=rate_limit_group(method))
+    
+    async def generate_image(self,
+                             prompt: str,
+                             size: str = "1024x1024",
+                             quality: str = "auto",
+                             format: str = "png",
+                             transparent_bg: bool = False,
+                             output_compression: Optional[int] = None,
+                             moderation: str = "auto",
+                             n: int = 1,
+                             reference_images: List = None) -> Dict:
+        """画像を生成"""
+        
+        try:
+            # 実際のコスト計算をアプリ側で行うため、プレースホルダーのみ
+            cost_estimate = {"cost_usd": "計算中", "cost_jpy": "計算中", "tokens": "N/A"}
+            
+            generation_params = self._build_generation_params(
+                prompt, size, quality, format, transparent_bg, output_compression, moderation, n
+            )
+            
+            # 同一パラメータの結果がキャッシュにあれば再利用（API呼び出しなし）
+            cache_key = self._make_cache_key(generation_params, format, moderation)
+            if cache_key is not None:
+                cached = await asyncio.to_thread(self.result_cache.get, cache_key)
+                if cached is not None:
+                    return cached
+            
+            async def generate() -> Dict:
+                result = await self._generate_simple(generation_params, cost_estimate, format, output_compression)
+                result["cache_hit"] = False
+                
+                if cache_key is not None:
+                    await asyncio.to_thread(self.result_cache.put, cache_key, result, format)
+                return result
+            
+            # 同一パラメータの呼び出しが実行中なら合流（API呼び出しは1回）
+            result, shared = await self.single_flight.do(
+                self._flight_key("generate", generation_params, format, moderation), generate
+            )
+            return self._coalesced_result(result, shared)
+                
+        except Exception as e:
+            raise Exception(f"画像生成エラー: {str(e)}")
+    
+    async def _generate_simple(self, params: Dict, cost_estimate: Dict, target_format: str = "png", compression: int = None) -> Dict:
+        """シンプルな画像生成（format互換性対応）"""
+        start_time = time.time()
+        
+        try:
+            response = await self._call_api(self.client.images.generate, **params)
+        except TypeError as e:
+            if 'format' in str(e) or 'output_compression' in str(e):
+                # 古いSDKの場合：format関連パラメータを除去してPNGで生成
+                response = await self._call_api(self.client.images.generate, **self._fallback_params(params))
+            else:
+                raise
+        
+        generation_time = time.time() - start_time
+        return await asyncio.to_thread(
+            self._build_images_result, response, params, generation_time, cost_estimate, target_format, compression
+        )
+    
+    async def generate_with_reference_image(self,
+                                            prompt: str,
+                                            reference_image_data: bytes,
+                                            size: str = "1024x1024",
+                                            quality: str = "auto",
+                                            format: str = "png",
+                                            transparent_bg: bool = False,
+                                            output_compression: Optional[int] = None,
+                                            moderation: str = "auto") -> Dict:
+        """参照画像を使用した画像生成（Image Edit API）"""
+        
+        try:
+            start_time = time.time()
+            
+            edit_params = self._build_reference_params(prompt, reference_image_data, size, quality)
+            response = await self._call_api(self.client.images.edit, **edit_params)
+            
+            generation_time = time.time() - start_time
+            return await asyncio.to_thread(self._build_reference_result, response, prompt, generation_time)
+            
+        except Exception as e:
+            raise Exception(f"参照画像生成エラー: {str(e)}")
+    
+    async def generate_image_split(self,
+                                   prompt: str,
+                                   size: str = "1024x1024",
+                                   quality: str = "auto",
+                                   format: str = "png",
+                                   transparent_bg: bool = False,
+                                   output_compression: Optional[int] = None,
+                                   moderation: str = "auto",
+                                   n: int = 1,
+                                   chunk_size: Optional[int] = None,
+                                   concurrency: Optional[int] = None,
+                                   timeout: Optional[float] = None) -> Dict:
+        """n枚の生成を並列サブリクエストに分割して実行し、1つの結果にまとめる"""
+        
+        try:
+            cost_estimate = {"cost_usd": "計算中", "cost_jpy": "計算中", "tokens": "N/A"}
+            params = self._build_generation_params(
+                prompt, size, quality, format, transparent_bg, output_compression, moderation, n
+            )
+            chunks = split_count(params["n"], chunk_size or FAN_OUT_SETTINGS["split_chunk_size"])
+            
+            cache_key = self._make_cache_key(params, format, moderation)
+            if cache_key is not None:
+                cached = await asyncio.to_thread(self.result_cache.get, cache_key)
+                if cached is not None:
+                    return cached
+            
+            async def generate() -> Dict:
+                # サブリクエストはキャッシュを経由しない（同一画像の重複返却を防ぐ）
+                start_time = time.time()
+                outcomes = [outcome async for outcome in fan_out(
+                    [dict(params, n=count) for count in chunks],
+                    lambda sub_params: self._generate_simple(sub_params, cost_estimate, format, output_compression),
+                    concurrency or FAN_OUT_SETTINGS["concurrency"],
+                    timeout or FAN_OUT_SETTINGS["item_timeout"]
+                )]
+                result = self._merge_split_results(outcomes, params, time.time() - start_time, cost_estimate)
+                
+                if cache_key is not None and not result["failed_requests"]:
+                    await asyncio.to_thread(self.result_cache.put, cache_key, result, format)
+                return result
+            
+            result, shared = await self.single_flight.do(self._flight_key("split", params, format, moderation), generate)
+            return self._coalesced_result(result, shared)
+            
+        except Exception as e:
+            raise Exception(f"画像生成エラー: {str(e)}")
+    
+    def generate_batch(self,
+                       requests: List[Dict],
+                       concurrency: Optional[int] = None,
+                       timeout: Optional[float] = None) -> AsyncIterator[Dict]:
+        """複数の生成リクエスト（generate_imageの引数辞書）を並列実行し、完了順に結果を返す"""
+        return fan_out(
+            requests,
+            lambda request: self.generate_image(**request),
+            concurrency or FAN_OUT_SETTINGS["concurrency"],
+            timeout or FAN_OUT_SETTINGS["item_timeout"]
+        )
+    
+    async def generate_variations(self, original_prompt: str, num_variations: int = 3,
+                                  concurrency: Optional[int] = None, timeout: Optional[float] = None, **kwargs) -> List[Dict]:
+        """バリエーション生成（並列実行、失敗は項目ごとにerror付きで返す）"""
+        prompts = self._variation_prompts(original_prompt, num_variations)
+        variations = [None] * len(prompts)
+        
+        async for outcome in self.generate_batch([dict(kwargs, prompt=p) for p in prompts], concurrency, timeout):
+            variations[outcome["index"]] = self._variation_entry(outcome)
+                
+        return variations
+    
+    async def edit_image(self, image_data: bytes, prompt: str, size: str = "1024x1024", quality: str = "auto") -> Dict:
+        """画像の編集"""
+        try:
+            start_time = time.time()
+            
+            # 画像データをファイルライクオブジェクトに変換
+            from io import BytesIO
+            image_file = BytesIO(image_data)
+            image_file.name = "image.png"
+            
+            response = await self._call_api(
+                self.client.images.edit,
+                model="gpt-image-1",
+                image=image_file,
+                prompt=prompt,
+                size=size,
+                quality=quality
+            )
+            
+            generation_time = time.time() - start_time
+            
+            # 画像データの取得（base64形式）
+            image_data = await asyncio.to_thread(decode_response_image, response.data[0])
+            
+            return {
+                "image_data": image_data,
+                "generation_time": round(generation_time, 2),
+                "estimated_cost": "編集のため計算複雑",
+                "tokens_used": "N/A",
+                "revised_prompt": getattr(response.data[0], 'revised_prompt', None),
+                "prompt": prompt
+            }
+            
+        except Exception as e:
+            raise Exception(f"画像編集エラー: {str(e)}")
+    
+    async def create_variation(self, image_data: bytes, size: str = "1024x1024", quality: str = "hd") -> Dict:
+        """画像のバリエーション生成"""
+        try:
+            start_time = time.time()
+            
+            # 画像データをファイルライクオブジェクトに変換
             from io import BytesIO
+            image_file = BytesIO(image_data)
+            image_file.name = "image.png"
             
-            # PNG画像データをPILで読み込み
-            image = Image.open(BytesIO(image_data))
-            
-            # RGBA to RGB変換（JPEG用）
-            if target_format == "jpeg" and image.mode in ("RGBA", "LA"):
-                # 白背景で合成
-                background = Image.new("RGB", image.size, (255, 255, 255))
-                if image.mode == "RGBA":
-                    background.paste(image, mask=image.split()[-1])
-                else:
-                    background.paste(image)
-                image = background
-            
-            # バイトストリームに保存
-            output = BytesIO()
-            save_kwargs = {}
-            
-            if target_format == "jpeg":
-                save_format = "JPEG"
-                if compression is not None:
-                    save_kwargs["quality"] = compression
-                else:
-                    save_kwargs["quality"] = 90  # デフォルト品質
-            elif target_format == "webp":
-                save_format = "WebP" 
-                if compression is not None:
-                    save_kwargs["quality"] = compression
-                else:
-                    save_kwargs["quality"] = 90  # デフォルト品質
+            # バリエーション生成は1024x1024のみサポート、qualityパラメータも非対応
+            response = await self._call_api(
+                self.client.images.create_variation,
+                image=image_file,
+                n=1,
+                size="1024x1024"
+            )
+            
+            generation_time = time.time() - start_time
+            
+            # 画像データの取得（base64形式またはURL）
+            if hasattr(response.data[0], 'b64_json') and response.data[0].b64_json:
+                image_data = await asyncio.to_thread(decode_response_image, response.data[0])
             else:
-                save_format = "PNG"
+                # URLから画像をダウンロード
+                import requests
+                image_response = await asyncio.to_thread(requests.get, response.data[0].url)
+                image_data = image_response.content
             
-            image.save(output, format=save_format, **save_kwargs)
-            return output.getvalue()
+            return {
+                "image_data": image_data,
+                "generation_time": round(generation_time, 2),
+                "estimated_cost": "バリエーションのため計算複雜",
+                "tokens_used": "N/A"
+            }
             
         except Exception as e:
-            # 変換に失敗した場合は元の画像データを返す
-            print(f"画像形式変換エラー: {e}")
-            return image_data
\ No newline at end of file
+            raise Exception(f"バリエーション生成エラー: {str(e)}")
@@ -0,0 +1,260 @@
+"""生成ジョブのアドミッション制御
+
+クリックのたびに即座にOpenAIを呼び出すと、混雑時にAPIキー単位・全体の同時実行数を
+制御できず、利用者には待ち時間も分からない。画像生成・Responses API呼び出しの前段で
+上限付きの待ち行列に登録し、優先度（対話型編集 > 通常生成 > 一括生成）順・
+APIキーごとの同時実行数上限を守って実行枠を割り当てる。待機中は順番と予想待ち時間を返す。
+"""
+
+import asyncio
+import itertools
+import math
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from src.utils.config import JOB_QUEUE_SETTINGS
+
+# 優先度クラス（小さいほど優先）
+PRIORITY_INTERACTIVE = 0  # 対話型編集
+PRIORITY_STANDARD = 1     # 通常の画像生成
+PRIORITY_BULK = 2         # 一括生成
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_STANDARD: "standard",
+    PRIORITY_BULK: "bulk"
+}
+
+# 実行時間の移動平均の重み
+_DURATION_EMA_ALPHA = 0.2
+
+
+class QueueFullError(Exception):
+    """待ち行列が上限に達しているため受け付けられない"""
+
+
+class JobTicket:
+    """待ち行列に登録された1ジョブ"""
+
+    def __init__(self, scheduler: "JobScheduler", key: str, priority: int, seq: int):
+        self.scheduler = scheduler
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    @property
+    def sort_key(self) -> Tuple[int, int]:
+        return self.priority, self.seq
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+    @property
+    def abandoned(self) -> bool:
+        """待機していたイベントループが既に閉じている（待ち手がいない）"""
+        return self._loop.is_closed()
+
+    def _wake(self) -> bool:
+        """割り当て済みのジョブの待機を解除（スケジューラのロックの外から呼ばれる。ループが閉じていればFalse）"""
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            return False
+        return True
+
+    async def updates(self) -> AsyncIterator[Tuple[int, float]]:
+        """実行枠が割り当てられるまで (順番, 予想待ち秒数) を返し続ける
+
+        登録直後と更新間隔ごとに値を返す。割り当て済みなら何も返さない。
+        """
+        while not self.admitted:
+            position, eta = self.scheduler.position(self)
+            if position:
+                yield position, eta
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=self.scheduler.update_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait(self):
+        """実行枠が割り当てられるまで待機（順番の表示が不要な呼び出し元用）"""
+        await self._event.wait()
+
+
+class JobScheduler:
+    """優先度付き・上限付き待ち行列による生成ジョブのアドミッション制御"""
+
+    def __init__(self,
+                 max_concurrency: int = JOB_QUEUE_SETTINGS["max_concurrency"],
+                 per_key_concurrency: int = JOB_QUEUE_SETTINGS["per_key_concurrency"],
+                 max_queue: int = JOB_QUEUE_SETTINGS["max_queue"],
+                 per_key_queue: int = JOB_QUEUE_SETTINGS["per_key_queue"],
+                 initial_duration: float = JOB_QUEUE_SETTINGS["initial_duration"],
+                 update_interval: float = JOB_QUEUE_SETTINGS["update_interval"]):
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_key_concurrency = max(1, per_key_concurrency)
+        self.max_queue = max_queue
+        self.per_key_queue = per_key_queue
+        self.update_interval = update_interval
+        self._avg_duration = initial_duration
+        self._waiting: List[JobTicket] = []       # 優先度・登録順でソート済み
+        self._running: Dict[str, int] = {}        # キー → 実行中ジョブ数
+        self._running_total = 0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "rejected": 0, "completed": 0, "cancelled": 0, "wait_time": 0.0}
+
+    def submit(self, key: str, priority: int = PRIORITY_STANDARD) -> JobTicket:
+        """ジョブを待ち行列に登録（上限超過時はQueueFullError）"""
+        with self._lock:
+            waiting_for_key = sum(1 for t in self._waiting if t.key == key)
+            if self.max_queue and len(self._waiting) >= self.max_queue:
+                self._stats["rejected"] += 1
+                raise QueueFullError(f"混雑のため受付を停止しています（待ち {len(self._waiting)}件）。しばらくしてから再試行してください")
+            if self.per_key_queue and waiting_for_key >= self.per_key_queue:
+                self._stats["rejected"] += 1
+                raise QueueFullError(f"このAPIキーの待ちジョブが上限（{self.per_key_queue}件）に達しています")
+
+            ticket = JobTicket(self, key, priority, next(self._seq))
+            self._insert_locked(ticket)
+            self._stats["submitted"] += 1
+            admitted = self._dispatch_locked()
+        self._notify(admitted)
+        return ticket
+
+    def release(self, ticket: JobTicket):
+        """ジョブの終了（実行前のキャンセルを含む）を通知し、次のジョブに枠を割り当てる"""
+        with self._lock:
+            if ticket.admitted:
+                self._free_slot_locked(ticket)
+                duration = time.monotonic() - ticket.admitted_at
+                self._avg_duration += _DURATION_EMA_ALPHA * (duration - self._avg_duration)
+                self._stats["completed"] += 1
+            elif ticket in self._waiting:
+                self._waiting.remove(ticket)
+                self._stats["cancelled"] += 1
+            admitted = self._dispatch_locked()
+        self._notify(admitted)
+
+    @asynccontextmanager
+    async def admission(self, key: str, priority: int = PRIORITY_STANDARD):
+        """待ち行列への登録から終了通知までを行うコンテキストマネージャ
+
+        with内で ticket.updates() を回し終えた時点で実行枠が割り当て済みになる。
+        """
+        ticket = self.submit(key, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def position(self, ticket: JobTicket) -> Tuple[int, float]:
+        """(順番（1始まり、割り当て済みは0）, 予想待ち秒数) を取得"""
+        with self._lock:
+            if ticket.admitted or ticket not in self._waiting:
+                return 0, 0.0
+            index = self._waiting.index(ticket)
+            same_key_ahead = sum(1 for t in self._waiting[:index] if t.key == ticket.key)
+            # 全体の枠と同一キーの枠のうち、より長く待つ方で見積もる
+            rounds = max(
+                math.ceil((index + 1) / self.max_concurrency),
+                math.ceil((same_key_ahead + 1) / self.per_key_concurrency)
+            )
+            return index + 1, round(rounds * self._avg_duration, 1)
+
+    def stats(self) -> Dict:
+        """待ち行列・実行中ジョブの統計を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "waiting": len(self._waiting),
+                "running": self._running_total,
+                "running_keys": len(self._running),
+                "avg_duration": round(self._avg_duration, 2),
+                "waiting_by_priority": {
+                    name: sum(1 for t in self._waiting if t.priority == priority)
+                    for priority, name in PRIORITY_NAMES.items()
+                }
+            })
+        stats["wait_time"] = round(stats["wait_time"], 3)
+        return stats
+
+    def _insert_locked(self, ticket: JobTicket):
+        """優先度・登録順を保って待ち行列に挿入（ロック取得済み前提）"""
+        index = len(self._waiting)
+        while index and self._waiting[index - 1].sort_key > ticket.sort_key:
+            index -= 1
+        self._waiting.insert(index, ticket)
+
+    def _free_slot_locked(self, ticket: JobTicket):
+        """割り当て済みジョブの枠を戻す（ロック取得済み前提）"""
+        self._running[ticket.key] -= 1
+        if not self._running[ticket.key]:
+            del self._running[ticket.key]
+        self._running_total -= 1
+
+    def _dispatch_locked(self) -> List[JobTicket]:
+        """空いている枠を優先度順に割り当て、割り当てたジョブを返す（ロック取得済み前提）
+
+        同時実行数上限に達したキーのジョブは飛ばし、他のキーのジョブを先に割り当てる。
+        待機していたループが閉じたジョブは割り当てずに取り除く。待機の解除は呼び出し側が
+        ロックの外で _notify により行う。
+        """
+        if self._running_total >= self.max_concurrency:
+            return []
+        admitted, abandoned = [], []
+        for ticket in self._waiting:
+            if self._running_total >= self.max_concurrency:
+                break
+            if ticket.abandoned:
+                abandoned.append(ticket)
+                continue
+            if self._running.get(ticket.key, 0) >= self.per_key_concurrency:
+                continue
+            self._running[ticket.key] = self._running.get(ticket.key, 0) + 1
+            self._running_total += 1
+            admitted.append(ticket)
+        for ticket in abandoned:
+            self._waiting.remove(ticket)
+            self._stats["cancelled"] += 1
+        now = time.monotonic()
+        for ticket in admitted:
+            self._waiting.remove(ticket)
+            self._stats["wait_time"] += now - ticket.enqueued_at
+            ticket.admitted_at = now
+        return admitted
+
+    def _notify(self, admitted: List[JobTicket]):
+        """割り当てたジョブの待機を解除（ロックの外で呼ぶ。ループが閉じていた分は枠を戻して割り当て直す）"""
+        while admitted:
+            abandoned = [ticket for ticket in admitted if not ticket._wake()]
+            if not abandoned:
+                return
+            with self._lock:
+                for ticket in abandoned:
+                    self._free_slot_locked(ticket)
+                    ticket.admitted_at = None
+                    self._stats["cancelled"] += 1
+                admitted = self._dispatch_locked()
+
+
+# プロセス共有のデフォルトスケジューラ
+_default_scheduler: Optional[JobScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_job_scheduler() -> JobScheduler:
+    """プロセス共有のジョブスケジューラを取得"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = JobScheduler()
+    return _default_scheduler
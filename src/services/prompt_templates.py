@@ -0,0 +1,410 @@
+"""ベースYAMLテンプレートのレジストリ
+
+prompts/base_*.yaml を起動時に一括で読み込み、行数・プレースホルダー位置・
+システムプロンプト（全文変換用・スロット埋め込み用）・トップレベルのセクションごとのキー構造を
+事前計算しておく。ファイルの更新時刻が変わった場合のみ再読み込みする。
+"""
+
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+import yaml
+
+from src.services.yaml_prompt_cache import hash_template
+
+PROMPTS_DIR = Path(__file__).resolve().parents[2] / "prompts"
+
+# サイズ → テンプレートファイル名
+TEMPLATE_FILES = {
+    "landscape": "base_landscape.yaml",
+    "portrait": "base_portrait.yaml",
+    "square": "base_square.yaml"
+}
+DEFAULT_TEMPLATE = "square"
+
+# {AUTO_XXX: 説明} 形式と {{AUTO_BADGE}} 形式のプレースホルダー
+_BLOCK_PLACEHOLDER_RE = re.compile(r"\{\{(AUTO_[A-Z0-9_]+)\}\}")
+_INLINE_PLACEHOLDER_RE = re.compile(r"(?<!\{)\{(AUTO_[A-Z0-9_]+)(?::\s*([^}]*))?\}(?!\})")
+_TOP_LEVEL_KEY_RE = re.compile(r"^([A-Za-z_]\w*)\s*:")
+
+
+def select_template_key(current_size: str) -> str:
+    """基本設定のサイズからテンプレート種別を選択"""
+    if "1536x1024" in current_size or "横長" in current_size:
+        return "landscape"
+    if "1024x1536" in current_size or "縦長" in current_size:
+        return "portrait"
+    return "square"
+
+
+def build_system_prompt(base_yaml: str, total_lines: int) -> str:
+    """超厳密なシステムプロンプト（自動推論型メタプロンプト対応）"""
+    return f"""あなたは画像生成プロンプト専門のYAML変換エージェントです。以下のベースYAMLテンプレートを使用して、ユーザーのリクエストを完全にYAML化してください。
+
+## ベースYAMLテンプレート（{total_lines}行）:
+```yaml
+{base_yaml}
+```
+
+## 絶対遵守のルール（違反は絶対禁止）:
+
+### 1. 完全構造保持（必須）
+- 上記ベースYAMLの**全{total_lines}行**を完全に出力
+- **全てのコメント行（#で始まる行）**を一字一句そのまま保持
+- **全てのセクション名**を削除・省略せずに保持
+- 全ての技術的な設定値・座標・サイズは元のまま保持
+
+### 2. AUTO_プレースホルダーの自動推論置換（最重要）
+ベースYAMLには`{{AUTO_*}}`形式のプレースホルダーが含まれています。以下のルールで自動的に最適な値に置換してください：
+
+#### 用途別自動設定
+- YouTube関連 → サイズ:横長、色:鮮やかで高コントラスト、文字:極太で視認性高、背景:目立つグラデーション
+- Instagram関連 → サイズ:正方形、色:おしゃれでトレンド感、文字:シンプルで洗練、背景:統一感
+- ビジネス関連 → 色:信頼感（青・緑系）、文字:読みやすく品格、背景:プロフェッショナル
+- イベント・募集 → 色:明るく親しみやすい、文字:キャッチー、背景:賑やか
+
+#### 自動推論ルール
+- `{{AUTO_STYLE}}` → ユーザーの用途から最適なスタイルを推論
+- `{{AUTO_COLORS}}` → 用途・ムードから最適な配色を自動選択（具体的な色名やHEXコード）
+- `{{AUTO_MOOD}}` → コンテキストから適切な雰囲気を推論
+- `{{AUTO_MAIN_TEXT}}` → ユーザー入力を元に魅力的なキャッチコピーを生成
+- `{{AUTO_SUB_TEXT}}` → メインを補完する効果的なサブテキストを自動生成
+- `{{AUTO_BG_TYPE}}` → solid/gradient/pattern等から最適なものを選択
+- `{{AUTO_FONT_*}}` → 用途に応じた最適なフォント設定
+- その他の`{{AUTO_*}}` → コンテキストから論理的に推論
+
+#### 未指定項目の補完
+- ユーザーが明示的に指定していない項目も、文脈から推論して適切に埋める
+- 空欄や曖昧な値は絶対に残さない
+- 全てのプレースホルダーを具体的な値に置換
+
+### 3. 条件付きセクションの処理
+- 用途に応じて必要なセクションのみ有効化
+- 不要なセクションは適切に省略または最小化
+- YouTube → character, icons重視
+- ビジネス → badge, cta_banner重視
+- SNS → visual_identity, social_elements重視
+
+### 4. 品質保証（必須）
+- 全ての`{{AUTO_*}}`を具体的で適切な値に置換
+- プロ品質の画像生成に必要な全詳細を自動生成
+- 色は具体的な色名またはHEXコードで指定
+- フォントサイズは具体的な値（px）または相対値（large等）で指定
+
+### 5. 出力形式（必須）
+- **ベースYAMLと同じ{total_lines}行**で出力（構造は保持）
+- インデント、配列構造、オブジェクト構造を完全保持
+- コードブロック不要、YAMLのみを出力
+
+## 変換例:
+入力: "YouTubeサムネイル、料理チャンネル"
+- style: "YouTubeサムネイル（料理系チャンネル）" 
+- theme_color: "#FF6B6B, #4ECDC4, #FFFFFF"（食欲をそそる配色）
+- main_texts[0].content: "超簡単！10分で作れる絶品パスタ"
+- background.type: "gradient"
+- character.expression: "笑顔で料理を楽しんでいる"
+
+**注意: 全ての{{AUTO_*}}プレースホルダーを適切な具体値に置換し、プロ品質の完全なYAMLを出力してください。**"""
+
+
+def build_slot_system_prompt(slots: List[Tuple[str, str, Optional[str]]]) -> str:
+    """スロット埋め込み用のシステムプロンプト（値のみをJSONで返させ、YAMLはローカルで組み立てる）"""
+    slot_lines = "\n".join(
+        f"- {name[len('AUTO_'):]} ({path}){': ' + hint if hint else ''}" for name, path, hint in slots
+    )
+    return f"""あなたは画像生成プロンプト専門のアシスタントです。ユーザーのリクエストから、ベースYAMLテンプレートの各項目（スロット）に入れる値を推論してください。YAMLはシステム側で組み立てるため、値だけをJSONで返します。
+
+## スロット一覧（キー (YAMLの位置): 推論の指針）
+{slot_lines}
+
+## 推論ルール
+- YouTube関連 → 色:鮮やかで高コントラスト、文字:極太で視認性高、背景:目立つグラデーション
+- Instagram関連 → 色:おしゃれでトレンド感、文字:シンプルで洗練、背景:統一感
+- ビジネス関連 → 色:信頼感（青・緑系）、文字:読みやすく品格、背景:プロフェッショナル
+- イベント・募集 → 色:明るく親しみやすい、文字:キャッチー、背景:賑やか
+- MAIN_TEXT・SUB_TEXTなどの文言はユーザー入力を元に魅力的なコピーを作成
+- ユーザーが指定していない項目も文脈から推論し、空欄や曖昧な値は残さない
+- 不要な要素（人物・キャラクター等）は「なし」とする
+- 色は具体的な色名またはHEXコード、サイズは具体的な値（px）または相対値（large等）
+
+## 出力形式（必須）
+- 上記の全キーを持つJSONオブジェクトのみを出力（キーは一覧の表記のまま、値は文字列）
+- 値は簡潔に（文言以外は20文字程度まで）。説明・コードブロック・YAMLは出力しない
+
+例: {{"STYLE": "YouTubeサムネイル（料理系）", "COLORS": "#FF6B6B, #4ECDC4, #FFFFFF", "MAIN_TEXT": "超簡単！10分で絶品パスタ", ...}}"""
+
+
+def build_repair_system_prompt(section_texts: List[str]) -> str:
+    """欠落・破損セクションの再生成用システムプロンプト（指定セクションのみを出力させる）"""
+    sections = "\n\n".join(section_texts)
+    return f"""あなたは画像生成プロンプト専門のYAML変換エージェントです。変換済みのYAMLのうち、欠落または破損している以下のセクションだけを、ユーザーのリクエストに合わせて出力してください。
+
+## 再生成するセクション（ベースYAMLテンプレートの該当部分）:
+```yaml
+{sections}
+```
+
+## ルール（必須）
+- 上記セクションのキー・入れ子構造・インデントをテンプレートどおりに保持する
+- `{{AUTO_*}}` プレースホルダーは、変換済みYAMLの他のセクションと一貫した具体的な値に置換する
+- 技術的な設定値・座標・サイズはテンプレートのまま保持する
+- 指定されたセクション以外は出力しない。コメント・説明は不要、YAMLのみを出力"""
+
+
+def split_yaml_sections(text: str) -> List[Tuple[Optional[str], str]]:
+    """YAMLをトップレベルのキーごとに分割（キーがNoneのチャンクは行頭のコメント・空行など）
+
+    セクションはキーの行から次に行頭から始まる行の手前まで（末尾の空行は含めない）。
+    全チャンクを改行で連結すると元のテキストに戻る。
+    """
+    chunks: List[Tuple[Optional[str], List[str]]] = []
+    for line in text.split("\n"):
+        match = _TOP_LEVEL_KEY_RE.match(line)
+        if match is not None:
+            chunks.append((match.group(1), [line]))
+        elif chunks and chunks[-1][0] is not None and (not line.strip() or line[0] in " \t"):
+            chunks[-1][1].append(line)
+        elif chunks and chunks[-1][0] is None:
+            chunks[-1][1].append(line)
+        else:
+            chunks.append((None, [line]))
+
+    result: List[Tuple[Optional[str], List[str]]] = []
+    for key, lines in chunks:
+        trailing = []
+        while key is not None and len(lines) > 1 and not lines[-1].strip():
+            trailing.insert(0, lines.pop())
+        for chunk_key, chunk_lines in ((key, lines), (None, trailing)):
+            if not chunk_lines:
+                continue
+            if chunk_key is None and result and result[-1][0] is None:
+                result[-1][1].extend(chunk_lines)
+            else:
+                result.append((chunk_key, chunk_lines))
+    return [(key, "\n".join(lines)) for key, lines in result]
+
+
+def parse_yaml(text: str) -> Optional[Dict]:
+    """YAMLを解析（{{AUTO_BADGE}} などのブロック型プレースホルダーは除く。失敗時・マッピング以外はNone）"""
+    try:
+        data = yaml.safe_load(_BLOCK_PLACEHOLDER_RE.sub("", text))
+    except yaml.YAMLError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def collect_key_paths(data, prefix: str = "") -> Set[str]:
+    """解析済みYAMLのキーの位置（例: background.overlay_text.content、配列の添字は省略）"""
+    paths: Set[str] = set()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            path = f"{prefix}.{key}" if prefix else str(key)
+            paths.add(path)
+            paths |= collect_key_paths(value, path)
+    elif isinstance(data, list):
+        for item in data:
+            paths |= collect_key_paths(item, prefix)
+    return paths
+
+
+def _yaml_key_paths(lines: List[str]) -> List[str]:
+    """各行のYAML上の位置（例: background.overlay_text.content、配列の添字は省略）"""
+    paths = []
+    stack: List[Tuple[int, str]] = []  # (インデント, キー名)
+    for line in lines:
+        match = re.match(r"^(\s*)(-\s*)?([A-Za-z_]\w*)\s*:", line)
+        if match is None or line.lstrip().startswith("#"):
+            paths.append(".".join(key for _, key in stack))
+            continue
+        indent = len(match.group(1)) + len(match.group(2) or "")
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        stack.append((indent, match.group(3)))
+        paths.append(".".join(key for _, key in stack))
+    return paths
+
+
+def _yaml_quoted(value) -> str:
+    """ダブルクォート内に埋め込めるようエスケープ（改行は空白に）"""
+    if isinstance(value, (list, tuple)):
+        value = ", ".join(str(v) for v in value)
+    text = " ".join(str(value).split())
+    return text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class PromptTemplate:
+    """事前計算済みのベースYAMLテンプレート"""
+
+    def __init__(self, key: str, path: Path):
+        self.key = key
+        self.path = path
+        self.name = path.name
+        self.mtime = 0.0
+        self.text = ""
+        self.line_count = 0
+        self.content_hash = ""
+        self.placeholders: List[Tuple[int, str, Optional[str]]] = []  # (行番号, 名前, 説明)
+        self.block_placeholders: List[Tuple[int, str]] = []           # (行番号, 名前) 例: AUTO_BADGE
+        self.system_prompt = ""
+        self.slots: List[Tuple[str, str, Optional[str]]] = []         # (名前, YAML上の位置, 説明) 重複なし
+        self.slot_system_prompt = ""
+        self.section_keys: List[str] = []                             # トップレベルのキー（出現順）
+        self.section_paths: Dict[str, FrozenSet[str]] = {}            # セクションごとのキーの位置
+        self.section_texts: Dict[str, str] = {}                       # セクションごとのテンプレート本文
+
+    def load(self):
+        """ファイルを読み込み、派生データを再計算"""
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+        lines = text.split('\n')
+        placeholders = []
+        block_placeholders = []
+        for line_no, line in enumerate(lines):
+            for match in _BLOCK_PLACEHOLDER_RE.finditer(line):
+                block_placeholders.append((line_no, match.group(1)))
+            for match in _INLINE_PLACEHOLDER_RE.finditer(line):
+                hint = match.group(2).strip() if match.group(2) else None
+                placeholders.append((line_no, match.group(1), hint))
+
+        system_prompt = build_system_prompt(text, len(lines))
+        paths = _yaml_key_paths(lines)
+        slots = {}
+        for line_no, line in enumerate(lines):
+            for match in _INLINE_PLACEHOLDER_RE.finditer(line):
+                # フローマッピング（offset: {x: "...", y: "..."}）内のキーも位置に含める
+                inline_key = re.search(r"(\w+):\s*\"?$", line[:match.start()])
+                path = paths[line_no]
+                if inline_key and not path.endswith(inline_key.group(1)):
+                    path = f"{path}.{inline_key.group(1)}"
+                hint = match.group(2).strip() if match.group(2) else None
+                slots.setdefault(match.group(1), (match.group(1), path, hint))
+        slots = list(slots.values())
+
+        # セクションごとのキー構造（プレースホルダーを仮の値にして解析）
+        structure = parse_yaml(_INLINE_PLACEHOLDER_RE.sub("x", text))
+        if structure is None:
+            print(f"ベースYAMLを解析できません（構造検証を無効化）: {self.path}")
+            structure = {}
+        section_paths = {key: frozenset(collect_key_paths({key: value})) for key, value in structure.items()}
+        section_texts = {key: chunk for key, chunk in split_yaml_sections(text) if key in section_paths}
+
+        # 参照側で途中状態を見ないよう最後にまとめて差し替える
+        self.text = text
+        self.line_count = len(lines)
+        self.content_hash = hash_template(text)
+        self.placeholders = placeholders
+        self.block_placeholders = block_placeholders
+        self.system_prompt = system_prompt
+        self.slots = slots
+        self.slot_system_prompt = build_slot_system_prompt(slots) if slots else ""
+        self.section_keys = list(section_paths)
+        self.section_paths = section_paths
+        self.section_texts = section_texts
+        self.mtime = mtime
+
+    def is_stale(self) -> bool:
+        """ファイルの更新時刻が変わっているか"""
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def placeholder_names(self) -> List[str]:
+        """重複を除いたインラインプレースホルダー名（出現順）"""
+        return list(dict.fromkeys(name for _, name, _ in self.placeholders))
+
+    def repair_system_prompt(self, sections: List[str]) -> str:
+        """指定セクションの再生成用システムプロンプト"""
+        return build_repair_system_prompt([self.section_texts[key] for key in sections if key in self.section_texts])
+
+    def render_slots(self, values: Dict[str, object]) -> Tuple[str, List[str]]:
+        """インラインプレースホルダーを値で置き換えたYAMLと、値のなかったスロット名を返す
+        
+        値のキーは "AUTO_" の有無どちらでもよい。{{AUTO_BADGE}} などのブロック型はそのまま残す。
+        """
+        normalized = {str(key).upper().removeprefix("AUTO_"): value for key, value in values.items()}
+        missing = []
+        
+        def replace(match: "re.Match") -> str:
+            name = match.group(1)
+            value = normalized.get(name[len("AUTO_"):])
+            if value is None or value == "":
+                if name not in missing:
+                    missing.append(name)
+                return ""
+            return _yaml_quoted(value)
+        
+        return _INLINE_PLACEHOLDER_RE.sub(replace, self.text), missing
+
+
+class PromptTemplateRegistry:
+    """ベースYAMLテンプレートの一括読み込み + 更新時刻ベースのホットリロード"""
+
+    def __init__(self, prompts_dir: Path = PROMPTS_DIR, check_interval: float = 2.0):
+        self.prompts_dir = Path(prompts_dir)
+        self.check_interval = check_interval  # 更新確認の最小間隔（秒）
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._last_checked: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.load_all()
+
+    def load_all(self):
+        """全テンプレートを読み込み"""
+        for key, filename in TEMPLATE_FILES.items():
+            template = PromptTemplate(key, self.prompts_dir / filename)
+            try:
+                template.load()
+            except OSError as e:
+                print(f"ベースYAMLファイルが見つかりません: {template.path} ({e})")
+                continue
+            with self._lock:
+                self._templates[key] = template
+                self._last_checked[key] = time.time()
+
+    def get(self, key: str) -> PromptTemplate:
+        """テンプレートを取得（更新されていれば再読み込み）"""
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                print(f"ベースYAMLテンプレートが未登録です: {key}（正方形を使用）")
+                template = self._templates[DEFAULT_TEMPLATE]
+                key = DEFAULT_TEMPLATE
+            now = time.time()
+            should_check = now - self._last_checked.get(key, 0) >= self.check_interval
+            if should_check:
+                self._last_checked[key] = now
+
+        if should_check and template.is_stale():
+            with self._lock:
+                if template.is_stale():
+                    try:
+                        template.load()
+                        print(f"ベースYAMLを再読み込みしました: {template.name}")
+                    except OSError as e:
+                        print(f"ベースYAML再読み込みエラー: {e}")
+        return template
+
+    def get_for_size(self, current_size: str) -> PromptTemplate:
+        """基本設定のサイズに対応するテンプレートを取得"""
+        return self.get(select_template_key(current_size))
+
+
+# プロセス共有のデフォルトレジストリ
+_default_registry: Optional[PromptTemplateRegistry] = None
+_default_registry_lock = threading.Lock()
+
+
+def get_template_registry() -> PromptTemplateRegistry:
+    """プロセス共有のテンプレートレジストリを取得（初回呼び出しで全件読み込み）"""
+    global _default_registry
+    if _default_registry is None:
+        with _default_registry_lock:
+            if _default_registry is None:
+                _default_registry = PromptTemplateRegistry()
+    return _default_registry
@@ -0,0 +1,334 @@
+"""レート制限を考慮したリトライスケジューラ
+
+高負荷時の429/5xxをそのままユーザー向けエラーにすると、手動リトライが集中して
+さらに状況が悪化する。APIキー × エンドポイント群（images / chat / responses など）単位の
+トークンバケットで送信間隔を揃え、Retry-After・x-ratelimit-* ヘッダーから制限を学習する
+（制限はエンドポイントごとに異なるため、チャットの上限で画像生成の間隔を広げないよう分ける）。失敗時は指数バックオフ
+（フルジッター）で再試行し、デッドラインを超える再試行は行わない。
+
+ヘッダーの学習は共有クライアントのHTTPレスポンスフックで行うため（client_pool参照）、
+成功レスポンスの残量情報も各呼び出し側の変更なしに反映される。
+"""
+
+import asyncio
+import email.utils
+import hashlib
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+from src.utils.config import RATE_LIMIT_SETTINGS
+
+# SDKの既定リトライと同じ対象ステータス
+RETRYABLE_STATUS = {408, 409, 429}
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+_RESOURCE_MODULE_PREFIX = "openai.resources."
+
+# エンドポイント群が分からない呼び出しのバケット
+DEFAULT_GROUP = "default"
+
+
+def api_key_id(api_key: str) -> str:
+    """APIキーの識別子（生のキーを保持しないためのハッシュ）"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """x-ratelimit-reset-* 形式の期間（例: 1s, 6m0s, 120ms）を秒に変換"""
+    if not value:
+        return None
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Retry-After（秒またはHTTP日付）/ retry-after-ms ヘッダーを秒に変換"""
+    if not headers:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        parsed = email.utils.parsedate_tz(retry_after)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+def rewind_uploads(kwargs: Dict):
+    """ファイルライクな引数を先頭へ戻す（再試行時に空のアップロードを送らないため）"""
+    for value in kwargs.values():
+        if hasattr(value, "seek") and hasattr(value, "read"):
+            value.seek(0)
+
+
+def upload_size(kwargs: Dict) -> int:
+    """ファイルライクな引数の合計バイト数（トレース用）"""
+    total = 0
+    for value in kwargs.values():
+        if hasattr(value, "getbuffer"):
+            total += value.getbuffer().nbytes
+        elif isinstance(value, (bytes, bytearray)):
+            total += len(value)
+    return total
+
+
+def api_endpoint_name(method: Callable) -> str:
+    """SDKメソッドのエンドポイント名（例: images.generate）"""
+    owner = getattr(method, "__self__", None)
+    resource = type(owner).__name__.lower().replace("async", "") if owner is not None else ""
+    name = getattr(method, "__name__", "call")
+    return f"{resource}.{name}" if resource else name
+
+
+def rate_limit_group(method: Callable) -> str:
+    """SDKメソッドのレート制限グループ（例: images, chat, responses, files）"""
+    module = type(getattr(method, "__self__", None)).__module__
+    if not module.startswith(_RESOURCE_MODULE_PREFIX):
+        return DEFAULT_GROUP
+    return module[len(_RESOURCE_MODULE_PREFIX):].split(".")[0]
+
+
+def rate_limit_group_from_path(path: str) -> str:
+    """リクエストURLのパスからレート制限グループを求める（例: /v1/images/generations → images）"""
+    parts = [part for part in path.split("/") if part]
+    if "v1" in parts:
+        parts = parts[parts.index("v1") + 1:]
+    return parts[0] if parts else DEFAULT_GROUP
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    """OpenAIのAPIStatusErrorならステータスコードを返す"""
+    from openai import APIStatusError  # エラー発生時には読み込み済み（起動時の読み込みを避ける）
+    return error.status_code if isinstance(error, APIStatusError) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """再試行すべきエラーか（429・5xx・接続エラー・タイムアウト）"""
+    from openai import APIConnectionError, APITimeoutError
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return False
+
+
+class TokenBucket:
+    """送信間隔を揃えるトークンバケット（不足分は予約として待ち時間に変換）"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 0.001)          # 補充速度（リクエスト/秒）
+        self.capacity = max(capacity, 1.0)    # バースト上限
+        self.tokens = self.capacity
+        self.blocked_until = 0.0              # Retry-After等で送信を止める時刻
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """1リクエスト分を予約し、送信までの待ち秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            self.tokens -= 1
+            wait = max(0.0, self.blocked_until - now)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def cancel(self):
+        """使わなかった予約を返却"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def block_for(self, seconds: float):
+        """指定秒数の間、このキーの送信を止める"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def learn(self, status: int, headers: Mapping[str, str]):
+        """レスポンスのレート制限ヘッダーから速度と残量を学習"""
+        limit = headers.get("x-ratelimit-limit-requests")
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        with self._lock:
+            self._refill_locked(time.monotonic())
+            if limit and limit.isdigit() and int(limit) > 0:
+                # 上限は1分あたりのリクエスト数
+                self.rate = int(limit) / 60.0
+                self.capacity = max(1.0, min(float(limit), self.rate * 10))
+            if remaining and remaining.isdigit():
+                self.tokens = min(self.tokens, float(remaining))
+                if int(remaining) == 0 and reset:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+        if status == 429:
+            retry_after = parse_retry_after(headers)
+            if retry_after:
+                self.block_for(retry_after)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rate": round(self.rate, 3),
+                "capacity": round(self.capacity, 1),
+                "tokens": round(self.tokens, 2),
+                "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 2)
+            }
+
+
+class RetryScheduler:
+    """APIキー × エンドポイント群単位のトークンバケット + 指数バックオフ + デッドライン付き再試行"""
+
+    def __init__(self,
+                 max_attempts: int = RATE_LIMIT_SETTINGS["max_attempts"],
+                 base_delay: float = RATE_LIMIT_SETTINGS["base_delay"],
+                 max_delay: float = RATE_LIMIT_SETTINGS["max_delay"],
+                 deadline: float = RATE_LIMIT_SETTINGS["deadline"],
+                 default_rate: float = RATE_LIMIT_SETTINGS["default_rate"],
+                 default_burst: float = RATE_LIMIT_SETTINGS["default_burst"]):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "retries": 0, "rate_limited": 0, "gave_up": 0}
+
+    def bucket(self, key: str, group: str = DEFAULT_GROUP) -> TokenBucket:
+        """キー・エンドポイント群に対応するトークンバケットを取得（なければ作成）"""
+        bucket = self._buckets.get((key, group))
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get((key, group))
+                if bucket is None:
+                    bucket = self._buckets[(key, group)] = TokenBucket(self.default_rate, self.default_burst)
+        return bucket
+
+    def observe(self, key: str, status: int, headers: Mapping[str, str], group: str = DEFAULT_GROUP):
+        """HTTPレスポンスのヘッダーをバケットに反映（レスポンスフックから呼ばれる）"""
+        self.bucket(key, group).learn(status, headers)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _backoff(self, attempt: int, error: BaseException) -> float:
+        """再試行までの待ち秒数（Retry-Afterとフルジッターの指数バックオフの大きい方）"""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        retry_after = parse_retry_after(headers)
+        return max(backoff, retry_after or 0.0)
+
+    def _next_delay(self, bucket: TokenBucket, attempt: int, error: BaseException, deadline_at: float) -> Optional[float]:
+        """再試行するなら待ち秒数を、打ち切るならNoneを返す"""
+        if not is_retryable(error) or attempt + 1 >= self.max_attempts:
+            return None
+        delay = self._backoff(attempt, error)
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        if _status_code(error) == 429:
+            # 同じキー・エンドポイント群の他のリクエストも待たせる（一斉再送を防ぐ）
+            self._count("rate_limited")
+            bucket.block_for(delay)
+        self._count("retries")
+        print(f"API一時エラーのため再試行します（{attempt + 1}回目、{delay:.1f}秒後）: {error}")
+        return delay
+
+    def _admit(self, bucket: TokenBucket, deadline_at: float) -> float:
+        """送信枠を予約し、待ち秒数を返す（デッドラインまでに送れない場合は例外）"""
+        wait = bucket.reserve()
+        if time.monotonic() + wait >= deadline_at:
+            bucket.cancel()
+            self._count("gave_up")
+            raise TimeoutError(f"レート制限のため期限内に送信できません（待ち時間 {wait:.1f}秒）")
+        return wait
+
+    def call(self, key: str, fn: Callable[[], Any], deadline: Optional[float] = None,
+             group: str = DEFAULT_GROUP) -> Any:
+        """同期呼び出しを再試行付きで実行"""
+        self._count("calls")
+        bucket = self.bucket(key, group)
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        attempt = 0
+        while True:
+            wait = self._admit(bucket, deadline_at)
+            if wait:
+                time.sleep(wait)
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._next_delay(bucket, attempt, e, deadline_at)
+                if delay is None:
+                    if is_retryable(e):
+                        self._count("gave_up")
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, key: str, fn: Callable[[], Awaitable[Any]], deadline: Optional[float] = None,
+                    group: str = DEFAULT_GROUP) -> Any:
+        """非同期呼び出しを再試行付きで実行（fnは試行ごとに新しいコルーチンを返すこと）"""
+        self._count("calls")
+        bucket = self.bucket(key, group)
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        attempt = 0
+        while True:
+            wait = self._admit(bucket, deadline_at)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._next_delay(bucket, attempt, e, deadline_at)
+                if delay is None:
+                    if is_retryable(e):
+                        self._count("gave_up")
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stats(self) -> Dict:
+        """再試行回数とキー・エンドポイント群ごとのバケット状態を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            buckets = dict(self._buckets)
+        stats["buckets"] = {f"{key}:{group}": bucket.stats() for (key, group), bucket in buckets.items()}
+        return stats
+
+
+# プロセス共有のデフォルトスケジューラ
+_default_scheduler: Optional[RetryScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_retry_scheduler() -> RetryScheduler:
+    """プロセス共有のリトライスケジューラを取得"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = RetryScheduler()
+    return _default_scheduler
@@ -0,0 +1,115 @@
+"""参照画像アップロードのキャッシュ（Files APIのfile_idを再利用）
+
+参照画像生成のたびにPNGへ可逆エンコードし、画像全体をアップロードし直すと、
+同じ参照画像でプロンプトだけを変えて試す場合にも毎回エンコードと数MBの送信が発生する。
+参照画像は生成サイズまで縮小してからFiles APIに1度だけアップロードし、返された
+file_idを内容ハッシュをキーにLRUで保持して、Responses APIの入力画像として再利用する。
+
+- キーは元画像の画素・生成サイズのハッシュ（ヒット時は縮小・エンコードも行わない）
+- file_idはアカウントごとのため、APIキーの識別子ごとに別のLRUで保持する
+  （追い出し・期限切れで返すfile_idは常に呼び出し元と同じアカウントのもの）
+- 追い出した（・期限切れの）file_idは呼び出し側が自身のクライアントでFiles APIから削除する
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from src.utils.config import REFERENCE_UPLOAD_SETTINGS
+
+
+def reference_key(raw_pixels: bytes, mode: str, size: Tuple[int, int], target_size: str) -> str:
+    """参照画像の内容ハッシュ（画素・モード・元サイズ・生成サイズ）"""
+    digest = hashlib.sha256(f"{mode}:{size[0]}x{size[1]}:{target_size}:".encode("utf-8"))
+    digest.update(raw_pixels)
+    return digest.hexdigest()
+
+
+class ReferenceUploadCache:
+    """APIキー識別子ごとの 内容ハッシュ → file_id のLRU + TTL（上限はAPIキーごと）"""
+
+    def __init__(self,
+                 max_items: int = REFERENCE_UPLOAD_SETTINGS["max_items"],
+                 ttl: float = REFERENCE_UPLOAD_SETTINGS["ttl"]):
+        self.max_items = max(1, max_items)
+        self.ttl = ttl
+        self._entries: Dict[str, "OrderedDict[str, Tuple[str, float]]"] = {}
+        self._lock = threading.Lock()
+        self._expired: Dict[str, List[str]] = {}  # 期限切れで外したfile_id（同じAPIキーの次のputで削除対象として返す）
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.evictions = 0
+
+    def get(self, key_id: str, key: str) -> Optional[str]:
+        """アップロード済みのfile_idを取得（なければNone）"""
+        with self._lock:
+            entries = self._entries.get(key_id)
+            entry = entries.get(key) if entries is not None else None
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                del entries[key]
+                self._expired.setdefault(key_id, []).append(entry[0])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key_id: str, key: str, file_id: str) -> List[str]:
+        """file_idを登録し、同じAPIキーで追い出し・期限切れにより不要になったfile_idを返す"""
+        with self._lock:
+            entries = self._entries.setdefault(key_id, OrderedDict())
+            entries[key] = (file_id, time.time())
+            entries.move_to_end(key)
+            self.uploads += 1
+            released = self._expired.pop(key_id, [])
+            while len(entries) > self.max_items:
+                _, (evicted, _) = entries.popitem(last=False)
+                released.append(evicted)
+                self.evictions += 1
+            return released
+
+    def discard(self, key_id: str, key: str, file_id: Optional[str] = None) -> Optional[str]:
+        """file_idを外して返す（file_idが無効になった場合など。次回はアップロードし直す）"""
+        with self._lock:
+            entries = self._entries.get(key_id)
+            entry = entries.get(key) if entries is not None else None
+            if entry is None or (file_id is not None and entry[0] != file_id):
+                return None
+            del entries[key]
+            if not entries:
+                del self._entries[key_id]
+            return entry[0]
+
+    def stats(self) -> Dict:
+        """キャッシュ統計を取得"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": sum(len(entries) for entries in self._entries.values()),
+                "api_keys": len(self._entries),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "uploads": self.uploads,
+                "evictions": self.evictions
+            }
+
+
+_default_cache: Optional[ReferenceUploadCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_reference_cache() -> ReferenceUploadCache:
+    """プロセス共有の参照画像アップロードキャッシュを取得"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ReferenceUploadCache()
+    return _default_cache
@@ -1,15 +1,58 @@
-from openai import OpenAI
-import base64
-from typing import Dict, Optional, List, AsyncIterator
+from src.services.client_pool import get_openai_client, get_async_openai_client
+from src.services.rate_limit import (api_endpoint_name, api_key_id, get_retry_scheduler, rate_limit_group,
+                                     rewind_uploads, upload_size)
+from src.services.reference_cache import get_reference_cache
+from src.services.result_cache import ResultCache, get_result_cache, make_cache_key
+from src.services.single_flight import get_single_flight
+from src.utils.config import REFERENCE_UPLOAD_SETTINGS
+from src.utils.image_utils import decode_image_base64, decode_response_image, decode_response_images
+from src.utils.metrics import GENERATION_TIME, TIME_TO_FIRST_PIXEL, get_latency_recorder
+from src.utils.tracing import record_span, span
+import asyncio
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, Optional, List, AsyncIterator
 import time
 
+# file_idが存在しない・失効したことを示すエラーコード
+_INVALID_FILE_CODES = {"file_not_found", "invalid_file_id", "file_expired"}
+
+
+def _is_invalid_file_error(error: Optional[BaseException]) -> bool:
+    """file_idが削除済み・無効であることを示すAPIエラーか（ラップされた元の例外もたどる）
+
+    404、file_id向けのエラーコード、またはパラメータがfile_idの400のみを対象とし、
+    ファイル形式・サイズ・モデレーションなど画像そのものの400は含めない。
+    """
+    from openai import APIStatusError  # エラー発生時には読み込み済み（起動時の読み込みを避ける）
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, APIStatusError):
+            if error.status_code == 404 or error.code in _INVALID_FILE_CODES:
+                return True
+            return error.status_code == 400 and str(error.param or "").endswith("file_id")
+        error = error.__cause__ or error.__context__
+    return False
+
+
 class ResponsesAPI:
     """OpenAI Responses APIを使用した画像生成サービス"""
     
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        
-    def generate_with_responses(self, 
+    def __init__(self, api_key: str, result_cache: Optional[ResultCache] = None):
+        self.client = get_openai_client(api_key)  # 共有レジストリから取得（接続再利用）
+        # 結果キャッシュ（未指定時は設定で有効な場合のみ共有キャッシュを使用）
+        self.result_cache = result_cache if result_cache is not None else get_result_cache()
+        self._key_id = api_key_id(api_key)
+    
+    def _call_api(self, method, **kwargs):
+        """API呼び出し（レート制限を考慮した再試行付き。ファイル引数は試行ごとに先頭へ戻す）"""
+        def attempt():
+            rewind_uploads(kwargs)
+            return method(**kwargs)
+        with span("api_call", endpoint=api_endpoint_name(method), upload_bytes=upload_size(kwargs)):
+            return get_retry_scheduler().call(self._key_id, attempt, group=rate_limit_group(method))
+    
+    def generate_with_responses(self,
                                prompt: str,
                                model: str = "gpt-4o-mini",
                                size: str = "1024x1024",
@@ -25,121 +68,240 @@ class ResponsesAPI:
         try:
             start_time = time.time()
             
-            # ツールパラメータの構築
-            tool_params = {
-                "type": "image_generation"
-            }
-            
-            # Responses API対応パラメータのみ追加（2025年6月時点）
-            if size != "1024x1024":
-                tool_params["size"] = size
-            if quality != "auto":
-                tool_params["quality"] = quality
-            if moderation != "auto":
-                tool_params["moderation"] = moderation
-            if partial_images is not None and stream:
-                tool_params["partial_images"] = partial_images
-            
-            # format指定（PNG以外の場合）
-            if format != "png":
-                tool_params["format"] = format
-            
-            # 以下は未サポートのため削除：background, output_compression
+            tool_params = self._build_tool_params(size, quality, format, moderation, partial_images, stream)
             
             # APIリクエスト
             if stream:
                 return self._generate_stream(prompt, model, tool_params, start_time)
             else:
-                response = self.client.responses.create(
+                # 同一パラメータの結果がキャッシュにあれば再利用（API呼び出しなし）
+                cache_key = self._make_cache_key(prompt, model, size, quality, format, moderation)
+                if cache_key is not None:
+                    cached = self.result_cache.get(cache_key)
+                    if cached is not None:
+                        return cached
+                
+                response = self._call_api(
+                    self.client.responses.create,
                     model=model,
                     input=prompt,
                     tools=[tool_params]
                 )
                 
                 generation_time = time.time() - start_time
+                result = self._build_responses_result(response, prompt, generation_time)
                 
-                # 画像データの抽出
-                image_data = []
-                revised_prompts = []
-                
-                for output in response.output:
-                    if output.type == "image_generation_call":
-                        if hasattr(output, 'result') and output.result:
-                            image_data.append(base64.b64decode(output.result))
-                        if hasattr(output, 'revised_prompt'):
-                            revised_prompts.append(output.revised_prompt)
-                
-                if not image_data:
-                    raise Exception("画像生成に失敗しました")
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, result, format)
                 
-                # 単一画像の場合は従来の形式を保持
-                if len(image_data) == 1:
-                    return {
-                        "image_data": image_data[0],
-                        "generation_time": round(generation_time, 2),
-                        "revised_prompt": revised_prompts[0] if revised_prompts else None,
-                        "prompt": prompt,
-                        "response_id": response.id
-                    }
-                else:
-                    return {
-                        "images": image_data,
-                        "image_count": len(image_data),
-                        "generation_time": round(generation_time, 2),
-                        "revised_prompts": revised_prompts,
-                        "prompt": prompt,
-                        "response_id": response.id
-                    }
-                    
+                return result
+        
         except Exception as e:
             raise Exception(f"Responses API エラー: {str(e)}")
     
-    def _generate_stream(self, prompt: str, model: str, tool_params: Dict, start_time: float):
+    @staticmethod
+    def _build_tool_params(size: str, quality: str, format: str, moderation: str,
+                           partial_images: Optional[int], stream: bool) -> Dict:
+        """image_generationツールのパラメータを構築"""
+        tool_params = {
+            "type": "image_generation"
+        }
+        
+        # Responses API対応パラメータのみ追加（2025年6月時点）
+        if size != "1024x1024":
+            tool_params["size"] = size
+        if quality != "auto":
+            tool_params["quality"] = quality
+        if moderation != "auto":
+            tool_params["moderation"] = moderation
+        if partial_images is not None and stream:
+            tool_params["partial_images"] = partial_images
+        
+        # format指定（PNG以外の場合）
+        if format != "png":
+            tool_params["format"] = format
+        
+        # 以下は未サポートのため削除：background, output_compression
+        return tool_params
+    
+    @staticmethod
+    def _filter_tool_kwargs(kwargs: Dict) -> Dict:
+        """ツールパラメータ（Responses API対応パラメータのみ）を抽出"""
+        tool_params = {"type": "image_generation"}
+        supported_params = {"size", "quality", "moderation", "partial_images", "format"}
+        
+        for key, value in kwargs.items():
+            if value is None:
+                continue
+            if key in supported_params:
+                tool_params[key] = value
+            elif key in ("output_format", "format") and value != "png":
+                tool_params["format"] = value
+            # background、output_compressionは未サポートのため無視
+        return tool_params
+    
+    def _make_cache_key(self, prompt: str, model: str, size: str, quality: str, format: str,
+                        moderation: str) -> Optional[str]:
+        """結果キャッシュのキーを作成（キャッシュ無効時はNone）
+
+        キャッシュ結果のresponse_idは発行したアカウントでしか継続・編集に使えないため、
+        APIキー単位の名前空間に分ける。_build_tool_paramsが送らないbackground・
+        output_compressionはキーに含めない（同じAPI呼び出しは同じキーになる）。
+        """
+        if self.result_cache is None:
+            return None
+        return make_cache_key(
+            prompt, size, quality, format, moderation=moderation, n=1,
+            namespace=f"responses:{self._key_id}:{model}"
+        )
+    
+    @staticmethod
+    def _build_responses_result(response, prompt: str, generation_time: float) -> Dict:
+        """responses.createのレスポンスから結果を構築"""
+        # 画像データの抽出
+        image_outputs = [output for output in response.output if output.type == "image_generation_call"]
+        revised_prompts = [output.revised_prompt for output in image_outputs if hasattr(output, 'revised_prompt')]
+        # デコード済みのBase64は順に解放（複数画像でもピークメモリを抑える）
+        image_data = decode_response_images(
+            [output for output in image_outputs if getattr(output, 'result', None)], "result"
+        )
+        
+        if not image_data:
+            raise Exception("画像生成に失敗しました")
+        
+        # 単一画像の場合は従来の形式を保持
+        if len(image_data) == 1:
+            return {
+                "image_data": image_data[0],
+                "generation_time": round(generation_time, 2),
+                "revised_prompt": revised_prompts[0] if revised_prompts else None,
+                "prompt": prompt,
+                "response_id": response.id,
+                "cache_hit": False
+            }
+        else:
+            return {
+                "images": image_data,
+                "image_count": len(image_data),
+                "generation_time": round(generation_time, 2),
+                "revised_prompts": revised_prompts,
+                "prompt": prompt,
+                "response_id": response.id,
+                "cache_hit": False
+            }
+    
+    @staticmethod
+    def _first_image_result(response, prompt: str, generation_time: float) -> Optional[Dict]:
+        """レスポンスから最初の生成画像を取り出す（なければNone）"""
+        for output in response.output:
+            if output.type == "image_generation_call" and hasattr(output, 'result'):
+                return {
+                    "image_data": decode_response_image(output, "result"),
+                    "generation_time": round(generation_time, 2),
+                    "revised_prompt": getattr(output, 'revised_prompt', None),
+                    "prompt": prompt,
+                    "response_id": response.id
+                }
+        return None
+    
+    @staticmethod
+    def _build_context_content(prompt: str, context_images: List[Dict]) -> List[Dict]:
+        """コンテキスト画像を含む入力コンテンツを構築"""
+        content = [{"type": "input_text", "text": prompt}]
+        
+        # コンテキスト画像を追加
+        for img in context_images:
+            if "file_id" in img:
+                content.append({
+                    "type": "input_image",
+                    "file_id": img["file_id"]
+                })
+            elif "base64" in img:
+                content.append({
+                    "type": "input_image",
+                    "image_url": f"data:image/jpeg;base64,{img['base64']}"
+                })
+            elif "generation_id" in img:
+                content.append({
+                    "type": "image_generation_call",
+                    "id": img["generation_id"]
+                })
+        return content
+    
+    @staticmethod
+    def _process_stream_event(event, prompt: str, start_time: float, partial_images: List) -> Optional[Dict]:
+        """ストリームイベントを部分画像/最終画像の辞書に変換（対象外はNone）"""
+        if not hasattr(event, 'type'):
+            return None
+        
+        if event.type == "response.image_generation_call.partial_image":
+            # 部分画像の処理
+            elapsed = time.time() - start_time
+            partial_data = {
+                "type": "partial",
+                "index": getattr(event, 'partial_image_index', 0),
+                "image_data": decode_image_base64(event.partial_image_b64),
+                "elapsed": round(elapsed, 2)
+            }
+            partial_images.append(partial_data)
+            if len(partial_images) == 1:
+                # 最初の部分画像が届くまでの時間（体感速度の主要指標）
+                get_latency_recorder().record(TIME_TO_FIRST_PIXEL, elapsed)
+                record_span("first_partial_image", elapsed, bytes=len(partial_data["image_data"]))
+            return partial_data
+        
+        if event.type in ("response.completed", "response.done"):
+            # 最終画像の処理（SDKではresponse.completedのevent.responseに結果が入る）
+            generation_time = time.time() - start_time
+            response = getattr(event, 'response', None) or event
+            final_image = None
+            revised_prompt = None
+            
+            for output in response.output:
+                if output.type == "image_generation_call" and getattr(output, 'result', None):
+                    final_image = decode_response_image(output, "result")
+                    if hasattr(output, 'revised_prompt'):
+                        revised_prompt = output.revised_prompt
+            
+            if not partial_images:
+                # 部分画像がない場合は最終画像の到着が最初の描画
+                get_latency_recorder().record(TIME_TO_FIRST_PIXEL, generation_time)
+            get_latency_recorder().record(GENERATION_TIME, generation_time)
+            record_span("stream", generation_time, partial_count=len(partial_images),
+                        bytes=len(final_image) if final_image else 0)
+            
+            return {
+                "type": "final",
+                "image_data": final_image,
+                "generation_time": round(generation_time, 2),
+                "time_to_first_pixel": partial_images[0]["elapsed"] if partial_images else round(generation_time, 2),
+                "revised_prompt": revised_prompt,
+                "prompt": prompt,
+                "partial_count": len(partial_images),
+                "response_id": getattr(response, 'id', None)
+            }
+        
+        return None
+    
+    def _generate_stream(self, prompt: str, model: str, tool_params: Dict, start_time: float, **request_kwargs):
         """ストリーミング生成（Generator返却）"""
         try:
-            stream = self.client.responses.create(
+            stream = self._call_api(
+                self.client.responses.create,
                 model=model,
                 input=prompt,
                 tools=[tool_params],
-                stream=True
+                stream=True,
+                **request_kwargs
             )
             
             partial_images = []
-            final_image = None
-            revised_prompt = None
             
             for event in stream:
-                if hasattr(event, 'type'):
-                    if event.type == "response.image_generation_call.partial_image":
-                        # 部分画像の処理
-                        partial_data = {
-                            "type": "partial",
-                            "index": getattr(event, 'partial_image_index', 0),
-                            "image_data": base64.b64decode(event.partial_image_b64)
-                        }
-                        partial_images.append(partial_data)
-                        yield partial_data
-                        
-                    elif event.type == "response.done":
-                        # 最終画像の処理
-                        generation_time = time.time() - start_time
-                        
-                        for output in event.output:
-                            if output.type == "image_generation_call" and hasattr(output, 'result'):
-                                final_image = base64.b64decode(output.result)
-                                if hasattr(output, 'revised_prompt'):
-                                    revised_prompt = output.revised_prompt
-                        
-                        yield {
-                            "type": "final",
-                            "image_data": final_image,
-                            "generation_time": round(generation_time, 2),
-                            "revised_prompt": revised_prompt,
-                            "prompt": prompt,
-                            "partial_count": len(partial_images),
-                            "response_id": getattr(event, 'id', None)
-                        }
-                        
+                data = self._process_stream_event(event, prompt, start_time, partial_images)
+                if data is not None:
+                    yield data
+        
         except Exception as e:
             yield {
                 "type": "error",
@@ -150,26 +312,23 @@ class ResponsesAPI:
                           previous_response_id: str,
                           prompt: str,
                           model: str = "gpt-4o-mini",
+                          stream: bool = False,
                           **kwargs) -> Dict:
-        """前回の生成を継続（マルチターン）"""
+        """前回の生成を継続（マルチターン、stream=TrueでGenerator返却）"""
         
         try:
             start_time = time.time()
             
-            # ツールパラメータ（Responses API対応パラメータのみ）
-            tool_params = {"type": "image_generation"}
-            supported_params = {"size", "quality", "moderation", "partial_images", "format"}
+            tool_params = self._filter_tool_kwargs(kwargs)
+            if not stream:
+                tool_params.pop("partial_images", None)
             
-            for key, value in kwargs.items():
-                if value is None:
-                    continue
-                if key in supported_params:
-                    tool_params[key] = value
-                elif key in ("output_format", "format") and value != "png":
-                    tool_params["format"] = value
-                # background、output_compressionは未サポートのため無視
+            if stream:
+                return self._generate_stream(prompt, model, tool_params, start_time,
+                                             previous_response_id=previous_response_id)
             
-            response = self.client.responses.create(
+            response = self._call_api(
+                self.client.responses.create,
                 model=model,
                 previous_response_id=previous_response_id,
                 input=prompt,
@@ -179,19 +338,13 @@ class ResponsesAPI:
             generation_time = time.time() - start_time
             
             # 画像データの抽出
-            for output in response.output:
-                if output.type == "image_generation_call" and hasattr(output, 'result'):
-                    return {
-                        "image_data": base64.b64decode(output.result),
-                        "generation_time": round(generation_time, 2),
-                        "revised_prompt": getattr(output, 'revised_prompt', None),
-                        "prompt": prompt,
-                        "response_id": response.id,
-                        "previous_response_id": previous_response_id
-                    }
+            result = self._first_image_result(response, prompt, generation_time)
+            if result is not None:
+                result["previous_response_id"] = previous_response_id
+                return result
             
             raise Exception("継続生成に失敗しました")
-            
+        
         except Exception as e:
             raise Exception(f"継続生成エラー: {str(e)}")
     
@@ -205,41 +358,11 @@ class ResponsesAPI:
         try:
             start_time = time.time()
             
-            # 入力コンテンツの構築
-            content = [{"type": "input_text", "text": prompt}]
-            
-            # コンテキスト画像を追加
-            for img in context_images:
-                if "file_id" in img:
-                    content.append({
-                        "type": "input_image",
-                        "file_id": img["file_id"]
-                    })
-                elif "base64" in img:
-                    content.append({
-                        "type": "input_image",
-                        "image_url": f"data:image/jpeg;base64,{img['base64']}"
-                    })
-                elif "generation_id" in img:
-                    content.append({
-                        "type": "image_generation_call",
-                        "id": img["generation_id"]
-                    })
-            
-            # ツールパラメータ（Responses API対応パラメータのみ）
-            tool_params = {"type": "image_generation"}
-            supported_params = {"size", "quality", "moderation", "partial_images", "format"}
-            
-            for key, value in kwargs.items():
-                if value is None:
-                    continue
-                if key in supported_params:
-                    tool_params[key] = value
-                elif key in ("output_format", "format") and value != "png":
-                    tool_params["format"] = value
-                # background、output_compressionは未サポートのため無視
-            
-            response = self.client.responses.create(
+            content = self._build_context_content(prompt, context_images)
+            tool_params = self._filter_tool_kwargs(kwargs)
+            
+            response = self._call_api(
+                self.client.responses.create,
                 model=model,
                 input=[{
                     "role": "user",
@@ -251,18 +374,283 @@ class ResponsesAPI:
             generation_time = time.time() - start_time
             
             # 画像データの抽出
-            for output in response.output:
-                if output.type == "image_generation_call" and hasattr(output, 'result'):
-                    return {
-                        "image_data": base64.b64decode(output.result),
-                        "generation_time": round(generation_time, 2),
-                        "revised_prompt": getattr(output, 'revised_prompt', None),
-                        "prompt": prompt,
-                        "response_id": response.id,
-                        "context_images_count": len(context_images)
-                    }
+            result = self._first_image_result(response, prompt, generation_time)
+            if result is not None:
+                result["context_images_count"] = len(context_images)
+                return result
             
             raise Exception("コンテキスト付き生成に失敗しました")
+        
+        except Exception as e:
+            raise Exception(f"コンテキスト生成エラー: {str(e)}")
+    
+    def upload_reference_image(self, reference_key: str, prepare: Callable[[], bytes]) -> str:
+        """参照画像をFiles APIにアップロードしてfile_idを返す（同じ画像は既存のfile_idを再利用）
+        
+        prepareはキャッシュにない場合のみ呼ばれ、アップロードする画像（縮小済みPNG）を返す。
+        """
+        cache = get_reference_cache()
+        file_id = cache.get(self._key_id, reference_key)
+        if file_id is not None:
+            return file_id
+        
+        def upload() -> str:
+            image_file = BytesIO(prepare())
+            image_file.name = "reference.png"
+            uploaded = self._call_api(self.client.files.create, file=image_file,
+                                      purpose=REFERENCE_UPLOAD_SETTINGS["purpose"])
+            self._delete_files(cache.put(self._key_id, reference_key, uploaded.id))
+            return uploaded.id
+        
+        # 同じ参照画像の同時アップロードは1回にまとめる
+        file_id, _ = get_single_flight("reference_upload", async_mode=False).do((self._key_id, reference_key), upload)
+        return file_id
+    
+    def _delete_files(self, file_ids: List[str]):
+        """キャッシュから外れたファイルを削除（失敗しても生成は続行）"""
+        if not REFERENCE_UPLOAD_SETTINGS["delete_evicted"]:
+            return
+        for file_id in file_ids:
+            try:
+                self.client.files.delete(file_id)
+            except Exception as e:
+                print(f"参照画像ファイル削除エラー: {e}")
+    
+    def generate_with_reference(self,
+                                prompt: str,
+                                reference_key: str,
+                                prepare: Callable[[], bytes],
+                                model: str = "gpt-4o-mini",
+                                **kwargs) -> Dict:
+        """参照画像を使った生成（アップロード済みのfile_idをコンテキスト画像として再利用）"""
+        file_id = self.upload_reference_image(reference_key, prepare)
+        try:
+            result = self.generate_with_context(prompt, [{"file_id": file_id}], model, **kwargs)
+        except Exception as e:
+            # file_idが無効になった場合のみ外して次回はアップロードし直す（一時的なエラーでは再利用する）
+            if _is_invalid_file_error(e):
+                discarded = get_reference_cache().discard(self._key_id, reference_key, file_id)
+                self._delete_files([discarded] if discarded else [])
+            raise
+        result["reference_file_id"] = file_id
+        return result
+
+
+class AsyncResponsesAPI(ResponsesAPI):
+    """ResponsesAPIの非同期版（AsyncOpenAI使用、メソッド構成は同期版と同一）
+    
+    API呼び出しはawaitし、base64デコードとキャッシュのディスクI/Oはスレッドへ逃がす。
+    """
+    
+    def __init__(self, api_key: str, result_cache: Optional[ResultCache] = None):
+        self.client = get_async_openai_client(api_key)  # 共有レジストリから取得（接続再利用）
+        # 結果キャッシュ（未指定時は設定で有効な場合のみ共有キャッシュを使用）
+        self.result_cache = result_cache if result_cache is not None else get_result_cache()
+        self._key_id = api_key_id(api_key)
+    
+    async def _call_api(self, method, **kwargs):
+        """API呼び出し（レート制限を考慮した再試行付き。ファイル引数は試行ごとに先頭へ戻す）"""
+        def attempt():
+            rewind_uploads(kwargs)
+            return method(**kwargs)
+        with span("api_call", endpoint=api_endpoint_name(method), upload_bytes=upload_size(kwargs)):
+            return await get_retry_scheduler().acall(self._key_id, attempt, group=rate_limit_group(method))
+    
+    async def generate_with_responses(self,
+                                      prompt: str,
+                                      model: str = "gpt-4o-mini",
+                                      size: str = "1024x1024",
+                                      quality: str = "auto",
+                                      format: str = "png",
+                                      background: str = "auto",
+                                      output_compression: Optional[int] = None,
+                                      moderation: str = "auto",
+                                      partial_images: Optional[int] = None,
+                                      stream: bool = False):
+        """Responses APIを使用して画像を生成（stream=Trueの場合は非同期ジェネレーターを返却）"""
+        
+        try:
+            start_time = time.time()
+            
+            tool_params = self._build_tool_params(size, quality, format, moderation, partial_images, stream)
+            
+            if stream:
+                return self._generate_stream(prompt, model, tool_params, start_time)
+            
+            # 同一パラメータの結果がキャッシュにあれば再利用（API呼び出しなし）
+            cache_key = self._make_cache_key(prompt, model, size, quality, format, moderation)
+            if cache_key is not None:
+                cached = await asyncio.to_thread(self.result_cache.get, cache_key)
+                if cached is not None:
+                    return cached
             
+            response = await self._call_api(
+                self.client.responses.create,
+                model=model,
+                input=prompt,
+                tools=[tool_params]
+            )
+            
+            generation_time = time.time() - start_time
+            result = await asyncio.to_thread(self._build_responses_result, response, prompt, generation_time)
+            
+            if cache_key is not None:
+                await asyncio.to_thread(self.result_cache.put, cache_key, result, format)
+            
+            return result
+        
+        except Exception as e:
+            raise Exception(f"Responses API エラー: {str(e)}")
+    
+    async def _generate_stream(self, prompt: str, model: str, tool_params: Dict, start_time: float,
+                               **request_kwargs) -> AsyncIterator[Dict]:
+        """ストリーミング生成（AsyncGenerator返却）"""
+        try:
+            stream = await self._call_api(
+                self.client.responses.create,
+                model=model,
+                input=prompt,
+                tools=[tool_params],
+                stream=True,
+                **request_kwargs
+            )
+            
+            partial_images = []
+            
+            async for event in stream:
+                data = self._process_stream_event(event, prompt, start_time, partial_images)
+                if data is not None:
+                    yield data
+        
+        except Exception as e:
+            yield {
+                "type": "error",
+                "error": str(e)
+            }
+    
+    async def continue_generation(self,
+                                  previous_response_id: str,
+                                  prompt: str,
+                                  model: str = "gpt-4o-mini",
+                                  stream: bool = False,
+                                  **kwargs):
+        """前回の生成を継続（マルチターン、stream=Trueの場合は非同期ジェネレーターを返却）"""
+        
+        try:
+            start_time = time.time()
+            
+            tool_params = self._filter_tool_kwargs(kwargs)
+            if not stream:
+                tool_params.pop("partial_images", None)
+            
+            if stream:
+                return self._generate_stream(prompt, model, tool_params, start_time,
+                                             previous_response_id=previous_response_id)
+            
+            response = await self._call_api(
+                self.client.responses.create,
+                model=model,
+                previous_response_id=previous_response_id,
+                input=prompt,
+                tools=[tool_params]
+            )
+            
+            generation_time = time.time() - start_time
+            
+            # 画像データの抽出
+            result = await asyncio.to_thread(self._first_image_result, response, prompt, generation_time)
+            if result is not None:
+                result["previous_response_id"] = previous_response_id
+                return result
+            
+            raise Exception("継続生成に失敗しました")
+        
+        except Exception as e:
+            raise Exception(f"継続生成エラー: {str(e)}")
+    
+    async def generate_with_context(self,
+                                    prompt: str,
+                                    context_images: List[Dict],
+                                    model: str = "gpt-4o-mini",
+                                    **kwargs) -> Dict:
+        """コンテキスト画像を含めた生成"""
+        
+        try:
+            start_time = time.time()
+            
+            content = self._build_context_content(prompt, context_images)
+            tool_params = self._filter_tool_kwargs(kwargs)
+            
+            response = await self._call_api(
+                self.client.responses.create,
+                model=model,
+                input=[{
+                    "role": "user",
+                    "content": content
+                }],
+                tools=[tool_params]
+            )
+            
+            generation_time = time.time() - start_time
+            
+            # 画像データの抽出
+            result = await asyncio.to_thread(self._first_image_result, response, prompt, generation_time)
+            if result is not None:
+                result["context_images_count"] = len(context_images)
+                return result
+            
+            raise Exception("コンテキスト付き生成に失敗しました")
+        
+        except Exception as e:
+            raise Exception(f"コンテキスト生成エラー: {str(e)}")
+    
+    async def upload_reference_image(self, reference_key: str, prepare: Callable[[], Awaitable[bytes]]) -> str:
+        """参照画像をFiles APIにアップロードしてfile_idを返す（同じ画像は既存のfile_idを再利用）
+        
+        prepareはキャッシュにない場合のみ呼ばれ、アップロードする画像（縮小済みPNG）を返す。
+        """
+        cache = get_reference_cache()
+        file_id = cache.get(self._key_id, reference_key)
+        if file_id is not None:
+            return file_id
+        
+        async def upload() -> str:
+            image_file = BytesIO(await prepare())
+            image_file.name = "reference.png"
+            uploaded = await self._call_api(self.client.files.create, file=image_file,
+                                            purpose=REFERENCE_UPLOAD_SETTINGS["purpose"])
+            await self._delete_files(cache.put(self._key_id, reference_key, uploaded.id))
+            return uploaded.id
+        
+        # 同じ参照画像の同時アップロードは1回にまとめる
+        file_id, _ = await get_single_flight("reference_upload").do((self._key_id, reference_key), upload)
+        return file_id
+    
+    async def _delete_files(self, file_ids: List[str]):
+        """キャッシュから外れたファイルを削除（失敗しても生成は続行）"""
+        if not REFERENCE_UPLOAD_SETTINGS["delete_evicted"]:
+            return
+        for file_id in file_ids:
+            try:
+                await self.client.files.delete(file_id)
+            except Exception as e:
+                print(f"参照画像ファイル削除エラー: {e}")
+    
+    async def generate_with_reference(self,
+                                      prompt: str,
+                                      reference_key: str,
+                                      prepare: Callable[[], Awaitable[bytes]],
+                                      model: str = "gpt-4o-mini",
+                                      **kwargs) -> Dict:
+        """参照画像を使った生成（アップロード済みのfile_idをコンテキスト画像として再利用）"""
+        file_id = await self.upload_reference_image(reference_key, prepare)
+        try:
+            result = await self.generate_with_context(prompt, [{"file_id": file_id}], model, **kwargs)
         except Exception as e:
-            raise Exception(f"コンテキスト生成エラー: {str(e)}")
\ No newline at end of file
+            # file_idが無効になった場合のみ外して次回はアップロードし直す（一時的なエラーでは再利用する）
+            if _is_invalid_file_error(e):
+                discarded = get_reference_cache().discard(self._key_id, reference_key, file_id)
+                await self._delete_files([discarded] if discarded else [])
+            raise
+        result["reference_file_id"] = file_id
+        return result
@@ -0,0 +1,253 @@
+"""生成結果のコンテンツアドレス型キャッシュ
+
+同一プロンプト・同一パラメータの再送信（再生成・ダブルクリック・テンプレート共有）で
+有料APIを再度呼ばないよう、生成画像をディスクに保存して再利用する（オプトイン）。
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from src.utils.config import RESULT_CACHE_SETTINGS
+from src.utils.tracing import span
+
+# キャッシュ結果に引き継ぐメタデータ
+_META_FIELDS = ("revised_prompt", "revised_prompts", "prompt", "response_id", "generation_type")
+
+
+def make_cache_key(prompt: str,
+                   size: str = "1024x1024",
+                   quality: str = "auto",
+                   format: str = "png",
+                   background: str = "auto",
+                   compression: Optional[int] = None,
+                   moderation: str = "auto",
+                   n: int = 1,
+                   namespace: str = "images") -> str:
+    """生成パラメータの正規化ハッシュを作成"""
+    canonical = json.dumps({
+        "namespace": namespace,
+        "prompt": prompt.strip(),
+        "size": size,
+        "quality": quality,
+        "format": format,
+        "background": background,
+        "compression": compression if format in ("jpeg", "webp") else None,
+        "moderation": moderation,
+        "n": int(n)
+    }, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """バイト予算付きLRU + TTLのディスクキャッシュ（インデックスはメモリ保持）"""
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_bytes: int = RESULT_CACHE_SETTINGS["max_bytes"],
+                 ttl: float = RESULT_CACHE_SETTINGS["ttl"]):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._index: "OrderedDict[str, Dict]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load_index()
+
+    # ------------------------------------------------------------------
+    # 公開API
+    # ------------------------------------------------------------------
+    def get(self, key: str) -> Optional[Dict]:
+        """キャッシュ済み結果を取得（なければNone）"""
+        with span("result_cache_get") as current:
+            result = self._get(key)
+            current.set(hit=result is not None)
+            return result
+
+    def _get(self, key: str) -> Optional[Dict]:
+        start_time = time.time()
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.ttl and time.time() - entry["created_at"] > self.ttl:
+                self._remove_locked(key)
+                self._save_index_locked()
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            files = list(entry["files"])
+            meta = dict(entry["meta"])
+
+        try:
+            images = [(self.cache_dir / name).read_bytes() for name in files]
+        except OSError:
+            # ファイルが消えている場合はエントリを破棄してミス扱い
+            with self._lock:
+                self._remove_locked(key)
+                self._save_index_locked()
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        result = dict(meta)
+        if len(images) == 1:
+            result["image_data"] = images[0]
+        else:
+            result["images"] = images
+            result["image_count"] = len(images)
+        result["generation_time"] = round(time.time() - start_time, 3)
+        result["cache_hit"] = True
+        return result
+
+    def put(self, key: str, result: Dict, format: str = "png"):
+        """生成結果を保存（予算超過分はLRUで破棄。失敗しても生成結果はそのまま返せるよう例外は出さない）"""
+        with span("result_cache_put"):
+            try:
+                self._put(key, result, format)
+            except Exception as e:
+                print(f"キャッシュ保存エラー: {e}")
+
+    def _put(self, key: str, result: Dict, format: str = "png"):
+        images: List[bytes] = result.get("images") or [result.get("image_data")]
+        images = [img for img in images if img]
+        if not images:
+            return
+
+        size = sum(len(img) for img in images)
+        if size > self.max_bytes:
+            return
+
+        files = []
+        for i, img in enumerate(images):
+            name = f"{key}_{i}.{format}"
+            self._write_file(name, img)
+            files.append(name)
+
+        with self._lock:
+            if key in self._index:
+                self._remove_locked(key, delete_files=False)
+            self._index[key] = {
+                "files": files,
+                "size": size,
+                "created_at": time.time(),
+                "meta": {k: result[k] for k in _META_FIELDS if result.get(k) is not None}
+            }
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                oldest = next(iter(self._index))
+                self._remove_locked(oldest)
+            self._save_index_locked()
+
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            for key in list(self._index):
+                self._remove_locked(key)
+            self._save_index_locked()
+
+    def stats(self) -> Dict:
+        """キャッシュ統計を取得"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+    # ------------------------------------------------------------------
+    # 内部処理
+    # ------------------------------------------------------------------
+    def _remove_locked(self, key: str, delete_files: bool = True):
+        """エントリを削除（ロック取得済み前提）"""
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry["size"]
+        if delete_files:
+            for name in entry["files"]:
+                try:
+                    (self.cache_dir / name).unlink()
+                except OSError:
+                    pass
+
+    def _write_file(self, name: str, data: bytes):
+        """一意な一時ファイルに書いてから置き換え（同じキーの同時書き込みでも壊れない）"""
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, self.cache_dir / name)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+
+    def _save_index_locked(self):
+        """インデックスをディスクに書き出し（ロック取得済み前提）"""
+        tmp_path = self.cache_dir / f".{self.INDEX_FILE}.tmp"
+        try:
+            tmp_path.write_text(json.dumps(list(self._index.items()), ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp_path, self.cache_dir / self.INDEX_FILE)
+        except OSError as e:
+            print(f"キャッシュインデックス保存エラー: {e}")
+
+    def _load_index(self):
+        """起動時にインデックスを復元（期限切れ・欠損ファイルは破棄）"""
+        index_path = self.cache_dir / self.INDEX_FILE
+        if not index_path.exists():
+            return
+        try:
+            items = json.loads(index_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"キャッシュインデックス読み込みエラー: {e}")
+            return
+
+        now = time.time()
+        for key, entry in items:
+            expired = self.ttl and now - entry["created_at"] > self.ttl
+            missing = any(not (self.cache_dir / name).exists() for name in entry["files"])
+            if expired or missing:
+                self._index[key] = entry
+                self._total_bytes += entry["size"]
+                self._remove_locked(key)
+                continue
+            self._index[key] = entry
+            self._total_bytes += entry["size"]
+
+
+# プロセス共有のデフォルトキャッシュ（オプトイン）
+_default_cache: Optional[ResultCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """設定でキャッシュが有効な場合のみ共有キャッシュを返す"""
+    global _default_cache
+    if not RESULT_CACHE_SETTINGS["cache_dir"]:
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = ResultCache(RESULT_CACHE_SETTINGS["cache_dir"])
+    return _default_cache
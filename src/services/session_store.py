@@ -0,0 +1,176 @@
+"""セッション単位の状態ストア
+
+全ハンドラが1つの状態辞書を共有すると、last_response_id・現在画像・生成履歴が
+同時利用者間で混ざるため、キューの同時実行数を1より上げられない。
+Gradioのセッションハッシュごとに状態・履歴・ロックを分離し、アイドルTTLで破棄する。
+履歴・編集ツリーの画像はセッション単位の上限に加えて全セッション合計の上限（SESSION_MAX_MB）を持ち、
+超過分は最近使われていないセッションから削る。編集ツリーのノードは履歴と同じバッファを
+保持するため、合計はバッファ単位で重複を除いて数える。
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+from src.services.edit_tree import EditTree
+from src.services.history_store import HistoryStore
+from src.utils.config import SESSION_SETTINGS
+
+# セッションハッシュが取得できない呼び出し（スクリプトからの直接呼び出しなど）用のキー
+DEFAULT_SESSION_ID = "default"
+
+
+def _image_bytes(state: "SessionState") -> int:
+    """セッションが保持する画像のバイト数（履歴と編集ツリーで共有するバッファは1回だけ数える）"""
+    buffers = state.history.buffer_sizes()
+    buffers.update(state.edit_tree.buffer_sizes())
+    return sum(buffers.values())
+
+
+def _initial_state() -> Dict:
+    """セッション状態の初期値"""
+    return {
+        'current_image': None,
+        'gallery_record_ids': [],  # 履歴ギャラリーの表示順に対応するレコードID
+        'current_prompt': "",
+        'original_prompt': "",  # 元のプロンプトを保存
+        'api_key': None,
+        'last_response_id': None,  # Responses API用
+        'generation_context': [],  # マルチターン用のコンテキスト
+        'api_mode': 'image',  # 'image' or 'responses'
+        'current_size': '1024x1024 (正方形)'
+    }
+
+
+class SessionState(dict):
+    """1セッション分の状態（従来のapp_stateと同じ辞書 + 履歴ストア・ロック）"""
+
+    def __init__(self, session_id: str):
+        super().__init__(_initial_state())
+        self.session_id = session_id
+        self.history = HistoryStore()
+        self.edit_tree = EditTree()  # 対話型編集の段階（戻る・分岐用）
+        self.lock = asyncio.Lock()  # 同一セッション内の状態更新を直列化
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class SessionStore:
+    """セッションハッシュ → SessionState のLRU + アイドルTTLストア"""
+
+    def __init__(self,
+                 idle_ttl: float = SESSION_SETTINGS["idle_ttl"],
+                 max_sessions: int = SESSION_SETTINGS["max_sessions"],
+                 max_bytes: int = SESSION_SETTINGS["max_bytes"]):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max(1, max_sessions)
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, SessionState]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._evictions = 0
+        self._trimmed = 0  # 全体の上限超過で削った履歴レコード・編集ノードの数
+
+    @staticmethod
+    def session_id_for(request) -> str:
+        """gr.Requestからセッションキーを取得"""
+        return getattr(request, "session_hash", None) or DEFAULT_SESSION_ID
+
+    def get(self, request=None) -> SessionState:
+        """リクエストに対応するセッション状態を取得（なければ作成）"""
+        session_id = self.session_id_for(request)
+        with self._lock:
+            evicted = self._evict_expired_locked()
+            state = self._sessions.get(session_id)
+            if state is None:
+                state = self._sessions[session_id] = SessionState(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    _, old_state = self._sessions.popitem(last=False)
+                    evicted.append(old_state)
+            else:
+                self._sessions.move_to_end(session_id)
+            state.last_used = time.time()
+
+        self._release(evicted)
+        self._enforce_budget(state)
+        return state
+
+    def drop(self, request=None):
+        """セッションを破棄（ブラウザ切断時など）"""
+        with self._lock:
+            state = self._sessions.pop(self.session_id_for(request), None)
+        if state is not None:
+            self._release([state])
+
+    def evict_idle(self) -> int:
+        """アイドルTTLを超えたセッションを破棄し、残数を返す"""
+        with self._lock:
+            evicted = self._evict_expired_locked()
+            remaining = len(self._sessions)
+        self._release(evicted)
+        return remaining
+
+    def stats(self) -> Dict:
+        """セッション数・履歴容量などの統計を取得"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        history_bytes = sum(state.history.stats()["bytes"] for state in sessions)
+        edit_tree_bytes = sum(state.edit_tree.stats()["bytes"] for state in sessions)
+        return {
+            "sessions": len(sessions),
+            "max_sessions": self.max_sessions,
+            "evictions": self._evictions,
+            "history_bytes": history_bytes,
+            "edit_tree_bytes": edit_tree_bytes,
+            "image_bytes": sum(_image_bytes(state) for state in sessions),  # 共有バッファの重複を除いた合計
+            "max_bytes": self.max_bytes,
+            "trimmed": self._trimmed
+        }
+
+    def _enforce_budget(self, current: SessionState):
+        """全セッション合計の画像バイト数が上限を超えていれば、最近使われていないセッションから削る
+
+        呼び出し元のセッションは削らない。各セッションは編集ツリー→履歴の順に、
+        古いものから超過分だけ破棄する（履歴の最新1件・編集ツリーの選択中の経路は残す）。
+        共有バッファは両方から外れて初めて解放されるため、履歴は編集ツリーに残るバッファの
+        レコードを残し、削減量はセッション単位で測り直す。
+        """
+        if not self.max_bytes:
+            return
+        with self._lock:
+            sessions = [state for state in self._sessions.values() if state is not current]  # 最近使われていない順
+        usage = {id(state): _image_bytes(state) for state in sessions}
+        excess = sum(usage.values()) + _image_bytes(current) - self.max_bytes
+        trimmed = 0
+        for state in sessions:
+            if excess <= 0:
+                break
+            before = usage[id(state)]
+            if before == 0:
+                continue
+            trimmed += state.edit_tree.trim(max(0, state.edit_tree.stats()["bytes"] - excess))
+            trimmed += state.history.trim(max(0, state.history.stats()["bytes"] - excess),
+                                          keep=set(state.edit_tree.buffer_sizes()))
+            excess -= before - _image_bytes(state)
+        if trimmed:
+            with self._lock:
+                self._trimmed += trimmed
+
+    def _evict_expired_locked(self):
+        """アイドルTTLを超えたセッションを取り出す（ロック取得済み前提）"""
+        if not self.idle_ttl:
+            return []
+        deadline = time.time() - self.idle_ttl
+        expired = [k for k, s in self._sessions.items() if s.last_used < deadline]
+        return [self._sessions.pop(key) for key in expired]
+
+    def _release(self, states):
+        """破棄したセッションの履歴（一時ファイル）・編集ツリーを解放"""
+        if not states:
+            return
+        with self._lock:
+            self._evictions += len(states)
+        for state in states:
+            state.history.clear()
+            state.edit_tree.clear()
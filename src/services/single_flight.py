@@ -0,0 +1,145 @@
+"""同一リクエストの実行中呼び出しの合流（single-flight）
+
+ダブルクリックや、複数ユーザーが同じテンプレートプロンプトを同時に送信した場合、
+それぞれが有料のAPI呼び出しを行ってしまう。正規化キーが同じ呼び出しが実行中であれば
+新たに呼び出さず、先行する呼び出しの結果を全員で共有する。
+結果キャッシュと異なり、完了後の結果は保持しない（実行中の重複のみを除去）。
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class _FlightStats:
+    """合流統計（同期版・非同期版で共通）"""
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self._waiters: Dict[Hashable, int] = {}  # キー → 合流待機数（実行中のみ）
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.max_waiters = 0
+
+    def _record_call(self, key: Hashable, leader: bool):
+        with self._stats_lock:
+            self.calls += 1
+            if leader:
+                self.executions += 1
+                self._waiters[key] = 0
+            else:
+                self.coalesced += 1
+                waiters = self._waiters[key] = self._waiters.get(key, 0) + 1
+                self.max_waiters = max(self.max_waiters, waiters)
+
+    def _record_done(self, key: Hashable, failed: bool):
+        with self._stats_lock:
+            self._waiters.pop(key, None)
+            self.errors += int(failed)
+
+    def stats(self) -> Dict:
+        """呼び出し数・実行数・合流率などの統計を取得"""
+        with self._stats_lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "coalesced": self.coalesced,
+                "coalescing_ratio": round(self.coalesced / self.calls, 3) if self.calls else 0.0,
+                "errors": self.errors,
+                "in_flight": len(self._waiters),
+                "waiters": sum(self._waiters.values()),
+                "max_waiters": self.max_waiters
+            }
+
+
+class SingleFlight(_FlightStats):
+    """asyncio用のsingle-flight
+
+    実行は独立したタスクで行い、呼び出し側はshieldして待つ。そのため先行する呼び出し側が
+    キャンセルされても、合流した他の呼び出し側には結果が届く。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """keyが実行中なら合流し、なければfnを実行する。(結果, 合流したか) を返す"""
+        # 非同期タスクはイベントループに紐づくため、キーには実行中のループも含める
+        flight_key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(flight_key)
+        shared = task is not None
+        if task is None:
+            task = self._tasks[flight_key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._finish(flight_key, t))
+        self._record_call(flight_key, leader=not shared)
+        return await asyncio.shield(task), shared
+
+    def _finish(self, flight_key: Hashable, task: asyncio.Task):
+        """実行完了時に登録を解除"""
+        if self._tasks.get(flight_key) is task:
+            del self._tasks[flight_key]
+        failed = task.cancelled() or task.exception() is not None
+        self._record_done(flight_key, failed)
+
+
+class SyncSingleFlight(_FlightStats):
+    """スレッド用のsingle-flight（先行スレッドが実行し、後続はその結果を待つ）"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._futures: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """keyが実行中なら合流し、なければfnを実行する。(結果, 合流したか) を返す"""
+        with self._lock:
+            future = self._futures.get(key)
+            shared = future is not None
+            if future is None:
+                future = self._futures[key] = Future()
+            self._record_call(key, leader=not shared)
+
+        if shared:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._futures[key]
+            self._record_done(key, future.exception() is not None)
+
+
+# プロセス共有のデフォルトインスタンス（用途ごと）
+_default_flights: Dict[Tuple[str, bool], _FlightStats] = {}
+_default_flight_lock = threading.Lock()
+
+
+def get_single_flight(name: str, async_mode: bool = True):
+    """用途名ごとのプロセス共有single-flightを取得"""
+    key = (name, async_mode)
+    flight = _default_flights.get(key)
+    if flight is None:
+        with _default_flight_lock:
+            flight = _default_flights.get(key)
+            if flight is None:
+                flight = _default_flights[key] = SingleFlight() if async_mode else SyncSingleFlight()
+    return flight
+
+
+def get_single_flight_stats() -> Dict:
+    """用途名ごとの合流統計を取得"""
+    with _default_flight_lock:
+        flights = dict(_default_flights)
+    return {f"{name}{'' if async_mode else ':sync'}": flight.stats()
+            for (name, async_mode), flight in flights.items()}
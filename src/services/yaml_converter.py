@@ -0,0 +1,267 @@
+"""依頼文のYAMLプロンプト変換
+
+ベースYAMLテンプレートの {AUTO_*} プレースホルダー（スロット）に入れる値だけを
+gpt-4oにJSONで返させ、テンプレートへの埋め込みはローカルで行う。YAML全文（150〜175行）を
+出力させる方式に比べて出力トークンが数分の一になり、変換時間も短い。
+JSONが得られない場合は従来どおりYAML全文を出力させる（YAML_CONVERSION_MODE=full で常に全文）。
+全文の出力はテンプレートとキー構造を比較し、欠落・破損したセクションだけを再生成させて差し込む。
+値のなかったスロットも、そのスロットだけを取り直す。
+UIハンドラと一括生成ランナー（bulk_generate.py）で共有するため、app.pyから分離した。
+"""
+
+import asyncio
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+from src.services.chat_api import create_chat_completion
+from src.services.prompt_templates import PromptTemplate, build_slot_system_prompt, get_template_registry
+from src.services.rate_limit import api_key_id
+from src.services.single_flight import get_single_flight
+from src.services.yaml_prompt_cache import get_yaml_prompt_cache
+from src.services.yaml_validator import get_yaml_validator
+from src.utils.config import YAML_CONVERSION_SETTINGS
+from src.utils.tracing import span
+
+# スロット値のJSONの出力トークン見積もりに加える固定分（括弧・区切りなど）
+SLOT_TOKEN_OVERHEAD = 200
+
+# {{AUTO_BADGE}} を有効にするキーワード
+BADGE_KEYWORDS = ["新商品", "新発売", "リリース", "キャンペーン", "限定", "NEW", "期間限定", "特価", "セール", "人気", "おすすめ", "注目"]
+
+BADGE_SECTION = """badge:
+  content: "NEW"
+  font_style: "bold"
+  font_color: "#FFFFFF"
+  background_shape: "circle"
+  background_color: "#FF4444"
+  font_size: "small"
+  position: "top-right"
+  padding: "10px" """
+
+
+def render_badge(yaml_result: str, text_prompt: str) -> str:
+    """{{AUTO_BADGE}}プレースホルダーを、依頼文にキーワードがあればバッジセクション、なければ空白に置換"""
+    if "{{AUTO_BADGE}}" not in yaml_result:
+        return yaml_result
+    needs_badge = any(keyword in text_prompt for keyword in BADGE_KEYWORDS)
+    return yaml_result.replace("{{AUTO_BADGE}}", BADGE_SECTION if needs_badge else "")
+
+
+def extract_code_block(text: str) -> str:
+    """応答からコードブロックの中身を抽出（なければ全体）"""
+    if "```yaml" in text:
+        text = text.split("```yaml")[1].split("```")[0]
+    elif "```" in text:
+        text = text.split("```")[1].split("```")[0]
+    return text.strip()
+
+
+def completion_tokens(response) -> int:
+    """応答の出力トークン数（usageがなければ0）"""
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "completion_tokens", None) or 0
+
+
+def parse_slot_values(content: str) -> Optional[Dict]:
+    """スロット値のJSONを解析（前後の説明文・コードブロックは除去、失敗時はNone）"""
+    text = extract_code_block(content or "")
+    try:
+        values = json.loads(text)
+    except ValueError:
+        match = re.search(r"\{.*\}", text, re.DOTALL)
+        if match is None:
+            return None
+        try:
+            values = json.loads(match.group(0))
+        except ValueError:
+            return None
+    return values if isinstance(values, dict) else None
+
+
+def slot_token_budget(slot_count: int) -> int:
+    """スロット数から出力トークンの上限を見積もる（YAML_SLOT_MAX_TOKENS を超えない）"""
+    estimate = SLOT_TOKEN_OVERHEAD + slot_count * YAML_CONVERSION_SETTINGS["slot_tokens_per_slot"]
+    return min(YAML_CONVERSION_SETTINGS["slot_max_tokens"], estimate)
+
+
+async def request_slot_values(text_prompt: str, api_key: str, system_prompt: str,
+                              slot_count: int) -> Tuple[Optional[Dict], int]:
+    """スロット値をJSONで取得し、(値（解析できなければNone）, 出力トークン数の合計) を返す
+
+    出力が上限で途切れた場合（finish_reason == "length"）は、YAML全文の変換に切り替えず
+    上限を広げて取り直す。
+    """
+    max_tokens = slot_token_budget(slot_count)
+    total_tokens = 0
+    while True:
+        response = await create_chat_completion(
+            api_key,
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"以下のリクエストのスロット値をJSONで出力してください: {text_prompt}"}
+            ],
+            temperature=0.1,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"}
+        )
+        total_tokens += completion_tokens(response)
+        choice = response.choices[0]
+        if getattr(choice, "finish_reason", None) != "length" or max_tokens >= YAML_CONVERSION_SETTINGS["slot_max_tokens"]:
+            return parse_slot_values(choice.message.content), total_tokens
+        print(f"警告: スロット値の出力が上限（{max_tokens}トークン）で途切れました（上限を広げて再取得）")
+        max_tokens = min(YAML_CONVERSION_SETTINGS["slot_max_tokens"], max_tokens * 2)
+
+
+async def run_slot_conversion(text_prompt: str, api_key: str, template: PromptTemplate) -> Optional[str]:
+    """スロットの値をJSONで受け取り、テンプレートに埋め込んだYAMLを返す（JSONが得られない・値が埋まらなければNone）"""
+    if not template.slots:
+        return None
+
+    values, tokens = await request_slot_values(text_prompt, api_key, template.slot_system_prompt, len(template.slots))
+    if values is None:
+        print("警告: スロット値のJSONを解析できませんでした（YAML全文の変換に切り替え）")
+        return None
+
+    yaml_result, missing = template.render_slots(values)
+    if missing:
+        print(f"警告: 値のないスロットがあります（{len(missing)}/{len(template.slots)}件）: {', '.join(missing[:5])}")
+        yaml_result, missing = await retry_missing_slots(text_prompt, api_key, template, values, missing, tokens)
+        if missing:
+            # 空欄のままのYAMLは使わず（キャッシュにも残さず）、YAML全文の変換に切り替える
+            return None
+    return yaml_result.strip()
+
+
+async def retry_missing_slots(text_prompt: str, api_key: str, template: PromptTemplate, values: Dict,
+                              missing: List[str], first_tokens: int) -> Tuple[str, List[str]]:
+    """値のなかったスロットだけを取り直して埋め込み直す"""
+    missing_slots = [slot for slot in template.slots if slot[0] in missing]
+    with span("yaml_slot_retry", slots=len(missing_slots)):
+        retried, retry_tokens = await request_slot_values(text_prompt, api_key, build_slot_system_prompt(missing_slots),
+                                                          len(missing_slots))
+    yaml_result, still_missing = template.render_slots({**values, **(retried or {})})
+
+    # 全スロットを取り直した場合のトークン数と比較して記録
+    get_yaml_validator().record_slot_retry(len(missing) - len(still_missing), retry_tokens, first_tokens)
+    if still_missing:
+        print(f"警告: 再取得後も値のないスロットがあります（{len(still_missing)}件、YAML全文の変換に切り替え）: "
+              f"{', '.join(still_missing[:5])}")
+    return yaml_result, still_missing
+
+
+async def run_full_conversion(text_prompt: str, api_key: str, template: PromptTemplate) -> str:
+    """gpt-4oでベースYAMLの全文を出力させて変換"""
+    total_lines = template.line_count
+
+    # OpenAI APIでYAMLに変換（共有クライアントで接続を再利用、429/5xxは自動再試行）
+    response = await create_chat_completion(
+        api_key,
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": template.system_prompt},
+            {"role": "user", "content": f"以下のリクエストを完全なYAML形式に変換してください（{total_lines}行で出力）: {text_prompt}"}
+        ],
+        temperature=0.1,  # 一貫性重視で大幅に下げる
+        max_tokens=4000   # トークン数を大幅に増加
+    )
+
+    yaml_result = extract_code_block(response.choices[0].message.content)
+    return await repair_yaml(text_prompt, api_key, template, yaml_result, completion_tokens(response))
+
+
+async def repair_yaml(text_prompt: str, api_key: str, template: PromptTemplate, yaml_result: str,
+                      output_tokens: int) -> str:
+    """テンプレートとキー構造を比較し、欠落・破損したセクションだけを再生成させて差し込む"""
+    validator = get_yaml_validator()
+    validation = validator.validate(yaml_result, template)
+    if validation.ok:
+        validator.record_valid()
+        return yaml_result
+
+    sections = validation.repair_sections
+    repaired: Dict[str, str] = {}
+    repair_tokens = 0
+    with span("yaml_repair", sections=len(sections), missing_paths=validation.missing_paths) as current:
+        if sections:
+            print(f"警告: YAMLのセクションが欠落・破損しています（{len(sections)}/{len(template.section_keys)}件）: "
+                  f"{', '.join(sections[:5])}")
+            response = await create_chat_completion(
+                api_key,
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": template.repair_system_prompt(sections)},
+                    {"role": "user", "content": f"以下のリクエストを完全なYAML形式に変換してください: {text_prompt}"},
+                    {"role": "assistant", "content": yaml_result},
+                    {"role": "user", "content": f"次のセクションが欠落・破損しています: {', '.join(sections)}。"
+                                                "これらのセクションのみを出力してください。"}
+                ],
+                temperature=0.05,
+                max_tokens=YAML_CONVERSION_SETTINGS["repair_max_tokens"]
+            )
+            repaired = validator.extract_sections(extract_code_block(response.choices[0].message.content), sections)
+            repair_tokens = completion_tokens(response)
+        # 再生成したセクションの差し込みと、セクション外の解析できない行の除去
+        merged = validator.merge(yaml_result, repaired, template)
+        success = validator.validate(merged, template).ok
+        current.set(repaired_sections=len(repaired), success=success)
+
+    # 全文を出し直した場合のトークン数を、初回の出力から行数比で推定して記録
+    result_lines = max(1, len(yaml_result.split("\n")))
+    full_tokens = round(output_tokens * max(1.0, template.line_count / result_lines))
+    validator.record_repair(len(repaired), success, repair_tokens, full_tokens)
+    if not success:
+        print(f"警告: YAMLの修復後も欠落・破損したセクションがあります（{len(sections) - len(repaired)}件）")
+    return merged
+
+
+async def run_yaml_conversion(text_prompt: str, api_key: str, template: PromptTemplate) -> str:
+    """gpt-4oでYAMLに変換し、結果をキャッシュに登録（失敗時は例外）"""
+    yaml_result = None
+    if YAML_CONVERSION_SETTINGS["mode"] == "slots":
+        with span("yaml_slot_fill", slots=len(template.slots)):
+            yaml_result = await run_slot_conversion(text_prompt, api_key, template)
+    if yaml_result is None:
+        yaml_result = await run_full_conversion(text_prompt, api_key, template)
+
+    yaml_result = render_badge(yaml_result, text_prompt)
+
+    await asyncio.to_thread(get_yaml_prompt_cache().put, text_prompt, template.name, template.content_hash,
+                            YAML_CONVERSION_SETTINGS["mode"], yaml_result)
+    return yaml_result
+
+
+async def convert_to_yaml_prompt(text_prompt: str, api_key: str, current_size: str = "1024x1024 (正方形)") -> str:
+    """通常のプロンプトをYAML形式に変換（完全な構造保持）"""
+    try:
+        # 事前読み込み済みのベースYAMLテンプレートを選択（ファイルI/Oなし）
+        template = get_template_registry().get_for_size(current_size)
+
+        # 同じ依頼文・同じテンプレートの変換結果があれば再利用
+        # （テンプレートのハッシュをキーに含めるため、ファイル変更時は自動で無効化）
+        yaml_cache = get_yaml_prompt_cache()
+        template_name = template.name
+        template_hash = template.content_hash
+        mode = YAML_CONVERSION_SETTINGS["mode"]
+        with span("yaml_conversion", template=template_name, input_bytes=len(text_prompt.encode("utf-8"))) as current:
+            cached_yaml = yaml_cache.get(text_prompt, template_name, template_hash, mode)
+            if cached_yaml is not None:
+                print(f"YAML変換キャッシュヒット: {template_name}")
+                current.set(cache_hit=True, bytes=len(cached_yaml.encode("utf-8")))
+                return cached_yaml
+
+            # 同じ依頼文の変換が実行中なら合流（gpt-4o呼び出しは1回、APIキー単位）
+            flight_key = f"{api_key_id(api_key)}:{yaml_cache.make_key(text_prompt, template_name, template_hash, mode)}"
+            yaml_result, shared = await get_single_flight("yaml_prompt").do(
+                flight_key, lambda: run_yaml_conversion(text_prompt, api_key, template)
+            )
+            if shared:
+                print(f"YAML変換を実行中のリクエストと共有: {template_name}")
+            current.set(cache_hit=False, shared=shared, bytes=len(yaml_result.encode("utf-8")))
+            return yaml_result
+
+    except Exception as e:
+        print(f"YAML変換エラー: {e}")
+        # フォールバック: 元のプロンプトを返す
+        return text_prompt
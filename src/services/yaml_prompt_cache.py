@@ -0,0 +1,127 @@
+"""YAMLプロンプト変換結果のメモ化
+
+convert_to_yaml_prompt はgpt-4oを1〜2回呼ぶため、同じ依頼文・同じテンプレートの
+変換結果をセッションを跨いで再利用する。キーにテンプレートのハッシュを含めるため、
+テンプレートファイルが変更されると古い結果は自動的に無効になる。変換方式（slots / full）も
+キーに含め、方式を切り替えた場合は別の結果として扱う。
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Dict, Optional
+
+from src.utils.config import YAML_CACHE_SETTINGS
+from src.utils.lru_cache import LRUCache
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_request_text(text: str) -> str:
+    """依頼文を正規化（NFKC + 空白の畳み込み）"""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def hash_template(template_text: str) -> str:
+    """テンプレート内容のハッシュ"""
+    return hashlib.sha256(template_text.encode("utf-8")).hexdigest()[:16]
+
+
+class YamlPromptCache:
+    """依頼文 + テンプレートハッシュ + 変換方式をキーとするLRUメモ（任意でディスク永続化）"""
+
+    def __init__(self,
+                 max_items: int = YAML_CACHE_SETTINGS["max_items"],
+                 persist_path: Optional[str] = YAML_CACHE_SETTINGS["persist_path"]):
+        self.persist_path = Path(persist_path) if persist_path else None
+        self._cache = LRUCache(max_items=max_items)
+        self._template_hashes: Dict[str, str] = {}  # テンプレート名 → 現在のハッシュ
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(text: str, template_name: str, template_hash: str, mode: str) -> str:
+        """キャッシュキーを作成（テンプレート変更時の無効化のため、名前・ハッシュを先頭に置く）"""
+        text_hash = hashlib.sha256(normalize_request_text(text).encode("utf-8")).hexdigest()
+        return f"{template_name}:{template_hash}:{mode}:{text_hash}"
+
+    def get(self, text: str, template_name: str, template_hash: str, mode: str) -> Optional[str]:
+        """変換済みYAMLを取得"""
+        self._sync_template(template_name, template_hash)
+        return self._cache.get(self.make_key(text, template_name, template_hash, mode))
+
+    def put(self, text: str, template_name: str, template_hash: str, mode: str, yaml_text: str):
+        """変換済みYAMLを登録"""
+        self._sync_template(template_name, template_hash)
+        self._cache.set(self.make_key(text, template_name, template_hash, mode), yaml_text)
+        self._save()
+
+    def stats(self) -> Dict:
+        """キャッシュ統計を取得"""
+        return self._cache.stats()
+
+    def _sync_template(self, template_name: str, template_hash: str):
+        """テンプレートが変更されていれば旧ハッシュのエントリを破棄"""
+        with self._lock:
+            previous = self._template_hashes.get(template_name)
+            self._template_hashes[template_name] = template_hash
+        if previous is None or previous == template_hash:
+            return
+
+        stale_prefix = f"{template_name}:{previous}:"
+        removed = 0
+        for key, _ in self._cache.items():
+            if key.startswith(stale_prefix):
+                self._cache.pop(key)
+                removed += 1
+        if removed:
+            print(f"テンプレート変更を検知: {template_name}（{removed}件のキャッシュを無効化）")
+            self._save()
+
+    def _save(self):
+        """ディスクへ永続化（設定時のみ）"""
+        if self.persist_path is None:
+            return
+        with self._lock:
+            templates = dict(self._template_hashes)
+        payload = {"templates": templates, "items": self._cache.items()}
+        with self._save_lock:
+            try:
+                tmp_path = self.persist_path.with_name(self.persist_path.name + ".tmp")
+                tmp_path.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+                os.replace(tmp_path, self.persist_path)
+            except OSError as e:
+                print(f"YAMLキャッシュ保存エラー: {e}")
+
+    def _load(self):
+        """ディスクから復元（設定時のみ）"""
+        if self.persist_path is None or not self.persist_path.exists():
+            return
+        try:
+            payload = json.loads(self.persist_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"YAMLキャッシュ読み込みエラー: {e}")
+            return
+        self._template_hashes.update(payload.get("templates", {}))
+        for key, value in payload.get("items", []):
+            self._cache.set(key, value)
+
+
+# プロセス共有のデフォルトキャッシュ
+_default_cache: Optional[YamlPromptCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_yaml_prompt_cache() -> YamlPromptCache:
+    """プロセス共有のYAML変換キャッシュを取得"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                _default_cache = YamlPromptCache()
+    return _default_cache
@@ -0,0 +1,162 @@
+"""変換結果のYAMLの構造検証と部分修復
+
+gpt-4oが出力したYAMLをPyYAMLで解析し、ベーステンプレートのトップレベルのセクションごとに
+キーの集合を比較する。欠落・解析不能・キーの大半が抜けたセクションだけを再生成させて
+元の結果に差し込むため、行数不足のたびにYAML全文を出力し直させる必要がない。
+
+- 解析できないYAMLはセクション単位で解析し直し、解析できたセクションはそのまま使う
+- 差し込みはテキスト単位で行い、残りのセクション・コメント行は変更しない
+  （テンプレートにない解析できないセクションと、セクション外の説明文は取り除く）
+- 修復率と、全文（または全スロット）を出力し直した場合と比べて節約した出力トークン数（推定）を集計する
+"""
+
+import re
+import threading
+from typing import Dict, List, Optional
+
+from src.services.prompt_templates import (PromptTemplate, collect_key_paths, parse_yaml,
+                                           split_yaml_sections)
+from src.utils.config import YAML_CONVERSION_SETTINGS
+
+# 行頭のコメント・空行・{{AUTO_*}} 以外の、セクションに属さない行（説明文など）
+_STRAY_LINE_RE = re.compile(r"^(?!\s*$|#|\{\{AUTO_[A-Z0-9_]+\}\}\s*$)")
+
+
+class YamlValidation:
+    """構造検証の結果"""
+
+    __slots__ = ("missing_sections", "broken_sections", "missing_paths", "parsed")
+
+    def __init__(self, missing_sections: List[str], broken_sections: List[str], missing_paths: int, parsed: bool):
+        self.missing_sections = missing_sections  # 出力されていないセクション
+        self.broken_sections = broken_sections    # 解析できない・キーの大半が抜けたセクション
+        self.missing_paths = missing_paths        # 欠けているキーの数（全セクション合計）
+        self.parsed = parsed                      # YAML全体を解析できたか
+
+    @property
+    def repair_sections(self) -> List[str]:
+        """再生成が必要なセクション"""
+        return self.missing_sections + self.broken_sections
+
+    @property
+    def ok(self) -> bool:
+        return self.parsed and not self.missing_sections and not self.broken_sections
+
+
+class YamlValidator:
+    """ベーステンプレートとのキー構造の比較・修復セクションの差し込み・修復結果の集計"""
+
+    def __init__(self, min_coverage: float = YAML_CONVERSION_SETTINGS["section_min_coverage"]):
+        self.min_coverage = min_coverage
+        self._lock = threading.Lock()
+        self._stats = {
+            "valid": 0, "repaired": 0, "repair_failed": 0, "sections_repaired": 0,
+            "slot_retries": 0, "slots_refilled": 0, "repair_tokens": 0, "tokens_saved": 0
+        }
+
+    def validate(self, text: str, template: PromptTemplate) -> YamlValidation:
+        """テンプレートの各セクションが揃っているか検証"""
+        chunks = split_yaml_sections(text)
+        present = {key for key, _ in chunks if key is not None}
+        data = parse_yaml(text)
+        parsed = data is not None
+        if data is None:
+            # 全体を解析できない場合はセクション単位で解析し、解析できたものだけを使う
+            data = {}
+            for key, chunk in chunks:
+                section = parse_yaml(chunk) if key is not None else None
+                if section is not None:
+                    data.update(section)
+
+        missing, broken, missing_paths = [], [], 0
+        for key in template.section_keys:
+            expected = template.section_paths[key]
+            if key not in data:
+                (broken if key in present else missing).append(key)
+                missing_paths += len(expected)
+                continue
+            lost = expected - collect_key_paths({key: data[key]})
+            missing_paths += len(lost)
+            if lost and (len(expected) - len(lost)) / len(expected) < self.min_coverage:
+                broken.append(key)
+        return YamlValidation(missing, broken, missing_paths, parsed)
+
+    def extract_sections(self, text: str, keys: List[str]) -> Dict[str, str]:
+        """再生成の応答から、指定セクションのうち解析できたものを取り出す"""
+        sections: Dict[str, str] = {}
+        for key, chunk in split_yaml_sections(text):
+            if key in keys and key not in sections and parse_yaml(chunk) is not None:
+                sections[key] = chunk
+        return sections
+
+    def merge(self, text: str, repaired: Dict[str, str], template: PromptTemplate) -> str:
+        """再生成したセクションを差し込む（既存は置き換え、欠落分はテンプレート上の直前のセクションの後ろ）"""
+        merged = []
+        for key, chunk in split_yaml_sections(text):
+            if key is None:
+                chunk = "\n".join(line for line in chunk.split("\n") if not _STRAY_LINE_RE.match(line))
+            elif key in repaired:
+                chunk = repaired[key]
+            elif key not in template.section_paths and parse_yaml(chunk) is None:
+                continue
+            merged.append((key, chunk))
+        present = {key for key, _ in merged if key is not None}
+        preceding = set()
+        for key in template.section_keys:
+            if key in repaired and key not in present:
+                index = 0
+                for i, (chunk_key, _) in enumerate(merged):
+                    if chunk_key in preceding:
+                        index = i + 1
+                merged.insert(index, (key, repaired[key]))
+            preceding.add(key)
+        return "\n".join(chunk for _, chunk in merged)
+
+    def record_valid(self):
+        """修復不要だった変換を記録"""
+        with self._lock:
+            self._stats["valid"] += 1
+
+    def record_repair(self, sections: int, success: bool, repair_tokens: int, full_tokens: int):
+        """構造の修復を記録（full_tokens: YAML全文を出力し直した場合の推定トークン数）"""
+        with self._lock:
+            self._stats["repaired" if success else "repair_failed"] += 1
+            self._stats["sections_repaired"] += sections if success else 0
+            self._stats["repair_tokens"] += repair_tokens
+            self._stats["tokens_saved"] += max(0, full_tokens - repair_tokens)
+
+    def record_slot_retry(self, refilled: int, retry_tokens: int, full_tokens: int):
+        """値のなかったスロットの再取得を記録（full_tokens: 全スロットを取り直した場合の推定トークン数）"""
+        with self._lock:
+            self._stats["slot_retries"] += 1
+            self._stats["slots_refilled"] += refilled
+            self._stats["repair_tokens"] += retry_tokens
+            self._stats["tokens_saved"] += max(0, full_tokens - retry_tokens)
+
+    def stats(self) -> Dict:
+        """修復率（修復が必要だった割合・修復に成功した割合）と節約トークン数"""
+        with self._lock:
+            stats = dict(self._stats)
+        needed = stats["repaired"] + stats["repair_failed"]
+        checked = stats["valid"] + needed
+        stats.update({
+            "checked": checked,
+            "repair_rate": round(needed / checked, 4) if checked else 0.0,
+            "repair_success_rate": round(stats["repaired"] / needed, 4) if needed else None,
+            "min_coverage": self.min_coverage
+        })
+        return stats
+
+
+_default_validator: Optional[YamlValidator] = None
+_default_validator_lock = threading.Lock()
+
+
+def get_yaml_validator() -> YamlValidator:
+    """プロセス共有のYAML構造検証を取得"""
+    global _default_validator
+    if _default_validator is None:
+        with _default_validator_lock:
+            if _default_validator is None:
+                _default_validator = YamlValidator()
+    return _default_validator
@@ -0,0 +1,54 @@
+"""ライブラリ互換パッチ（必要な場合のみ適用）
+
+以前はapp.pyの読み込み時に無条件でパッチを当てており、そのためにgradio_client・openaiを
+起動直後に読み込んでいた。各パッチは不具合の有無を確認してから適用し、確認結果はキャッシュする。
+パッチは初めて必要になる時点（UI構築時・クライアント作成時）で呼び出す。
+"""
+
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_gradio_schema_patch() -> bool:
+    """gradio_clientのJSONスキーマ変換がboolスキーマで落ちる不具合を回避（適用した場合True）"""
+    try:
+        import gradio_client.utils as _gcu
+    except ImportError:
+        return False
+
+    try:
+        _gcu._json_schema_to_python_type(True, {})
+        return False  # 修正済みのバージョン
+    except TypeError:
+        pass
+    except Exception as e:
+        print(f"Gradioスキーマ変換の確認に失敗: {e}")
+        return False
+
+    _orig = _gcu._json_schema_to_python_type  # keep ref
+
+    def _patched(schema, defs=None):
+        if isinstance(schema, bool):          # bool → 空dict に変換
+            schema = {}
+        return _orig(schema, defs or {})
+
+    _gcu._json_schema_to_python_type = _patched
+    print("Gradio猿パッチを適用しました")
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_openai_compat() -> bool:
+    """古いOpenAI SDKのproxies引数を無効化（適用した場合True）"""
+    try:
+        import inspect
+        from openai import OpenAI
+
+        if 'proxies' not in inspect.signature(OpenAI.__init__).parameters:
+            return False  # 新しいSDKには存在しない
+        OpenAI.__init__ = functools.partialmethod(OpenAI.__init__, proxies=None)
+        print("OpenAI proxies猿パッチを適用しました")
+        return True
+    except Exception as e:
+        print(f"OpenAI猿パッチの適用に失敗: {e}")
+        return False
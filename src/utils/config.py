@@ -1,5 +1,8 @@
 """設定管理モジュール（必要最小限）"""
 
+import os
+import tempfile
+
 # 画像生成に関する定数定義
 IMAGE_SIZES = {
     "1024x1024": {"width": 1024, "height": 1024, "description": "正方形（標準）"},
@@ -21,4 +24,122 @@ FORMAT_SETTINGS = {
     "png": "PNG（透過対応）",
     "jpeg": "JPEG（高圧縮）",
     "webp": "WebP（最新形式）"
-}
\ No newline at end of file
+}
+
+# OpenAIクライアント共有レジストリ設定
+CLIENT_POOL_SETTINGS = {
+    "max_clients": int(os.getenv("OPENAI_POOL_MAX_CLIENTS", 32)),   # 保持するAPIキー数の上限
+    "idle_ttl": float(os.getenv("OPENAI_POOL_IDLE_TTL", 900)),      # 未使用クライアントの破棄秒数
+    "max_connections": 20,                                          # クライアント毎の最大接続数
+    "max_keepalive": 10,                                            # keep-alive保持接続数
+    "keepalive_expiry": 120.0                                       # keep-alive接続の保持秒数
+}
+
+# 生成結果キャッシュ設定（IMAGE_RESULT_CACHE_DIRを指定した場合のみ有効）
+RESULT_CACHE_SETTINGS = {
+    "cache_dir": os.getenv("IMAGE_RESULT_CACHE_DIR", ""),                           # 保存先ディレクトリ
+    "max_bytes": int(os.getenv("IMAGE_RESULT_CACHE_MAX_MB", 512)) * 1024 * 1024,    # 容量上限
+    "ttl": float(os.getenv("IMAGE_RESULT_CACHE_TTL", 24 * 3600))                   # 有効期限（秒）
+}
+
+# YAMLプロンプト変換メモ化設定
+YAML_CACHE_SETTINGS = {
+    "max_items": int(os.getenv("YAML_PROMPT_CACHE_MAX_ITEMS", 256)),   # メモリ保持件数
+    "persist_path": os.getenv("YAML_PROMPT_CACHE_PATH", "")            # 永続化ファイル（空ならメモリのみ）
+}
+
+# YAMLプロンプト変換設定
+YAML_CONVERSION_SETTINGS = {
+    "mode": os.getenv("YAML_CONVERSION_MODE", "slots"),                 # slots: 値のみJSONで受け取りローカルで組み立て / full: YAML全文を出力させる
+    "slot_tokens_per_slot": int(os.getenv("YAML_SLOT_TOKENS_PER_SLOT", 60)),  # スロット1件あたりの出力トークン見積もり（上限の算出用）
+    "slot_max_tokens": int(os.getenv("YAML_SLOT_MAX_TOKENS", 16000)),   # スロット値の出力トークン上限（途切れた場合もここまでしか広げない）
+    "repair_max_tokens": int(os.getenv("YAML_REPAIR_MAX_TOKENS", 1500)),  # 欠落・破損セクションの再生成時の出力トークン上限
+    "section_min_coverage": float(os.getenv("YAML_SECTION_MIN_COVERAGE", 0.5))  # セクション内のキーがこの割合未満なら再生成
+}
+
+# 並列ファンアウト設定（バリエーション・バッチ・分割生成）
+FAN_OUT_SETTINGS = {
+    "concurrency": int(os.getenv("IMAGE_FAN_OUT_CONCURRENCY", 4)),   # 同時実行数の上限
+    "item_timeout": float(os.getenv("IMAGE_FAN_OUT_TIMEOUT", 180)),  # 項目ごとのタイムアウト（秒）
+    "split_chunk_size": int(os.getenv("IMAGE_SPLIT_CHUNK_SIZE", 1))  # n分割時のサブリクエスト枚数
+}
+
+# 生成履歴の保持設定（セッション単位）
+HISTORY_SETTINGS = {
+    "max_items": int(os.getenv("HISTORY_MAX_ITEMS", 30)),                      # 保持件数の上限
+    "max_bytes": int(os.getenv("HISTORY_MAX_MB", 64)) * 1024 * 1024,          # 画像バイト数の上限
+    "temp_dir": os.getenv("HISTORY_TEMP_DIR", os.path.join(tempfile.gettempdir(), "ai_image_history")),  # 一時ファイル専用ディレクトリ
+    "orphan_min_age": float(os.getenv("HISTORY_ORPHAN_MIN_AGE", 60)),         # 起動時に削除する孤立ファイルの最低経過秒数
+    "thumbnail_size": int(os.getenv("HISTORY_THUMBNAIL_SIZE", 256)),          # ギャラリー用サムネイルの長辺px
+    "thumbnail_format": os.getenv("HISTORY_THUMBNAIL_FORMAT", "webp"),        # サムネイル形式（webp / jpeg）
+    "thumbnail_quality": int(os.getenv("HISTORY_THUMBNAIL_QUALITY", 75))      # サムネイルの品質
+}
+
+# 対話型編集の編集ツリー設定（セッション単位。各段階の画像を保持して即時に戻る・分岐する）
+EDIT_TREE_SETTINGS = {
+    "max_nodes": int(os.getenv("EDIT_TREE_MAX_NODES", 50)),                   # 保持する段階数の上限
+    "max_bytes": int(os.getenv("EDIT_TREE_MAX_MB", 64)) * 1024 * 1024         # 画像バイト数の上限
+}
+
+# セッション状態の保持設定
+SESSION_SETTINGS = {
+    "idle_ttl": float(os.getenv("SESSION_IDLE_TTL", 3600)),     # 未使用セッションの破棄秒数
+    "max_sessions": int(os.getenv("SESSION_MAX_SESSIONS", 200)),  # 同時に保持するセッション数の上限
+    "max_bytes": int(os.getenv("SESSION_MAX_MB", 1024)) * 1024 * 1024  # 全セッションの履歴・編集ツリーの画像バイト数の上限（0で無制限）
+}
+
+# レート制限・再試行設定（共有クライアントのSDK内蔵リトライは無効化し、こちらで一元管理）
+RATE_LIMIT_SETTINGS = {
+    "max_attempts": int(os.getenv("OPENAI_RETRY_MAX_ATTEMPTS", 4)),     # 最大試行回数（初回を含む）
+    "base_delay": float(os.getenv("OPENAI_RETRY_BASE_DELAY", 1.0)),     # バックオフの基準秒数
+    "max_delay": float(os.getenv("OPENAI_RETRY_MAX_DELAY", 20.0)),      # バックオフの上限秒数
+    "deadline": float(os.getenv("OPENAI_RETRY_DEADLINE", 150.0)),       # 再試行を含む1呼び出しの期限（秒）
+    "default_rate": float(os.getenv("OPENAI_DEFAULT_RATE", 5.0)),       # ヘッダー学習前の送信速度（リクエスト/秒）
+    "default_burst": float(os.getenv("OPENAI_DEFAULT_BURST", 10.0))     # ヘッダー学習前のバースト上限
+}
+
+# 生成ジョブのアドミッション制御設定
+JOB_QUEUE_SETTINGS = {
+    "max_concurrency": int(os.getenv("JOB_MAX_CONCURRENCY", 6)),         # 全体の同時実行数の上限
+    "per_key_concurrency": int(os.getenv("JOB_PER_KEY_CONCURRENCY", 2)), # APIキーごとの同時実行数の上限
+    "max_queue": int(os.getenv("JOB_MAX_QUEUE", 50)),                     # 全体の待ち行列の上限
+    "per_key_queue": int(os.getenv("JOB_PER_KEY_QUEUE", 10)),             # APIキーごとの待ち行列の上限
+    "initial_duration": float(os.getenv("JOB_INITIAL_DURATION", 20.0)),   # 実績がない場合の想定実行秒数（ETA計算用）
+    "update_interval": float(os.getenv("JOB_UPDATE_INTERVAL", 1.0))       # 順番待ち表示の更新間隔（秒）
+}
+
+# REST/ストリーミングAPI設定
+API_SETTINGS = {
+    "enabled": os.getenv("ENABLE_REST_API", "1") not in ("0", "false", "False"),  # Gradio UIと同じサーバーにAPIを載せるか
+    "prefix": os.getenv("REST_API_PREFIX", "/api/v1"),                           # APIのパス
+    "idempotency_max_items": int(os.getenv("API_IDEMPOTENCY_MAX_ITEMS", 64)),     # 冪等キーで保持するレスポンス数
+    "idempotency_ttl": float(os.getenv("API_IDEMPOTENCY_TTL", 3600))             # 冪等キーの有効期限（秒）
+}
+
+# 画像処理（Pillow）のプロセスプール設定（ワーカー数0なら呼び出し元のスレッドで実行）
+IMAGE_EXECUTOR_SETTINGS = {
+    "workers": int(os.getenv("IMAGE_EXECUTOR_WORKERS", min(4, os.cpu_count() or 1))),   # ワーカープロセス数
+    "inline_max_bytes": int(os.getenv("IMAGE_EXECUTOR_INLINE_MAX_BYTES", 64 * 1024))     # これ以下の画像はプロセス間転送せず直接処理
+}
+
+# 参照画像アップロードキャッシュ設定（Files APIのfile_idを再利用）
+REFERENCE_UPLOAD_SETTINGS = {
+    "max_items": int(os.getenv("REFERENCE_UPLOAD_CACHE_SIZE", 64)),                          # APIキーごとに保持するfile_id数（LRU）
+    "ttl": float(os.getenv("REFERENCE_UPLOAD_TTL", 24 * 3600)),                                # file_idを再利用する期間（秒）
+    "delete_evicted": os.getenv("REFERENCE_UPLOAD_DELETE_EVICTED", "1") not in ("0", "false", "False"),  # 追い出したファイルをFiles APIから削除するか
+    "purpose": os.getenv("REFERENCE_UPLOAD_PURPOSE", "vision")                                 # Files APIのpurpose
+}
+
+# Base64画像デコード設定
+DECODE_SETTINGS = {
+    "chunk_size": int(os.getenv("BASE64_DECODE_CHUNK_SIZE", 1024 * 1024))   # 1回にデコードするBase64文字数（4の倍数に切り下げ）
+}
+
+# 段階別トレース設定（TRACE_EXPORTを指定した場合のみファイルに書き出し）
+TRACING_SETTINGS = {
+    "enabled": os.getenv("TRACING_ENABLED", "1") not in ("0", "false", "False"),  # スパンを記録するか
+    "export": os.getenv("TRACE_EXPORT", ""),                                    # 書き出し形式（jsonl / otlp、空なら書き出さない）
+    "path": os.getenv("TRACE_EXPORT_PATH", "traces.jsonl"),                     # 書き出し先ファイル
+    "service_name": os.getenv("TRACE_SERVICE_NAME", "ai-image-generator"),      # OTLPのservice.name
+    "recent_traces": int(os.getenv("TRACE_RECENT_TRACES", 50))                  # 統計用に保持する直近トレース数
+}
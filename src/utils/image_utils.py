@@ -1,15 +1,70 @@
 """画像処理ユーティリティ（必要最小限）"""
 
 import base64
+import binascii
 from PIL import Image
 from io import BytesIO
 
+from src.utils.config import DECODE_SETTINGS
+from src.utils.tracing import record_peak, span
+
 def encode_image_to_base64(image_path):
     """画像ファイルをBase64エンコード"""
     with open(image_path, 'rb') as f:
         image_data = f.read()
     return base64.b64encode(image_data).decode('utf-8')
 
+def _b64decode_chunked(image_base64, chunk_size):
+    """Base64を一定文字数ずつデコード（作業領域をchunk_size程度に抑える）"""
+    step = max(4, chunk_size - chunk_size % 4)
+    if len(image_base64) <= step or "\n" in image_base64 or "\r" in image_base64:
+        # 短い・改行入り（チャンク境界がずれる）場合は一括でデコード
+        return base64.b64decode(image_base64)
+    output = BytesIO()
+    for start in range(0, len(image_base64), step):
+        output.write(binascii.a2b_base64(image_base64[start:start + step]))
+    # getvalueは内部バッファをそのまま返す（コピーなし）
+    return output.getvalue()
+
+def decode_image_base64(image_base64, chunk_size=DECODE_SETTINGS["chunk_size"]):
+    """APIレスポンスのBase64画像をバイト列にデコード（段階別トレースに記録）"""
+    with span("decode_base64", encoded_bytes=len(image_base64)) as current:
+        image_data = _b64decode_chunked(image_base64, chunk_size)
+        peak_bytes = len(image_base64) + len(image_data) + chunk_size
+        current.set(bytes=len(image_data), peak_bytes=peak_bytes)
+    record_peak("decode_peak_bytes", peak_bytes)
+    return image_data
+
+def decode_response_images(items, attr="b64_json", chunk_size=DECODE_SETTINGS["chunk_size"]):
+    """レスポンスの画像（items[i].<attr>）を1枚ずつデコード
+    
+    デコードし終えた画像のBase64文字列はレスポンスから外して解放するため、
+    ピーク時のメモリは「未デコードのBase64 + デコード済みのバイト列 + 1チャンク」に収まる。
+    """
+    pending = sum(len(getattr(item, attr, None) or "") for item in items)
+    decoded = 0
+    peak_bytes = 0
+    images = []
+    with span("decode_base64", images=len(items), encoded_bytes=pending) as current:
+        for item in items:
+            image_base64 = getattr(item, attr)
+            image_data = _b64decode_chunked(image_base64, chunk_size)
+            peak_bytes = max(peak_bytes, pending + decoded + len(image_data) + chunk_size)
+            images.append(image_data)
+            
+            # 元の文字列を解放（レスポンスのオブジェクトが参照を持ち続けないように）
+            setattr(item, attr, None)
+            pending -= len(image_base64)
+            decoded += len(image_data)
+            del image_base64
+        current.set(bytes=decoded, peak_bytes=peak_bytes)
+    record_peak("decode_peak_bytes", peak_bytes)
+    return images
+
+def decode_response_image(item, attr="b64_json"):
+    """レスポンスの画像1枚をデコード（元のBase64文字列は解放）"""
+    return decode_response_images([item], attr)[0]
+
 def decode_base64_to_image(base64_string):
     """Base64文字列を画像オブジェクトに変換"""
     image_data = base64.b64decode(base64_string)
@@ -26,4 +81,60 @@ def get_image_info(image_data):
         'size': image.size,
         'mode': image.mode,
         'format': image.format
-    }
\ No newline at end of file
+    }
+
+# 形式名 → PILの保存形式名
+_PIL_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+
+# 以下はプロセスプール（src.services.image_executor）のワーカーで実行する処理関数
+# （第1引数に画像バイト列を受け取り、bytes または (bytes, dict) を返す）
+
+def convert_image_format(image_data, target_format, compression=None):
+    """画像形式を変換（JPEGは透過部分を白背景で合成）"""
+    image = Image.open(BytesIO(image_data))
+    
+    # RGBA to RGB変換（JPEG用）
+    if target_format == "jpeg" and image.mode in ("RGBA", "LA", "P"):
+        # 白背景で合成
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    
+    output = BytesIO()
+    if target_format == "jpeg":
+        image.save(output, format="JPEG", quality=compression if compression is not None else 90)
+    elif target_format == "webp":
+        image.save(output, format="WebP", quality=compression if compression is not None else 90)
+    else:
+        image.save(output, format="PNG")
+    return output.getvalue()
+
+def render_thumbnail(image_data, max_size, target_format="jpeg", quality=80):
+    """長辺max_sizeの縮小画像を作成（draftでJPEGはデコード自体を縮小）"""
+    image = Image.open(BytesIO(image_data))
+    image.draft("RGB", (max_size, max_size))
+    image.thumbnail((max_size, max_size))
+    if target_format == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    output = BytesIO()
+    image.save(output, format=_PIL_FORMATS.get(target_format, target_format.upper()), quality=quality)
+    return output.getvalue()
+
+def decode_to_rgba(image_data):
+    """画像をデコードしてRGBAの生データを返す（表示側は Image.frombuffer で復元）"""
+    image = Image.open(BytesIO(image_data)).convert("RGBA")
+    return image.tobytes(), {"size": image.size}
+
+def prepare_reference_image(raw_data, mode, size, target_size="1024x1024"):
+    """参照画像を生成サイズ（auto は長辺1536）に収まるよう縮小してPNGに変換"""
+    image = Image.frombytes(mode, size, raw_data)
+    width, height = (int(v) for v in target_size.split("x")) if "x" in target_size else (1536, 1536)
+    image.thumbnail((width, height), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def image_from_rgba(raw_data, size):
+    """decode_to_rgbaの結果からPIL画像を復元（コピーなし）"""
+    return Image.frombuffer("RGBA", size, raw_data, "raw", "RGBA", 0, 1)
@@ -0,0 +1,99 @@
+"""スレッドセーフなLRUキャッシュ（必要最小限）"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class LRUCache:
+    """件数上限とTTL付きのLRUキャッシュ"""
+
+    def __init__(self,
+                 max_items: int = 128,
+                 ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.max_items = max(1, max_items)
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """値を取得（期限切れ・未登録ならdefault）"""
+        evicted = []
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl and time.time() - item[0] > self.ttl:
+                evicted.append((key, self._data.pop(key)[1]))
+                item = None
+            if item is None:
+                self.misses += 1
+                value = default
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[1]
+        self._notify(evicted)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """値を登録（上限超過分は古いものから破棄）"""
+        evicted = []
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                old_key, (_, old_value) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._notify(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """値を取り出して削除（破棄コールバックは呼ばない）"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """古い順のスナップショットを取得"""
+        with self._lock:
+            return [(k, v) for k, (_, v) in self._data.items()]
+
+    def clear(self):
+        """全件削除"""
+        with self._lock:
+            evicted = [(k, v) for k, (_, v) in self._data.items()]
+            self._data.clear()
+        self._notify(evicted)
+
+    def stats(self) -> Dict:
+        """ヒット率などの統計を取得"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _notify(self, evicted):
+        """破棄コールバックをロック外で呼び出す"""
+        if not self.on_evict:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f"キャッシュ破棄処理エラー: {e}")
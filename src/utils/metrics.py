@@ -0,0 +1,62 @@
+"""レイテンシ指標の記録（必要最小限）"""
+
+import math
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+# 記録対象の主な指標名
+TIME_TO_FIRST_PIXEL = "time_to_first_pixel"  # 生成開始から最初の部分画像までの秒数
+GENERATION_TIME = "generation_time"          # 生成開始から最終画像までの秒数
+
+
+def _percentile(sorted_values, ratio: float) -> float:
+    """ソート済みの値からパーセンタイルを取得（最近傍法）"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(ratio * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    """名前付きレイテンシ指標を直近N件保持し、パーセンタイルを集計"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float):
+        """計測値を記録"""
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.max_samples)
+            samples.append(seconds)
+
+    def summary(self, name: Optional[str] = None) -> Dict:
+        """指標ごとの件数・平均・p50/p95/p99を取得"""
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._samples.items() if name is None or k == name}
+
+        result = {}
+        for key, values in snapshot.items():
+            ordered = sorted(values)
+            result[key] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 3) if values else 0.0,
+                "p50": round(_percentile(ordered, 0.50), 3),
+                "p95": round(_percentile(ordered, 0.95), 3),
+                "p99": round(_percentile(ordered, 0.99), 3),
+                "last": round(values[-1], 3) if values else 0.0
+            }
+        return result
+
+
+# プロセス共有のデフォルトレコーダー
+_default_recorder = LatencyRecorder()
+
+
+def get_latency_recorder() -> LatencyRecorder:
+    """プロセス共有のレイテンシレコーダーを取得"""
+    return _default_recorder
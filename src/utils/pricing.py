@@ -0,0 +1,77 @@
+"""画像生成・チャット補完の料金計算
+
+UI表示と一括生成のマニフェストで同じ単価表を使うため、app.pyから分離した。
+"""
+
+from typing import Dict
+
+# GPT Image 1価格設定（2025年6月最新価格）
+GPT_IMAGE_PRICING = {
+    'low': {
+        '1024x1024': 0.011,
+        '1024x1536': 0.016,
+        '1536x1024': 0.016
+    },
+    'medium': {
+        '1024x1024': 0.042,
+        '1024x1536': 0.063,
+        '1536x1024': 0.063
+    },
+    'hd': {  # high
+        '1024x1024': 0.167,
+        '1024x1536': 0.25,
+        '1536x1024': 0.25
+    }
+}
+
+# 品質マッピング
+QUALITY_PRICING_MAP = {
+    'auto': 'medium',  # デフォルトはmedium
+    'standard': 'medium',
+    'low': 'low',
+    'medium': 'medium',
+    'high': 'hd',  # OpenAI docsではhigh = hd
+    'hd': 'hd'
+}
+
+# チャット補完の単価（USD / 100万トークン、入力・出力）。YAML変換はgpt-4o
+CHAT_PRICING = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60)
+}
+
+FALLBACK_COST_USD = 0.042
+USD_TO_JPY = 150  # 1USD = 150円で概算
+
+
+def image_cost_usd(size: str, quality: str, image_count: int = 1) -> float:
+    """サイズと品質に基づく合計コスト（USD、未知のサイズはフォールバック単価）"""
+    mapped_quality = QUALITY_PRICING_MAP.get(quality, 'medium')
+    cost_per_image = GPT_IMAGE_PRICING[mapped_quality].get(size, FALLBACK_COST_USD)
+    return cost_per_image * image_count
+
+
+def chat_cost_usd(model: str, input_tokens: int, output_tokens: int) -> float:
+    """チャット補完のコスト（USD、未知のモデルはgpt-4oの単価）"""
+    input_price, output_price = CHAT_PRICING.get(model, CHAT_PRICING['gpt-4o'])
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def calculate_image_cost(size, quality, image_count=1, cache_hit=False) -> Dict:
+    """サイズと品質に基づいて正確なコストを計算（表示用の文字列で返す）"""
+    # キャッシュヒット時はAPIを呼んでいないため無料
+    if cache_hit:
+        return {
+            'cost_usd': "0.000",
+            'cost_jpy': "0.0",
+            'per_image_usd': "0.000",
+            'cache_hit': True
+        }
+
+    cost_per_image = image_cost_usd(size, quality)
+    total_cost_usd = cost_per_image * image_count
+    return {
+        'cost_usd': f"{total_cost_usd:.3f}",
+        'cost_jpy': f"{total_cost_usd * USD_TO_JPY:.1f}",
+        'per_image_usd': f"{cost_per_image:.3f}"
+    }
@@ -0,0 +1,347 @@
+"""生成パイプラインの段階別トレース
+
+1回の生成リクエストをトレース（トレースID付き）とし、YAML変換・順番待ち・API呼び出し・
+base64デコード・形式変換・履歴書き込みなどの段階をスパンとして所要時間とバイト数を記録する。
+
+- 現在のトレース・スパンはcontextvarsで保持するため、asyncio.to_thread や
+  ファンアウトのタスクで実行した処理も同じトレースに記録される
+- トレース外で呼ばれた span() は何も記録しない（サービス層は常に計測を埋め込んでよい）
+- 完了したトレースはJSON Lines、またはOTLP互換のJSONファイルに書き出せる
+  （TRACE_EXPORT=jsonl / otlp）。段階ごとの所要時間はレイテンシレコーダーにも集計する
+"""
+
+import contextlib
+import contextvars
+import json
+import secrets
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from src.utils.config import TRACING_SETTINGS
+from src.utils.metrics import get_latency_recorder
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """トレース内の1段階（名前・開始/終了時刻・属性）"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        """属性を追加（バイト数など、処理後に分かる値）"""
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class _NoopSpan:
+    """トレース外で使われるスパン（記録しない）"""
+
+    def set(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """1リクエスト分のトレース"""
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.trace_id = secrets.token_hex(16)
+        self.name = name
+        self.attributes = attributes
+        self.root = Span(name, None, attributes)
+        self.wall_start = time.time()
+        self.spans: List[Span] = []
+        self.error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._previous: Optional["Trace"] = None
+        self._previous_span: Optional[str] = None
+        self._ended = False
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def set(self, **attributes):
+        """トレース全体の属性を追加"""
+        self.attributes.update(attributes)
+
+    def set_error(self, error: BaseException):
+        """トレースを失敗として記録"""
+        self.error = str(error)
+
+    def wall_time(self, perf: float) -> float:
+        """perf_counterの値をUNIX時刻に換算"""
+        return self.wall_start + (perf - self.root.start)
+
+    def stages(self) -> Dict[str, float]:
+        """段階名ごとの合計秒数"""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return {name: round(seconds, 4) for name, seconds in totals.items()}
+
+    def end(self):
+        """トレースを終了して書き出す（contextvarは開始前の値に戻す）"""
+        if self._ended:
+            return
+        self._ended = True
+        self.root.end = time.perf_counter()
+        # yieldを挟むハンドラでは開始時と終了時のContextが異なる場合があるため、resetではなくsetで戻す
+        _current_trace.set(self._previous)
+        _current_span.set(self._previous_span)
+        get_tracer().finish(self)
+
+    def to_dict(self) -> Dict:
+        """JSON Lines形式の1行分"""
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start_time": round(self.wall_start, 6),
+            "duration": round(self.root.duration, 4),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+            "stages": self.stages(),
+            "spans": [{
+                "span_id": span.span_id,
+                "parent_id": span.parent_id or self.root.span_id,
+                "name": span.name,
+                "offset": round(span.start - self.root.start, 4),
+                "duration": round(span.duration, 4),
+                "attributes": span.attributes,
+                **({"error": span.error} if span.error else {})
+            } for span in spans]
+        }
+
+
+def start_trace(name: str, **attributes) -> Trace:
+    """トレースを開始して現在のトレースにする（終了時は trace.end() を呼ぶ）"""
+    trace = Trace(name, attributes)
+    trace._previous = _current_trace.get()
+    trace._previous_span = _current_span.get()
+    _current_trace.set(trace)
+    _current_span.set(trace.root.span_id)
+    return trace
+
+
+@contextlib.contextmanager
+def traced(name: str, **attributes) -> Iterator[Trace]:
+    """with文でトレースを開始・終了（例外はエラーとして記録）"""
+    trace = start_trace(name, **attributes)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.set_error(e)
+        raise
+    finally:
+        trace.end()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Any]:
+    """段階を計測するスパン（トレース外では何も記録しない）"""
+    trace = _current_trace.get()
+    if trace is None or not TRACING_SETTINGS["enabled"]:
+        yield _NOOP_SPAN
+        return
+
+    current = Span(name, _current_span.get(), attributes)
+    previous = _current_span.get()
+    _current_span.set(current.span_id)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = str(e) or type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.set(previous)
+        trace.add(current)
+
+
+def record_span(name: str, duration: float, **attributes):
+    """別途計測した所要時間をスパンとして記録（終了時刻は現在）"""
+    trace = _current_trace.get()
+    if trace is None or not TRACING_SETTINGS["enabled"]:
+        return
+    recorded = Span(name, _current_span.get(), attributes)
+    recorded.end = time.perf_counter()
+    recorded.start = recorded.end - max(0.0, duration)
+    trace.add(recorded)
+
+
+def record_peak(name: str, value: int):
+    """トレースの属性に最大値を記録（リクエスト内で複数回呼ばれた場合は最大値を残す）"""
+    trace = _current_trace.get()
+    if trace is None or not TRACING_SETTINGS["enabled"]:
+        return
+    with trace._lock:
+        trace.attributes[name] = max(trace.attributes.get(name) or 0, value)
+
+
+def record_total(name: str, value: float):
+    """トレースの属性に値を加算（リクエスト内のトークン数・コストの合計など）"""
+    trace = _current_trace.get()
+    if trace is None or not TRACING_SETTINGS["enabled"]:
+        return
+    with trace._lock:
+        trace.attributes[name] = (trace.attributes.get(name) or 0) + value
+
+
+class JsonLinesExporter:
+    """トレースを1行1件のJSONで追記"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def format(self, trace: Trace) -> Dict:
+        return trace.to_dict()
+
+    def export(self, trace: Trace):
+        line = json.dumps(self.format(trace), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class OtlpFileExporter(JsonLinesExporter):
+    """OTLP/JSON（OpenTelemetry Collectorのfile exporterと同じ形式）で追記
+
+    otelcolのfilelog/otlpjsonfileレシーバーなどでそのまま取り込める。
+    """
+
+    def _otlp_span(self, trace: Trace, span: Span, parent_id: Optional[str], error: Optional[str]) -> Dict:
+        end = span.end if span.end is not None else time.perf_counter()
+        return {
+            "traceId": trace.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": parent_id or "",
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(int(trace.wall_time(span.start) * 1e9)),
+            "endTimeUnixNano": str(int(trace.wall_time(end) * 1e9)),
+            "attributes": _otlp_attributes(span.attributes),
+            "status": {"code": 2, "message": error} if error else {"code": 1}
+        }
+
+    def format(self, trace: Trace) -> Dict:
+        with trace._lock:
+            spans = list(trace.spans)
+        otlp_spans = [self._otlp_span(trace, trace.root, None, trace.error)]
+        otlp_spans += [self._otlp_span(trace, s, s.parent_id or trace.root.span_id, s.error) for s in spans]
+        return {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": TRACING_SETTINGS["service_name"]})},
+            "scopeSpans": [{"scope": {"name": "src.utils.tracing"}, "spans": otlp_spans}]
+        }]}
+
+
+_EXPORTERS = {"jsonl": JsonLinesExporter, "otlp": OtlpFileExporter}
+
+
+class Tracer:
+    """完了したトレースの書き出し・集計"""
+
+    def __init__(self, export: str = TRACING_SETTINGS["export"], path: str = TRACING_SETTINGS["path"],
+                 recent_traces: int = TRACING_SETTINGS["recent_traces"]):
+        exporter_class = _EXPORTERS.get(export)
+        self.exporter = exporter_class(path) if exporter_class and path else None
+        self._recent: Deque[Dict] = deque(maxlen=max(1, recent_traces))
+        self._lock = threading.Lock()
+        self._finished = 0
+        self._errors = 0
+        self._export_errors = 0
+
+    def finish(self, trace: Trace):
+        """完了したトレースを集計し、設定されていれば書き出す"""
+        recorder = get_latency_recorder()
+        recorder.record(f"trace.{trace.name}", trace.root.duration)
+        stages = trace.stages()
+        for name, seconds in stages.items():
+            recorder.record(f"stage.{name}", seconds)
+
+        with self._lock:
+            self._finished += 1
+            self._errors += 1 if trace.error else 0
+            self._recent.append({
+                "trace_id": trace.trace_id,
+                "name": trace.name,
+                "duration": round(trace.root.duration, 4),
+                "status": "error" if trace.error else "ok",
+                "stages": stages
+            })
+
+        if self.exporter is not None:
+            try:
+                self.exporter.export(trace)
+            except Exception as e:
+                with self._lock:
+                    self._export_errors += 1
+                print(f"トレース書き出しエラー: {e}")
+
+    def recent(self, limit: int = 10) -> List[Dict]:
+        """直近のトレース概要（新しい順）"""
+        with self._lock:
+            return list(self._recent)[::-1][:limit]
+
+    def stats(self) -> Dict:
+        """トレース数と段階別レイテンシの集計"""
+        latency = get_latency_recorder().summary()
+        with self._lock:
+            return {
+                "finished": self._finished,
+                "errors": self._errors,
+                "export_errors": self._export_errors,
+                "exporter": type(self.exporter).__name__ if self.exporter else None,
+                "stages": {k[len("stage."):]: v for k, v in latency.items() if k.startswith("stage.")},
+                "traces": {k[len("trace."):]: v for k, v in latency.items() if k.startswith("trace.")}
+            }
+
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """プロセス共有のトレーサーを取得"""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer()
+    return _tracer